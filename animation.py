@@ -6,12 +6,13 @@ Email: lx249@cam.ac.uk
 
 # %%
 import networkx as nx
-import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from matplotlib.lines import Line2D
 
 from network import SCNetwork
+from simulation import spawn_seed_sequences
+from trajectory import TrajectoryReader
 from utils import load_config_file
 
 
@@ -61,10 +62,13 @@ def get_bankrupt_nodes(data):
     return list(bankrupt_nodes["node_idx"])
 
 
-def update(ts, data, network, ax, max_ts):
+def update(ts, reader, network, ax, max_ts):
     ax.clear()
     ax.set_ymargin(0.2)
 
+    # Read only the current and previous timesteps
+    data = reader.frames(ts - 1, ts)
+
     G = network.G.copy()
     layout = network.layout.copy()
     node_colors = network.node_colors.copy()
@@ -160,18 +164,21 @@ def update(ts, data, network, ax, max_ts):
 
 def animate(data_file):
     
-    data = pd.read_csv(data_file)
+    reader = TrajectoryReader(data_file)
 
-    max_ts = data.timestep.max()
+    max_ts = reader.max_timestep
 
     network_config = load_config_file("configs/network_config.yaml")
     sim_config = load_config_file("configs/simulation_config.yaml")
+    # Assign the same node powers as the simulation with the same seed
+    power_seq, _, _ = spawn_seed_sequences(sim_config.get("seed"))
     network = SCNetwork(
         sim_config["network_topology"],
         sim_config["homogeneous"],
         sim_config["powers"], 
         sim_config["market_shares"],
-        config=network_config)
+        config=network_config,
+        seed=power_seq)
 
     fig, ax = network.draw()
 
@@ -184,7 +191,7 @@ def animate(data_file):
                                    frames=range(1, max_ts+2), 
                                    interval=500,
                                    repeat=False,
-                                   fargs=(data, network, ax, max_ts))
+                                   fargs=(reader, network, ax, max_ts))
 
     # Toggle animation
     paused = False
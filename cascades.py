@@ -0,0 +1,199 @@
+"""
+Bankruptcy cascades: which failures a bankruptcy exposed other firms to.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+The tracer keeps the unpaid payments between firms as arrays, appended to as
+orders are paid for, a step at a time, and pruned as payments fall due, so
+that no payment is handled one by one. When a firm goes bankrupt, it records
+the cascade edges out of it, summing what it owes each seller from the arrays:
+    `receivable`: a supplier exposed to it by what it owed, with the amount;
+    `supply`: a customer that lost it as a supply route, with the number of
+              suppliers the customer has left.
+`receivable` edges record exposure only: the engine still pays the receivables
+of a bankrupt buyer to its sellers, so no receivable is stranded, and they do
+not propagate failures. The failures form a cascade tree: the parent of a
+failure is the failed firm whose `supply` edge into it is the most recent,
+the fewest suppliers left breaking ties; failures with no `supply` edge into
+them are roots.
+"""
+
+import json
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+
+class CascadeTracer(object):
+    """
+    Parameters
+    ----------
+    `graph`: nx.DiGraph
+        The supply chain network, i.e., `SCNetwork.G`, with edges from sellers to buyers.
+    `excluded`: list
+        Nodes that are not traced, i.e., the dummy nodes.
+    """
+
+    def __init__(self, graph, excluded=()):
+        self.G = graph
+        self.excluded = set(excluded)
+        # Nodes whose payments are not traced: the excluded ones, and the failed ones as they fail
+        self.untraced = np.zeros(max(graph.nodes, default=-1) + 1, dtype=bool)
+        self.untraced[list(self.excluded)] = True
+        # Unpaid payments, as chunks of `(buyers, sellers, amounts, due)` arrays
+        self.unpaid = []
+        # Cascade edges (t, source, target, kind, value), and the failures {node: t}
+        self.edges = []
+        self.failed_at = {}
+        # Cascade edges into each node, for finding its parent when it fails
+        self.edges_into = defaultdict(list)
+
+
+    def add_payments(self, buyers, sellers, amounts, due):
+        """
+        Record that each of `buyers` owes its seller the amount, to be paid at its `due` timestep.
+        """
+        traced = (amounts > 0) & ~self.untraced[buyers] & ~self.untraced[sellers]
+        if traced.any():
+            self.unpaid.append((buyers[traced], sellers[traced], amounts[traced], due[traced]))
+
+
+    def _keep(self, kept):
+        """
+        Keep the unpaid payments selected by the mask `kept`, merged into one chunk.
+        """
+        buyers, sellers, amounts, due = self._merged()
+        self.unpaid = [(buyers[kept], sellers[kept], amounts[kept], due[kept])] if kept.any() else []
+
+
+    def _merged(self):
+        """
+        The unpaid payments as a single chunk of arrays.
+        """
+        if len(self.unpaid) > 1:
+            self.unpaid = [tuple(np.concatenate(arrays) for arrays in zip(*self.unpaid))]
+        return self.unpaid[0]
+
+
+    def settle(self, t):
+        """
+        Remove the payments due by timestep `t`, as they are paid.
+        """
+        if self.unpaid:
+            self._keep(self._merged()[3] > t)
+
+
+    def fail(self, node, t):
+        """
+        Record the bankruptcy of `node` at timestep `t`, before its edges are removed,
+        and drop its unpaid payments from the index.
+        """
+        self.failed_at[node] = t
+        self.untraced[node] = True
+        if self.unpaid:
+            buyers, sellers, amounts, _ = self._merged()
+            owed = buyers == node
+            if owed.any():
+                # What it owes each seller, in the order they were first owed
+                owed_sellers, first, inverse = np.unique(sellers[owed], return_index=True,
+                                                         return_inverse=True)
+                totals = np.bincount(inverse, weights=amounts[owed])
+                for i in np.argsort(first).tolist():
+                    self._add_edge(t, node, int(owed_sellers[i]), "receivable", float(totals[i]))
+            self._keep(~owed & (sellers != node))
+        for customer in self.G.successors(node):
+            if customer in self.excluded or customer in self.failed_at:
+                continue
+            self._add_edge(t, node, customer, "supply", self.G.in_degree(customer) - 1)
+
+
+    def _add_edge(self, t, source, target, kind, value):
+        edge = (t, source, target, kind, value)
+        self.edges.append(edge)
+        self.edges_into[target].append(edge)
+
+
+    def parent(self, node):
+        """
+        The failed node whose `supply` edge into `node` is the most recent before
+        it failed, the fewest suppliers left breaking ties; None for a root.
+        """
+        t_failed = self.failed_at[node]
+        candidates = [(t, -value, -source)
+                      for t, source, _, kind, value in self.edges_into.get(node, ())
+                      if kind == "supply" and t <= t_failed]
+        if not candidates:
+            return None
+        return -max(candidates)[2]
+
+
+    def tree(self):
+        """
+        The cascade tree, as the failures in the order they happened, each with its
+        parent, depth, and root, and the cascade edges.
+        """
+        failures = []
+        depths = {}
+        roots = {}
+        for node, t in sorted(self.failed_at.items(), key=lambda x: (x[1], x[0])):
+            parent = self.parent(node)
+            depths[node] = 0 if parent is None else depths[parent] + 1
+            roots[node] = node if parent is None else roots[parent]
+            failures.append({"node": node, "t": t, "parent": parent,
+                             "depth": depths[node], "root": roots[node]})
+        return {
+            "failures": failures,
+            "edges": [list(edge) for edge in self.edges],
+        }
+
+
+    @property
+    def depth(self):
+        """
+        The depth of the deepest cascade, i.e., 0 if no failure caused another.
+        """
+        return max((f["depth"] for f in self.tree()["failures"]), default=0)
+
+
+    def save(self, path, sim_id=None):
+        """
+        Export the cascade tree as JSON.
+        """
+        with open(path, "w") as file:
+            json.dump({"sim_id": sim_id, **self.tree()}, file, default=float)
+
+
+def load_cascade(path):
+    """
+    Load an exported cascade tree, as `(failures, edges)` dataframes.
+    """
+    with open(path) as file:
+        tree = json.load(file)
+    failures = pd.DataFrame(tree["failures"], columns=["node", "t", "parent", "depth", "root"])
+    edges = pd.DataFrame(tree["edges"], columns=["t", "source", "target", "kind", "value"])
+    return failures, edges
+
+
+def cascade_from_summary(summary):
+    """
+    Rebuild the failures of the cascade tree from the summary of a simulation,
+    e.g., a row of the results table, for runs whose tree was not exported, as
+    the `failures` dataframe of `load_cascade`.
+    """
+    def pairs(value):
+        if not isinstance(value, str) or not value:
+            return []
+        return [tuple(int(x) for x in pair.split(":")) for pair in value.split(";")]
+
+    parents = dict(pairs(summary["cascade_parents"]))
+    failures = []
+    depths = {}
+    roots = {}
+    for node, t in pairs(summary["failed_nodes"]):
+        parent = parents.get(node)
+        depths[node] = 0 if parent is None else depths[parent] + 1
+        roots[node] = node if parent is None else roots[parent]
+        failures.append({"node": node, "t": t, "parent": parent,
+                         "depth": depths[node], "root": roots[node]})
+    return pd.DataFrame(failures, columns=["node", "t", "parent", "depth", "root"])
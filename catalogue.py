@@ -0,0 +1,239 @@
+"""
+A local SQLite catalogue of simulations: their configs, engine version, seed,
+runtime and summary metrics, indexed by the swept parameters.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+"""
+
+# %%
+import argparse
+import json
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from simulation import ENGINE_VERSION
+
+# The default catalogue file
+catalogue_file = "output_data/catalogue.db"
+
+# Swept parameters, stored as columns and indexed for lookups
+indexed_columns = [
+    ("network_topology", "TEXT"),
+    ("homogeneous", "INTEGER"),
+    ("financed", "INTEGER"),
+    ("paradigm", "TEXT"),
+    ("operation_fee", "REAL"),
+    ("loan_repayment_time", "INTEGER"),
+    ("bank_annual_rate", "REAL"),
+    ("invoice_annual_rate", "REAL"),
+    ("invoice_term", "INTEGER"),
+    ("window_size", "INTEGER"),
+    ("demand_mean", "REAL"),
+    ("demand_sigma", "REAL"),
+]
+
+# Summary metrics, stored as columns for filtering and sorting
+metric_columns = [
+    ("t_end", "INTEGER"),
+    ("stop_reason", "TEXT"),
+    ("survived", "INTEGER"),
+    ("num_failed", "INTEGER"),
+]
+
+schema = f"""
+CREATE TABLE IF NOT EXISTS simulations (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sim_id TEXT,
+    {", ".join(f"{name} {dtype}" for name, dtype in indexed_columns + metric_columns)},
+    engine_version TEXT,
+    seed TEXT,
+    runtime REAL,
+    output_path TEXT,
+    config TEXT,
+    summary TEXT,
+    recorded_at REAL
+);
+CREATE TABLE IF NOT EXISTS failures (
+    run_id INTEGER REFERENCES simulations(run_id),
+    node_idx INTEGER,
+    timestep INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_failures_node ON failures (node_idx, run_id);
+CREATE INDEX IF NOT EXISTS idx_simulations_sim_id ON simulations (sim_id);
+""" + "\n".join(f"CREATE INDEX IF NOT EXISTS idx_simulations_{name} ON simulations ({name});"
+                for name, _ in indexed_columns)
+
+
+def _to_json(obj):
+    """
+    Serialise configs and summaries, converting numpy scalars and arrays.
+    """
+    def default(x):
+        if isinstance(x, np.generic):
+            return x.item()
+        if isinstance(x, np.ndarray):
+            return x.tolist()
+        return str(x)
+    return json.dumps(obj, default=default)
+
+
+def _to_sql(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+class Catalogue(object):
+    """
+    Catalogue of simulations in a SQLite database.
+    Records are buffered and written in batches of `batch_size`, each in a
+    single transaction, so that parallel workers rarely contend for the lock.
+
+    Parameters
+    ----------
+    `path`: str
+        The database file.
+    `batch_size`: int
+        The number of records buffered before they are written.
+    `timeout`: float
+        Seconds to wait for the lock held by other writers.
+    """
+
+    def __init__(self, path=catalogue_file, batch_size=100, timeout=60):
+        self.path = path
+        self.batch_size = batch_size
+        self.buffer = []
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(schema)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def record(self, summary, config, runtime, output_path=None, seed=None,
+               engine_version=ENGINE_VERSION):
+        """
+        Buffer the record of a finished simulation.
+
+        Parameters
+        ----------
+        `summary`: dict
+            The summary of the simulation, see `SCFSimulation.summary`.
+        `config`: dict
+            The full config of the simulation.
+        `runtime`: float
+            Seconds taken to run the simulation.
+        `output_path`: str, optional
+            The trajectory file, None if not written.
+        `seed`: int, optional
+            The seed of the simulation.
+        """
+        failures = []
+        if summary.get("failed_nodes"):
+            for item in summary["failed_nodes"].split(";"):
+                node_idx, t = item.split(":")
+                failures.append((int(node_idx), int(t)))
+
+        row = [str(summary["sim_id"])]
+        row += [_to_sql(summary.get(name)) for name, _ in indexed_columns + metric_columns]
+        row += [engine_version, None if seed is None else str(seed), runtime, output_path,
+                _to_json(config), _to_json(summary), time.time()]
+        self.buffer.append((row, failures))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Write buffered records in a single transaction.
+        """
+        if not self.buffer:
+            return
+        columns = (["sim_id"] + [name for name, _ in indexed_columns + metric_columns]
+                   + ["engine_version", "seed", "runtime", "output_path",
+                      "config", "summary", "recorded_at"])
+        insert = (f"INSERT INTO simulations ({', '.join(columns)}) "
+                  f"VALUES ({', '.join('?' * len(columns))})")
+        with self.conn:
+            for row, failures in self.buffer:
+                run_id = self.conn.execute(insert, row).lastrowid
+                self.conn.executemany(
+                    "INSERT INTO failures (run_id, node_idx, timestep) VALUES (?, ?, ?)",
+                    [(run_id, node_idx, t) for node_idx, t in failures])
+        self.buffer = []
+
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+    def find(self, failed_node=None, **filters):
+        """
+        Find simulations by swept parameters and failed node.
+        e.g., `find(network_topology="diamond", bank_annual_rate=1.05, invoice_term=60, failed_node=3)`
+
+        Parameters
+        ----------
+        `failed_node`: int, optional
+            Only simulations in which this node went bankrupt.
+        `filters`: dict
+            Equality filters on the indexed columns and the summary metrics.
+
+        Returns
+        -------
+            pd.DataFrame: The matching simulations, with their output paths and summaries.
+        """
+        columns = {name for name, _ in indexed_columns + metric_columns} | {"sim_id", "engine_version"}
+        clauses, params = [], []
+        for name, value in filters.items():
+            if name not in columns:
+                raise ValueError(f"Cannot filter by '{name}', must be one of {sorted(columns)}.")
+            clauses.append(f"s.{name} = ?")
+            params.append(_to_sql(value))
+        if failed_node is not None:
+            clauses.append("s.run_id IN (SELECT run_id FROM failures WHERE node_idx = ?)")
+            params.append(int(failed_node))
+
+        self.flush()
+        query = "SELECT s.* FROM simulations s"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        return pd.read_sql_query(query, self.conn, params=params)
+
+
+def _parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return {"True": 1, "False": 0}.get(value, value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up simulations in the catalogue.")
+    parser.add_argument("filters", nargs="*",
+                        help="Filters as `name=value`, e.g., `network_topology=diamond failed_node=3`.")
+    parser.add_argument("--catalogue", default=catalogue_file, help="The catalogue file.")
+    args = parser.parse_args()
+
+    filters = dict(f.split("=", 1) for f in args.filters)
+    filters = {name: _parse_value(value) for name, value in filters.items()}
+    with Catalogue(args.catalogue) as catalogue:
+        t = time.perf_counter()
+        found = catalogue.find(**filters)
+        elapsed = time.perf_counter() - t
+    print(found[["run_id", "sim_id", "t_end", "survived", "num_failed", "output_path"]].to_string())
+    print(f"{len(found)} simulations found in {elapsed * 1000:.1f} ms.")
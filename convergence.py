@@ -0,0 +1,67 @@
+"""
+Detect steady (absorbing) states in which a simulation can be stopped early.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+"""
+
+import numpy as np
+
+
+class SteadyStateDetector(object):
+    """
+    Detect the steady state of a simulation, in which no node is expected to
+    go bankrupt any more. Over the past `window_size` timesteps, every active
+    (i.e., non-dummy and non-bankrupt) node must satisfy all of:
+        1) non-negative cash drift: its cash at the end of the window is at
+           least the cash at the start, never fell more than `cash_tolerance`
+           below it within the window, and stayed positive;
+        2) no debt outstanding: no loan is waiting to be repaid; and
+        3) no open invoices: its outstanding payables are covered by its cash.
+    """
+
+    def __init__(self, num_nodes, window_size, cash_tolerance=0):
+        if window_size < 1:
+            raise ValueError("`window_size` must be a positive integer.")
+        self.window_size = int(window_size)
+        self.cash_tolerance = cash_tolerance
+        # Ring buffer of cash, one row per timestep;
+        # it holds one more row than the window for the cash at window start.
+        self.cash_history = np.zeros((self.window_size + 1, num_nodes))
+        self.num_updates = 0
+
+
+    def update(self, cash, active, total_payables, total_debts):
+        """
+        Record the state at current timestep and check if steady state is reached.
+
+        Parameters
+        ----------
+        `cash`: np.ndarray
+            Cash of each node at current timestep.
+        `active`: np.ndarray
+            Boolean mask of nodes to be checked, i.e., non-dummy and non-bankrupt ones.
+        `total_payables`: np.ndarray
+            Outstanding payables of each node, including debts.
+        `total_debts`: np.ndarray
+            Outstanding debts (loans plus interest) of each node.
+
+        Returns
+        -------
+            bool: True if steady state is reached.
+        """
+        self.cash_history[self.num_updates % (self.window_size + 1)] = cash
+        self.num_updates += 1
+        if self.num_updates <= self.window_size or not np.any(active):
+            return False
+
+        # The oldest row is the next one to be overwritten
+        start_cash = self.cash_history[self.num_updates % (self.window_size + 1)][active]
+        window_cash = self.cash_history[:, active]
+        # A node losing cash over the window is heading for bankruptcy, however slowly
+        is_drift_nonnegative = np.all(cash[active] >= start_cash)
+        is_drift_bounded = np.all(window_cash.min(axis=0) >= start_cash - self.cash_tolerance)
+        is_cash_positive = np.all(window_cash > 0)
+        is_debt_free = np.all(total_debts[active] <= 0)
+        is_invoice_covered = np.all(total_payables[active] <= cash[active])
+        return bool(is_drift_nonnegative and is_drift_bounded and is_cash_positive
+                    and is_debt_free and is_invoice_covered)
@@ -0,0 +1,488 @@
+"""
+Summary cube: the summaries of completed sweeps, pre-aggregated over every
+swept parameter, so that slices and marginals are answered in milliseconds
+without reading the results table or any trajectory again.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+The cube has one axis per swept parameter, one cell per combination of their
+values. Each cell keeps, per measure, the count, sum, sum of squares, minimum,
+maximum, and a histogram over fixed bin edges shared by all cells. All of them
+add up, so cells merge by summing: a marginal over some parameters sums their
+axes, and cubes built from different sweeps merge into one. Quantiles are
+read from the merged histograms, to within a bin.
+
+Only the cells holding simulations are stored, by their flat index into the
+axes, so that a cube takes at most a cell per simulation; e.g., continuous
+parameters of a sampled sweep, with a value per simulation, would otherwise
+make the combinations of their values far too many to hold.
+"""
+
+# %%
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from emulator import load_results
+from output import results_file
+
+# The default cube file
+cube_file = "output_data/cube.npz"
+
+# Summary metrics aggregated by default, with the failure counts and shares by power
+default_measures = ["t_end", "survived", "num_failed", "cascade_depth", "total_loans", "total_discounts",
+                    "peak_memory_mb"]
+measure_prefixes = ("failed_power_", "failed_share_")
+
+# Columns of the results table that are neither swept parameters nor measures
+other_columns = ["sim_id", "seed", "stop_reason", "failed_nodes", "failed_tiers",
+                 "peak_memory_phase", "memory_by_phase", "memory_by_subsystem"]
+
+# Statistics answered by `SummaryCube.query`, besides quantiles `p<percent>`, e.g., `p50`
+stat_names = ("count", "mean", "std", "min", "max")
+
+# The most groups a query may aggregate into, as they are held densely
+max_groups = 2**20
+
+
+def _coord(value):
+    """
+    A coordinate as a plain Python value, None for a missing value.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _ravel(codes, shape, size):
+    """
+    The flat indices of `size` cells, given their coordinate indices along each axis.
+    """
+    if not shape:
+        return np.zeros(size, dtype=np.int64)
+    return np.ravel_multi_index(codes, shape).astype(np.int64)
+
+
+def _bin_edges(values, bins):
+    """
+    Bin edges of a measure: unit bins centred on the integers if the values
+    are integers spanning fewer than `bins` of them, otherwise `bins` equal bins.
+    """
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.array([-0.5, 0.5])
+    low, high = values.min(), values.max()
+    if np.all(values == np.round(values)) and high - low < bins:
+        return np.arange(low - 0.5, high + 1.5)
+    if low == high:
+        return np.array([low - 0.5, high + 0.5])
+    return np.linspace(low, high, bins + 1)
+
+
+class SummaryCube(object):
+    """
+    Parameters
+    ----------
+    `dims`: list
+        The swept parameters, one axis each.
+    `coords`: list
+        The values of each parameter along its axis, None for a missing value.
+    `measures`: list
+        The aggregated summary metrics.
+    `edges`: list
+        The histogram bin edges of each measure.
+    `arrays`: dict, optional
+        The aggregates of the cells holding simulations, and their flat indices
+        `cells`, as built by `from_results`; no cell by default.
+    """
+
+    def __init__(self, dims, coords, measures, edges, arrays=None):
+        self.dims = list(dims)
+        self.coords = [list(c) for c in coords]
+        self.measures = list(measures)
+        self.edges = [np.asarray(e, dtype=float) for e in edges]
+        self.shape = tuple(len(c) for c in self.coords)
+        if np.prod(self.shape, dtype=float) > np.iinfo(np.int64).max:
+            raise ValueError(f"The axes of {self.dims} have {np.prod(self.shape, dtype=float):.3g} "
+                             "combinations, too many to index; build the cube over fewer parameters.")
+        self.num_bins = max(len(e) - 1 for e in self.edges) if self.edges else 0
+        self._set(self._empty(0) if arrays is None else arrays)
+
+
+    def _empty(self, num_cells):
+        """
+        The aggregates of `num_cells` empty cells.
+        """
+        M = len(self.measures)
+        return {
+            "cells": np.zeros(num_cells, dtype=np.int64),
+            "count": np.zeros(num_cells, dtype=np.int64),
+            "n": np.zeros((num_cells, M), dtype=np.int64),
+            "total": np.zeros((num_cells, M)),
+            "total_sq": np.zeros((num_cells, M)),
+            "minimum": np.full((num_cells, M), np.inf),
+            "maximum": np.full((num_cells, M), -np.inf),
+            "hist": np.zeros((num_cells, M, self.num_bins), dtype=np.int64),
+        }
+
+
+    def _set(self, arrays):
+        # `cells`: sorted flat indices of the cells; `count`: simulations per cell;
+        # `n`: those with a value of each measure
+        self.cells = arrays["cells"]
+        self.count = arrays["count"]
+        self.n = arrays["n"]
+        self.total = arrays["total"]
+        self.total_sq = arrays["total_sq"]
+        self.minimum = arrays["minimum"]
+        self.maximum = arrays["maximum"]
+        self.hist = arrays["hist"]
+
+
+    @property
+    def arrays(self):
+        return {"cells": self.cells, "count": self.count, "n": self.n, "total": self.total,
+                "total_sq": self.total_sq, "minimum": self.minimum, "maximum": self.maximum,
+                "hist": self.hist}
+
+
+    @property
+    def num_sims(self):
+        return int(self.count.sum())
+
+
+    @classmethod
+    def from_results(cls, results, dims=None, measures=None, bins=64, edges=None):
+        """
+        Build a cube from simulation summaries, see `emulator.load_results`.
+
+        Parameters
+        ----------
+        `results`: pd.DataFrame
+            The summaries, one row per simulation.
+        `dims`: list, optional
+            The swept parameters, by default every column that is not a measure
+            nor in `other_columns`.
+        `measures`: list, optional
+            The summary metrics to aggregate, by default `default_measures` and
+            the failure counts and shares by power, as far as present.
+        `bins`: int
+            The number of histogram bins of a measure, see `_bin_edges`.
+        `edges`: dict, optional
+            `{measure: bin edges}`, overriding the bins of those measures, e.g.,
+            to build a cube that merges with an existing one.
+        """
+        if measures is None:
+            measures = [c for c in results.columns
+                        if c in default_measures or c.startswith(measure_prefixes)]
+        if dims is None:
+            dims = [c for c in results.columns if c not in measures and c not in other_columns]
+        missing = [c for c in list(dims) + list(measures) if c not in results.columns]
+        if missing:
+            raise ValueError(f"The results have no columns {missing}.")
+
+        codes, coords = [], []
+        for dim in dims:
+            code, uniques = pd.factorize(results[dim], sort=True, use_na_sentinel=False)
+            codes.append(code)
+            coords.append([_coord(u) for u in uniques])
+        values = results[measures].to_numpy(dtype=float)
+        edges = [np.asarray((edges or {}).get(m, _bin_edges(values[:, i], bins)), dtype=float)
+                 for i, m in enumerate(measures)]
+        cube = cls(dims, coords, measures, edges)
+        cube._add(codes, values)
+        return cube
+
+
+    def _insert(self, cells):
+        """
+        Add empty cells at the flat indices `cells`, if not stored yet.
+        """
+        cells = np.union1d(self.cells, cells)
+        if len(cells) == len(self.cells):
+            return
+        arrays = self._empty(len(cells))
+        at = np.searchsorted(cells, self.cells)
+        for k, a in self.arrays.items():
+            arrays[k][at] = a
+        arrays["cells"] = cells
+        self._set(arrays)
+
+
+    def _add(self, codes, values):
+        """
+        Add simulations to their cells, given their coordinate indices and measure values.
+        """
+        cells = _ravel(codes, self.shape, len(values))
+        self._insert(cells)
+        cells = np.searchsorted(self.cells, cells)
+
+        np.add.at(self.count, cells, 1)
+        for i, edges in enumerate(self.edges):
+            v = values[:, i]
+            has_value = ~np.isnan(v)
+            c, v = cells[has_value], v[has_value]
+            np.add.at(self.n[:, i], c, 1)
+            np.add.at(self.total[:, i], c, v)
+            np.add.at(self.total_sq[:, i], c, v * v)
+            np.minimum.at(self.minimum[:, i], c, v)
+            np.maximum.at(self.maximum[:, i], c, v)
+            # Values beyond the edges fall in the end bins
+            b = np.clip(np.searchsorted(edges, v, side="right") - 1, 0, len(edges) - 2)
+            np.add.at(self.hist[:, i], (c, b), 1)
+
+
+    def merge(self, other):
+        """
+        A cube of the simulations of both cubes, over the union of their
+        coordinates. They must have the same parameters, measures and bin edges.
+        """
+        if self.dims != other.dims or self.measures != other.measures:
+            raise ValueError("Cubes of different parameters or measures cannot be merged.")
+        if any(len(a) != len(b) or not np.allclose(a, b) for a, b in zip(self.edges, other.edges)):
+            raise ValueError("Cubes of different bin edges cannot be merged, "
+                             "build one with `edges` of the other.")
+        coords = []
+        for a, b in zip(self.coords, other.coords):
+            coords.append(sorted(a + [c for c in b if c not in a], key=lambda c: (c is None, c)))
+        merged = SummaryCube(self.dims, coords, self.measures, self.edges)
+        for cube in (self, other):
+            # The cells of the cube, indexed along the merged axes
+            codes = np.unravel_index(cube.cells, cube.shape) if cube.shape else ()
+            positions = [{c: i for i, c in enumerate(merged_coords)} for merged_coords in coords]
+            codes = [np.array([pos[c] for c in cube_coords], dtype=np.int64)[code]
+                     for pos, cube_coords, code in zip(positions, cube.coords, codes)]
+            cells = _ravel(codes, merged.shape, len(cube.cells))
+            merged._insert(cells)
+            at = np.searchsorted(merged.cells, cells)
+            merged.count[at] += cube.count
+            merged.n[at] += cube.n
+            merged.total[at] += cube.total
+            merged.total_sq[at] += cube.total_sq
+            merged.minimum[at] = np.minimum(merged.minimum[at], cube.minimum)
+            merged.maximum[at] = np.maximum(merged.maximum[at], cube.maximum)
+            merged.hist[at] += cube.hist
+        return merged
+
+
+    def update(self, results):
+        """
+        A cube with more simulation summaries added, binned as this cube.
+        """
+        edges = dict(zip(self.measures, self.edges))
+        return self.merge(SummaryCube.from_results(results, self.dims, self.measures, edges=edges))
+
+
+    def _select(self, by=(), **filters):
+        """
+        The aggregates of the cells matching `filters`, summed over the
+        parameters not in `by`, and the coordinates along `by`.
+
+        Parameters
+        ----------
+        `by`: list
+            The parameters kept as axes, in order.
+        `filters`: dict
+            `{parameter: value or list of values}`.
+        """
+        for name in list(by) + list(filters):
+            if name not in self.dims:
+                raise ValueError(f"Unknown parameter '{name}', must be one of {self.dims}.")
+        codes = np.unravel_index(self.cells, self.shape) if self.shape else ()
+        coords = [list(c) for c in self.coords]
+        # The index of each coordinate among those kept by the filters
+        positions = [np.arange(len(c)) for c in coords]
+        is_selected = np.ones(len(self.cells), dtype=bool)
+        for name, value in filters.items():
+            d = self.dims.index(name)
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            is_kept = np.array([c in {_coord(v) for v in values} for c in coords[d]], dtype=bool)
+            is_selected &= is_kept[codes[d]]
+            positions[d] = np.cumsum(is_kept) - 1
+            coords[d] = [c for c, k in zip(coords[d], is_kept) if k]
+
+        # Sum the selected cells into groups by the kept parameters, in the order of `by`
+        kept = [self.dims.index(name) for name in by]
+        shape = tuple(len(coords[d]) for d in kept)
+        size = int(np.prod(shape))
+        if size > max_groups:
+            raise ValueError(f"Grouping by {list(by)} makes {size} groups, more than {max_groups}; "
+                             "group by fewer parameters, or filter them.")
+        groups = _ravel([positions[d][codes[d][is_selected]] for d in kept], shape, int(is_selected.sum()))
+        reduced = {}
+        for k, a in self.arrays.items():
+            if k == "cells":
+                continue
+            a = a[is_selected]
+            if k == "minimum":
+                r = np.full((size,) + a.shape[1:], np.inf)
+                np.minimum.at(r, groups, a)
+            elif k == "maximum":
+                r = np.full((size,) + a.shape[1:], -np.inf)
+                np.maximum.at(r, groups, a)
+            else:
+                r = np.zeros((size,) + a.shape[1:], dtype=a.dtype)
+                np.add.at(r, groups, a)
+            reduced[k] = r.reshape(shape + a.shape[1:])
+        return reduced, [coords[d] for d in kept]
+
+
+    def _quantile(self, hist, n, minimum, maximum, edges, q):
+        """
+        Quantile `q` of each cell, interpolated within the histogram bin holding it,
+        or the integer of the bin for a measure binned by integers.
+        """
+        num_bins = len(edges) - 1
+        is_integer = np.allclose(np.diff(edges), 1) and edges[0] % 1 == 0.5
+        hist = hist[..., :num_bins]
+        cum = np.cumsum(hist, axis=-1)
+        target = q * n
+        b = np.minimum((cum < target[..., None]).sum(axis=-1), num_bins - 1)
+        below = np.where(b > 0, np.take_along_axis(cum, np.maximum(b - 1, 0)[..., None], -1)[..., 0], 0)
+        in_bin = np.take_along_axis(hist, b[..., None], -1)[..., 0]
+        frac = np.where(in_bin > 0, (target - below) / np.maximum(in_bin, 1), 0.5)
+        if is_integer:
+            value = edges[b] + 0.5
+        else:
+            value = edges[b] + frac * (edges[b + 1] - edges[b])
+        value = np.clip(value, minimum, maximum)
+        return np.where(n > 0, value, np.nan)
+
+
+    def query(self, by=(), measures=None, stats=("count", "mean", "p50"), **filters):
+        """
+        Statistics of the measures over the simulations matching `filters`,
+        grouped by the parameters in `by`, marginalised over the others.
+        e.g., `query(by=["network_topology"], stats=["mean", "p90"], financed=True)`
+
+        Parameters
+        ----------
+        `by`: list
+            The parameters to group by, none for a single row.
+        `measures`: list, optional
+            The measures, by default all.
+        `stats`: list
+            Statistics of `stat_names`, and quantiles `p<percent>`, e.g., `p50`, `p99.9`.
+        `filters`: dict
+            `{parameter: value or list of values}`.
+
+        Returns
+        -------
+            pd.DataFrame: `sims`, and `<measure>_<stat>` of each measure, one row
+            per combination of `by` with simulations.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        measures = self.measures if measures is None else measures
+        for stat in stats:
+            if stat not in stat_names and not stat.startswith("p"):
+                raise ValueError(f"Unknown statistic '{stat}', must be one of {stat_names} or `p<percent>`.")
+        reduced, coords = self._select(by, **filters)
+
+        index = pd.MultiIndex.from_product(coords, names=by) if by else pd.RangeIndex(1)
+        columns = {"sims": reduced["count"].reshape(-1)}
+        for measure in measures:
+            i = self.measures.index(measure)
+            n = reduced["n"][..., i]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = reduced["total"][..., i] / n
+                var = np.maximum(reduced["total_sq"][..., i] / n - mean ** 2, 0)
+            for stat in stats:
+                if stat == "count":
+                    value = n
+                elif stat == "mean":
+                    value = mean
+                elif stat == "std":
+                    value = np.sqrt(var)
+                elif stat == "min":
+                    value = np.where(n > 0, reduced["minimum"][..., i], np.nan)
+                elif stat == "max":
+                    value = np.where(n > 0, reduced["maximum"][..., i], np.nan)
+                else:
+                    value = self._quantile(reduced["hist"][..., i, :], n, reduced["minimum"][..., i],
+                                           reduced["maximum"][..., i], self.edges[i],
+                                           float(stat[1:]) / 100)
+                columns[f"{measure}_{stat}"] = np.asarray(value).reshape(-1)
+        table = pd.DataFrame(columns, index=index)
+        return table[table["sims"] > 0]
+
+
+    def histogram(self, measure, by=(), **filters):
+        """
+        The histogram of a measure over the simulations matching `filters`,
+        e.g., of survival times, for plotting without the results table.
+
+        Returns
+        -------
+            tuple: The bin edges, and the counts per bin, as a pd.DataFrame
+            with one row per combination of `by`, or a np.ndarray without `by`.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        i = self.measures.index(measure)
+        reduced, coords = self._select(by, **filters)
+        edges = self.edges[i]
+        counts = reduced["hist"][..., i, :len(edges) - 1]
+        if not by:
+            return edges, counts
+        index = pd.MultiIndex.from_product(coords, names=by)
+        return edges, pd.DataFrame(counts.reshape(-1, len(edges) - 1), index=index)
+
+
+    def save(self, path=cube_file):
+        """
+        Save the cube as a compressed `.npz` file.
+        """
+        meta = {"dims": self.dims, "coords": self.coords, "measures": self.measures,
+                "edges": [e.tolist() for e in self.edges]}
+        np.savez_compressed(path, meta=np.array(json.dumps(meta)), **self.arrays)
+
+
+def load_cube(path=cube_file):
+    """
+    Load a cube saved by `SummaryCube.save`.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data["meta"]))
+        arrays = {k: data[k] for k in data.files if k != "meta"}
+    return SummaryCube(meta["dims"], meta["coords"], meta["measures"], meta["edges"], arrays)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the summary cube of completed sweeps.")
+    parser.add_argument("command", choices=["build", "query"],
+                        help="`build` the cube from the results, adding to an existing cube "
+                             "with `--update`; or `query` it.")
+    parser.add_argument("filters", nargs="*",
+                        help="Query filters as `name=value`, e.g., `network_topology=diamond financed=True`.")
+    parser.add_argument("--cube", default=cube_file, help="The cube file.")
+    parser.add_argument("--results", default=results_file, help="The results table or catalogue to build from.")
+    parser.add_argument("--bins", default=64, type=int, help="Histogram bins per measure.")
+    parser.add_argument("--update", action="store_true", help="Add the results to the existing cube.")
+    parser.add_argument("--by", nargs="*", default=[], help="Parameters to group by.")
+    parser.add_argument("--measures", nargs="*", default=None)
+    parser.add_argument("--stats", nargs="*", default=["count", "mean", "p50"])
+    args = parser.parse_args()
+
+    if args.command == "build":
+        results = load_results(args.results)
+        if args.update:
+            cube = load_cube(args.cube).update(results)
+        else:
+            cube = SummaryCube.from_results(results, bins=args.bins)
+        cube.save(args.cube)
+        print(f"Cube of {cube.num_sims} simulations over {len(cube.dims)} parameters "
+              f"and {len(cube.measures)} measures saved to {args.cube}.")
+    else:
+        filters = dict(f.split("=", 1) for f in args.filters)
+        filters = {name: yaml.safe_load(value) for name, value in filters.items()}
+        cube = load_cube(args.cube)
+        t = time.perf_counter()
+        table = cube.query(args.by, args.measures, args.stats, **filters)
+        elapsed = time.perf_counter() - t
+        print(table.to_string())
+        print(f"Answered in {elapsed * 1000:.1f} ms.")
@@ -0,0 +1,338 @@
+"""
+Surrogate models (emulators) of the simulation, trained on the summaries of
+completed sweeps, to screen the continuous parameter space before simulating it.
+Needs the optional `scikit-learn` package.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+"""
+
+# %%
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from output import results_file
+from utils import make_seed_sequence, seed_to_str
+
+# Continuous inputs of the emulator, and which of them are integers
+default_features = ["bank_annual_rate", "invoice_annual_rate", "invoice_term", "window_size", "operation_fee"]
+integer_features = ["invoice_term", "window_size", "loan_repayment_time"]
+
+# Inputs that apply only to some runs, and the column and value of those runs;
+# other runs hold placeholders, e.g., rates of 0 when unfinanced, which are not inputs
+conditional_features = {
+    "bank_annual_rate": ("financed", True),
+    "invoice_annual_rate": ("financed", True),
+    "invoice_term": ("financed", True),
+    "loan_repayment_time": ("financed", True),
+    "window_size": ("paradigm", "proactive"),
+}
+
+# Outputs of the emulator, any summary column or failure share `failed_share_<power>`
+default_targets = ["survived", "t_end", "num_failed"]
+
+# Targets censored in some runs, and the column flagging those runs: a run that
+# survived stops at `t_max` or at steady state, so its `t_end` only bounds its
+# time to disconnection from below. Such targets are fitted on the other runs only.
+censored_targets = {"t_end": "survived"}
+
+
+def _import_sklearn():
+    try:
+        import sklearn
+    except ImportError:
+        raise ImportError("The emulator requires `scikit-learn`, install it first.")
+    return sklearn
+
+
+def load_results(source=results_file, **filters):
+    """
+    Load the summaries of simulations from the results table (`.csv`)
+    or the catalogue (`.db`), with the failure shares by power. Inputs in
+    `conditional_features` are NaN in the runs they do not apply to.
+
+    Parameters
+    ----------
+    `source`: str
+        The results table or catalogue file.
+    `filters`: dict
+        Equality filters on the columns, e.g., `network_topology="diamond", financed=True`.
+    """
+    if source.endswith(".db"):
+        from catalogue import Catalogue
+        with Catalogue(source) as catalogue:
+            found = catalogue.find()
+        results = pd.DataFrame([json.loads(s) for s in found["summary"]])
+    else:
+        results = pd.read_csv(source)
+
+    for name, value in filters.items():
+        results = results[results[name] == value]
+
+    for feature, (name, value) in conditional_features.items():
+        if feature in results and name in results:
+            results[feature] = results[feature].where(results[name] == value)
+
+    # Share of failures borne by each power, zero if no failure
+    for col in [c for c in results.columns if c.startswith("failed_power_")]:
+        share = results[col] / results["num_failed"].where(results["num_failed"] > 0)
+        results["failed_share_" + col[len("failed_power_"):]] = share.fillna(0)
+    return results.reset_index(drop=True)
+
+
+def sim_id_numbers(sim_ids):
+    """
+    The leading integer of each `sim_id`, e.g., 12 of `12`, of the replica
+    `12_0_1` of successive halving, or of the Sobol run `12_sa_<key>_A`,
+    NaN for ids without one.
+    """
+    return pd.to_numeric(pd.Series(sim_ids, dtype=str).str.extract(r"^(\d+)", expand=False))
+
+
+def next_sim_id(source=results_file):
+    """
+    The first `sim_id` after all those in the results table or catalogue,
+    from which new simulations are numbered without overwriting the output
+    files or reusing the seeds of those already run.
+    """
+    if not os.path.exists(source):
+        return 1
+    results = load_results(source)
+    if "sim_id" not in results:
+        return 1
+    numbers = sim_id_numbers(results["sim_id"]).dropna()
+    return int(numbers.max()) + 1 if len(numbers) else 1
+
+
+def applicable_features(results, features=default_features):
+    """
+    The `features` that apply to every one of the runs, see `conditional_features`.
+    """
+    applicable = []
+    for feature in features:
+        name, value = conditional_features.get(feature, (None, None))
+        if name is None or name not in results or (results[name] == value).all():
+            applicable.append(feature)
+    return applicable
+
+
+class Emulator(object):
+    """
+    Emulator of summary outputs from continuous inputs. Simulations at the
+    same inputs (e.g., different seeds) are kept as replicates, so that the
+    model learns the noise of the simulation as well as its trend.
+    A target in `censored_targets` is fitted on the runs in which it is observed,
+    e.g., `t_end` is the time to disconnection of the runs that do not survive,
+    while `survived` gives the share of runs that do.
+
+    Parameters
+    ----------
+    `features`: list, optional
+        The input columns, by default those of `default_features` that apply to
+        all the runs it is trained on, e.g., no rates unless they are all financed.
+    `targets`: list
+        The output columns, e.g., `survived`, `t_end`, `num_failed`, `failed_share_1`.
+    `model`: str
+        `gp` for a Gaussian process, whose uncertainty is its predictive standard
+        deviation, for up to a few thousand simulations; or `gbr` for gradient 
+        boosting, which scales to larger sweeps, whose uncertainty is estimated
+        from the 10% and 90% quantile regressors.
+    `model_params`: dict
+        Parameters passed to the scikit-learn regressor.
+    """
+
+    models = ("gp", "gbr")
+
+    def __init__(self, features=None, targets=default_targets, model="gp", **model_params):
+        if model not in self.models:
+            raise ValueError(f"Unrecognised model '{model}', must be one of {self.models}.")
+        _import_sklearn()
+        self.requested_features = None if features is None else list(features)
+        self.features = self.requested_features
+        self.targets = list(targets)
+        self.model = model
+        self.model_params = model_params
+        self.regressors = {}
+
+
+    def _make_regressor(self, quantile=None):
+        from sklearn.pipeline import make_pipeline
+        from sklearn.preprocessing import StandardScaler
+        if self.model == "gp":
+            from sklearn.gaussian_process import GaussianProcessRegressor
+            from sklearn.gaussian_process.kernels import ConstantKernel, Matern, WhiteKernel
+            kernel = (ConstantKernel() * Matern(length_scale=np.ones(len(self.features)), nu=2.5)
+                      + WhiteKernel())
+            params = {"kernel": kernel, "normalize_y": True, "n_restarts_optimizer": 2,
+                      "random_state": 0, **self.model_params}
+            regressor = GaussianProcessRegressor(**params)
+        else:
+            from sklearn.ensemble import GradientBoostingRegressor
+            params = {"n_estimators": 200, "max_depth": 3, "random_state": 0, **self.model_params}
+            if quantile is not None:
+                params.update(loss="quantile", alpha=quantile)
+            regressor = GradientBoostingRegressor(**params)
+        return make_pipeline(StandardScaler(), regressor)
+
+
+    def fit(self, results):
+        """
+        Train the emulator on simulation summaries, see `load_results`.
+        Inputs that do not apply to all of them are refused, as their
+        placeholders are not values, e.g., rates in unfinanced runs;
+        filter the runs to those they apply to, e.g., `financed=True`.
+        """
+        if self.requested_features is None:
+            self.features = applicable_features(results)
+            if not self.features:
+                raise ValueError("None of the default features applies to all the simulations.")
+        else:
+            self.features = self.requested_features
+            inapplicable = [f for f in self.features if f not in applicable_features(results, [f])]
+            if inapplicable:
+                conditions = ", ".join("`{}` (if `{}={}`)".format(f, *conditional_features[f])
+                                       for f in inapplicable)
+                raise ValueError(f"Features apply only to some of the simulations: {conditions}; "
+                                 "filter the simulations, or leave the features out.")
+        flags = [censored_targets[t] for t in self.targets if t in censored_targets]
+        results = results.dropna(subset=self.features + self.targets + flags)
+        if len(results) < 2:
+            raise ValueError("At least two simulations are needed to train the emulator.")
+        X = results[self.features].to_numpy(dtype=float)
+        self.bounds = pd.DataFrame({"low": X.min(axis=0), "high": X.max(axis=0)}, index=self.features)
+        self.target_std = pd.Series(1.0, index=self.targets)
+        for target in self.targets:
+            observed = results
+            if target in censored_targets:
+                observed = results[~results[censored_targets[target]].astype(bool)]
+                if len(observed) < 2:
+                    raise ValueError(f"At least two simulations in which `{target}` is not censored "
+                                     "are needed to train the emulator.")
+            X = observed[self.features].to_numpy(dtype=float)
+            y = observed[target].to_numpy(dtype=float)
+            if y.std() > 0:
+                self.target_std[target] = y.std()
+            if self.model == "gp":
+                self.regressors[target] = [self._make_regressor().fit(X, y)]
+            else:
+                self.regressors[target] = [self._make_regressor(q).fit(X, y) for q in (None, 0.1, 0.9)]
+        return self
+
+
+    def predict(self, configs):
+        """
+        Predict the targets at the given inputs.
+
+        Parameters
+        ----------
+        `configs`: pd.DataFrame
+            The inputs, one row per config, with the `features` columns.
+
+        Returns
+        -------
+            pd.DataFrame: `<target>_mean` and `<target>_std` of each target, one row per config;
+            for a target in `censored_targets`, as in the runs in which it is observed.
+        """
+        if not self.regressors:
+            raise RuntimeError("The emulator is not trained, call `fit` first.")
+        X = configs[self.features].to_numpy(dtype=float)
+        predicted = {}
+        for target, regressors in self.regressors.items():
+            if self.model == "gp":
+                mean, std = regressors[0].predict(X, return_std=True)
+            else:
+                mean = regressors[0].predict(X)
+                low, high = regressors[1].predict(X), regressors[2].predict(X)
+                # 10% to 90% of a normal distribution spans 2.563 standard deviations
+                std = np.abs(high - low) / 2.563
+            predicted[f"{target}_mean"] = mean
+            predicted[f"{target}_std"] = std
+        return pd.DataFrame(predicted, index=configs.index)
+
+
+    def suggest(self, num_configs=10, bounds=None, num_candidates=2000, seed=None):
+        """
+        Suggest the configs to simulate next, where the emulator is least
+        certain, i.e., the largest standard deviation summed over the targets,
+        each relative to its spread in the training data.
+
+        Parameters
+        ----------
+        `num_configs`: int
+            The number of configs to suggest.
+        `bounds`: dict, optional
+            `{feature: (low, high)}`, by default the range of the training data.
+        `num_candidates`: int
+            The number of random candidate configs to choose from.
+        `seed`: int, optional
+            The seed of the candidates.
+
+        Returns
+        -------
+            pd.DataFrame: The suggested configs with their predictions, the least certain first.
+        """
+        bounds = {**{f: tuple(self.bounds.loc[f]) for f in self.features}, **(bounds or {})}
+        rng = np.random.default_rng(seed)
+        candidates = pd.DataFrame({
+            f: rng.uniform(low, high, num_candidates) for f, (low, high) in bounds.items()
+            if f in self.features})
+        for f in self.features:
+            if f in integer_features:
+                candidates[f] = candidates[f].round().astype(int)
+        candidates = candidates.drop_duplicates().reset_index(drop=True)
+
+        predicted = self.predict(candidates)
+        uncertainty = sum(predicted[f"{t}_std"] / self.target_std[t] for t in self.targets)
+        suggested = pd.concat([candidates, predicted], axis=1).assign(uncertainty=uncertainty)
+        return suggested.nlargest(num_configs, "uncertainty").reset_index(drop=True)
+
+
+def to_sim_configs(suggested, base_config, first_sim_id):
+    """
+    Turn suggested inputs into simulation configs, as run by `grid_search.execute`.
+
+    Parameters
+    ----------
+    `suggested`: pd.DataFrame
+        The suggested inputs, see `Emulator.suggest`.
+    `base_config`: dict
+        A config enumerated by `grid_search.iter_sim_configs`, for the other inputs.
+    `first_sim_id`: int
+        The `sim_id` of the first config, after those already run, e.g., `next_sim_id()`.
+        The seed of each config is spawned by its `sim_id`, as in the grid.
+    """
+    sim_configs = []
+    for i, row in enumerate(suggested.to_dict("records")):
+        config = dict(base_config)
+        for f in suggested.columns:
+            if f in base_config:
+                config[f] = int(row[f]) if f in integer_features else float(row[f])
+        config["sim_id"] = first_sim_id + i
+        if base_config.get("seed") is not None:
+            seed_seq = make_seed_sequence(base_config["seed"])
+            config["seed"] = seed_to_str(np.random.SeedSequence(seed_seq.entropy,
+                                                                spawn_key=(config["sim_id"],)))
+        sim_configs.append(config)
+    return sim_configs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train an emulator and suggest configs to simulate next.")
+    parser.add_argument("--results", default=results_file, help="The results table or catalogue.")
+    parser.add_argument("--model", default="gp", choices=Emulator.models)
+    parser.add_argument("--targets", nargs="+", default=default_targets)
+    parser.add_argument("--suggest", default=10, type=int, help="The number of configs to suggest.")
+    parser.add_argument("filters", nargs="*",
+                        help="Filters as `name=value`, e.g., `network_topology=diamond financed=True`.")
+    args = parser.parse_args()
+
+    filters = dict(f.split("=", 1) for f in args.filters)
+    filters = {name: yaml.safe_load(value) for name, value in filters.items()}
+    results = load_results(args.results, **filters)
+    emulator = Emulator(targets=args.targets, model=args.model).fit(results)
+    print(f"Trained on {len(results)} simulations.")
+    print(emulator.suggest(args.suggest).to_string())
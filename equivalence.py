@@ -0,0 +1,285 @@
+"""
+Equivalence harness: check that an alternative simulation engine reproduces
+the trajectories of `SCFSimulation.run`, or report exactly where it deviates.
+It doubles as a regression suite, against golden trajectories stored in `golden/`,
+also of the configs run together as lanes of one engine (see `lanes.py`).
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+An engine is a function `engine(config, network_config)` that runs a config,
+as enumerated by `grid_search.iter_sim_configs`, and returns its trajectory
+as a dataframe with the columns of `output.columns`.
+"""
+
+# %%
+import argparse
+import contextlib
+import importlib
+import io
+import itertools
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from lanes import iter_lane_groups, lane_key, lanes_engine
+from output import columns
+from simulation import ENGINE_VERSION, SCFSimulation
+from utils import load_config_file
+
+# The directory of golden trajectories, and their manifest
+golden_dir = "golden"
+manifest_file = "manifest.json"
+
+# Rows are identified by these columns
+key_columns = ["timestep", "node_idx"]
+
+
+# %% Golden configs
+def golden_configs(t_max=200):
+    """
+    The seeded configs of the suite, spanning both topologies, homogeneous
+    and heterogeneous powers, financed and unfinanced, and reactive and
+    proactive runs; operation fees are high enough for runs with bankruptcies.
+    """
+    configs = []
+    combinations = itertools.product(["lattice", "diamond"], [True, False],
+                                     [True, False], ["reactive", "proactive"])
+    for i, (topology, homogeneous, financed, paradigm) in enumerate(combinations):
+        configs.append({
+            "sim_id": f"golden_{i}",
+            "network_topology": topology,
+            "homogeneous": homogeneous,
+            "t_max": t_max,
+            "financed": financed,
+            "paradigm": paradigm,
+            "operation_fee": [1, 5][i % 2],
+            "loan_repayment_time": 120,
+            "bank_annual_rate": 1.03,
+            "invoice_annual_rate": 1.07,
+            "invoice_term": 60,
+            "window_size": 5,
+            "forecast_method": "MA",
+            "forecast_params": None,
+            "powers": [1, 2, 3],
+            "market_shares": [1, 2, 3],
+            "demand_distribution": "normal",
+            "distribution_params": {"mean": 20, "sigma": 5},
+            "convergence": None,
+            "seed": 1000 + i,
+        })
+    return configs
+
+
+# %% Reference engine
+def reference_engine(config, network_config):
+    """
+    Run a config on `SCFSimulation`, writing nothing into `output_data`.
+    """
+    config = dict(config)
+    sim_id = config.pop("sim_id")
+    topology = config.pop("network_topology")
+    homogeneous = config.pop("homogeneous")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config.update(output_level="full", output_dir=tmp_dir)
+        sim = SCFSimulation(sim_id, topology, homogeneous, network_config, **config)
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim.run()
+    return sim.writer.output
+
+
+def load_engine(spec):
+    """
+    Load an engine from `module:function`.
+    """
+    module, _, function = spec.partition(":")
+    return getattr(importlib.import_module(module), function or "run")
+
+
+# %% Comparison
+def compare(expected, actual, rtol=1e-9, atol=1e-9, tolerances=None):
+    """
+    Compare two trajectories column by column, matching rows by timestep and node.
+
+    Parameters
+    ----------
+    `expected`, `actual`: pd.DataFrame
+        The trajectories of the reference and the candidate.
+    `rtol`, `atol`: float
+        The default relative and absolute tolerances of numeric columns;
+        NaNs are equal to NaNs, and other columns must be equal.
+    `tolerances`: dict, optional
+        `{column: (rtol, atol)}`, overriding the defaults.
+
+    Returns
+    -------
+        dict: Whether the trajectories are equivalent; the first divergence,
+        i.e., the earliest timestep and the lowest node at it with a mismatch
+        or a missing row, with the mismatching columns and their values;
+        the number of mismatching rows; and the max absolute difference per column.
+    """
+    tolerances = tolerances or {}
+    merged = expected.merge(actual, on=key_columns, how="outer",
+                            suffixes=("_expected", "_actual"), indicator=True)
+    merged = merged.sort_values(key_columns, kind="stable").reset_index(drop=True)
+    mismatch = np.array(merged["_merge"] != "both")
+    mismatched_columns = {}
+    max_abs_diff = {}
+    for col in columns:
+        if col in key_columns:
+            continue
+        if f"{col}_expected" not in merged or f"{col}_actual" not in merged:
+            raise ValueError(f"Column '{col}' is missing from a trajectory.")
+        a, b = merged[f"{col}_expected"], merged[f"{col}_actual"]
+        if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b) \
+                and not pd.api.types.is_bool_dtype(a):
+            a, b = a.to_numpy(dtype=float), b.to_numpy(dtype=float)
+            col_rtol, col_atol = tolerances.get(col, (rtol, atol))
+            with np.errstate(invalid="ignore"):
+                is_close = np.isclose(a, b, rtol=col_rtol, atol=col_atol, equal_nan=True)
+                diff = np.abs(a - b)
+            max_abs_diff[col] = float(np.nanmax(diff)) if np.any(~np.isnan(diff)) else 0.0
+        else:
+            is_close = (a == b).to_numpy() | (a.isna() & b.isna()).to_numpy()
+        col_mismatch = ~is_close & (merged["_merge"] == "both").to_numpy()
+        if col_mismatch.any():
+            mismatched_columns[col] = col_mismatch
+        mismatch |= col_mismatch
+
+    report = {
+        "equivalent": not mismatch.any(),
+        "num_rows": (len(expected), len(actual)),
+        "num_mismatched_rows": int(mismatch.sum()),
+        "max_abs_diff": max_abs_diff,
+        "first_divergence": None,
+    }
+    if mismatch.any():
+        i = int(np.flatnonzero(mismatch)[0])
+        row = merged.iloc[i]
+        divergence = {"timestep": int(row["timestep"]), "node_idx": int(row["node_idx"])}
+        if row["_merge"] != "both":
+            divergence["missing_in"] = "actual" if row["_merge"] == "left_only" else "expected"
+        else:
+            divergence["columns"] = {
+                col: (row[f"{col}_expected"], row[f"{col}_actual"])
+                for col, col_mismatch in mismatched_columns.items() if col_mismatch[i]}
+        report["first_divergence"] = divergence
+    return report
+
+
+def format_report(name, report):
+    if report["equivalent"]:
+        return f"{name}: OK ({report['num_rows'][0]} rows)"
+    div = report["first_divergence"]
+    where = f"timestep {div['timestep']}, node {div['node_idx']}"
+    if "missing_in" in div:
+        what = f"row missing in {div['missing_in']}"
+    else:
+        what = ", ".join(f"{col}: expected {e}, got {a}" for col, (e, a) in div["columns"].items())
+    return (f"{name}: DIVERGED at {where}: {what} "
+            f"({report['num_mismatched_rows']} mismatched rows)")
+
+
+# %% Suites
+def compare_engines(candidate, network_config, configs=None, **tolerances):
+    """
+    Run the reference and the candidate engine on the same configs, and compare them.
+
+    Returns
+    -------
+        dict: The comparison report of each config, keyed by `sim_id`.
+    """
+    reports = {}
+    for config in configs or golden_configs():
+        expected = reference_engine(config, network_config)
+        actual = candidate(config, network_config)
+        reports[config["sim_id"]] = compare(expected, actual, **tolerances)
+    return reports
+
+
+def record_golden(network_config, configs=None, directory=golden_dir):
+    """
+    Record the golden trajectories of the reference engine, with a manifest
+    of their configs and the engine version.
+    """
+    configs = configs or golden_configs()
+    os.makedirs(directory, exist_ok=True)
+    for config in configs:
+        trajectory = reference_engine(config, network_config)
+        trajectory.to_csv(os.path.join(directory, f"{config['sim_id']}.csv.gz"), index=False)
+    with open(os.path.join(directory, manifest_file), "w") as file:
+        json.dump({"engine_version": ENGINE_VERSION, "configs": configs}, file, indent=2)
+
+
+def check_golden(engine, network_config, directory=golden_dir, **tolerances):
+    """
+    Run an engine on the configs of the golden trajectories, and compare them.
+
+    Returns
+    -------
+        dict: The comparison report of each config, keyed by `sim_id`.
+    """
+    with open(os.path.join(directory, manifest_file)) as file:
+        manifest = json.load(file)
+    if manifest["engine_version"] != ENGINE_VERSION:
+        print(f"Golden trajectories were recorded by engine {manifest['engine_version']}, "
+              f"the reference engine is {ENGINE_VERSION}.")
+    reports = {}
+    for config in manifest["configs"]:
+        expected = pd.read_csv(os.path.join(directory, f"{config['sim_id']}.csv.gz"))
+        actual = engine(config, network_config)
+        reports[config["sim_id"]] = compare(expected, actual, **tolerances)
+    return reports
+
+
+def check_lanes(network_config, directory=golden_dir, max_lanes=32, **tolerances):
+    """
+    Run the configs of the golden trajectories together, as lanes of one engine
+    (see `lanes.py`), up to `max_lanes` configs on the same network at a time,
+    and compare each lane with its golden trajectory.
+
+    Returns
+    -------
+        dict: The comparison report of each config, keyed by `sim_id`.
+    """
+    with open(os.path.join(directory, manifest_file)) as file:
+        configs = json.load(file)["configs"]
+    configs = sorted(configs, key=lambda config: str(lane_key(config)))
+    reports = {}
+    for group in iter_lane_groups(configs, max_lanes):
+        for config, actual in zip(group, lanes_engine(group, network_config)):
+            expected = pd.read_csv(os.path.join(directory, f"{config['sim_id']}.csv.gz"))
+            reports[config["sim_id"]] = compare(expected, actual, **tolerances)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check engines against the reference engine.")
+    parser.add_argument("command", choices=["check", "compare", "lanes", "record"],
+                        help="`check` an engine against the golden trajectories; "
+                             "`compare` it with the reference engine live; "
+                             "check the golden configs run together as `lanes`; "
+                             "or `record` the golden trajectories.")
+    parser.add_argument("--engine", default="equivalence:reference_engine",
+                        help="The candidate engine, as `module:function`.")
+    parser.add_argument("--rtol", default=1e-9, type=float)
+    parser.add_argument("--atol", default=1e-9, type=float)
+    args = parser.parse_args()
+
+    network_config = load_config_file("configs/network_config.yaml")
+    if args.command == "record":
+        record_golden(network_config)
+        print(f"Golden trajectories recorded in {golden_dir}/.")
+    else:
+        if args.command == "lanes":
+            reports = check_lanes(network_config, rtol=args.rtol, atol=args.atol)
+        elif args.command == "check":
+            reports = check_golden(load_engine(args.engine), network_config, rtol=args.rtol, atol=args.atol)
+        else:
+            reports = compare_engines(load_engine(args.engine), network_config, rtol=args.rtol, atol=args.atol)
+        for name, report in reports.items():
+            print(format_report(name, report))
+        if not all(report["equivalent"] for report in reports.values()):
+            raise SystemExit(1)
@@ -0,0 +1,115 @@
+"""
+Financing threshold forecasters for the `proactive` paradigm.
+Each forecaster keeps rolling state for all nodes at once as arrays,
+updated in O(1) per node per timestep regardless of the window size.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+"""
+
+import numpy as np
+
+
+class MovingAverage(object):
+    """
+    Moving average of the past `window_size` values, using a running sum over
+    a ring buffer. Timesteps before the window fills count as zero.
+    """
+
+    def __init__(self, num_nodes, window_size):
+        self.window_size = int(window_size)
+        self.values = np.zeros((self.window_size, num_nodes))
+        self.total = np.zeros(num_nodes)
+        self.num_updates = 0
+
+
+    def update(self, values):
+        slot = self.num_updates % self.window_size
+        self.total += values - self.values[slot]
+        self.values[slot] = values
+        self.num_updates += 1
+
+
+    def forecast(self):
+        return self.total / self.window_size
+
+
+class EWMA(object):
+    """
+    Exponentially weighted moving average, initialised with the first value.
+    `alpha` defaults to 2 / (window_size + 1), i.e., the span of `window_size`.
+    """
+
+    def __init__(self, num_nodes, window_size, alpha=None):
+        self.alpha = 2 / (window_size + 1) if alpha is None else alpha
+        self.level = np.zeros(num_nodes)
+        self.num_updates = 0
+
+
+    def update(self, values):
+        if self.num_updates == 0:
+            self.level[:] = values
+        else:
+            self.level += self.alpha * (values - self.level)
+        self.num_updates += 1
+
+
+    def forecast(self):
+        return self.level.copy()
+
+
+class HoltLinear(object):
+    """
+    Holt's linear trend method, i.e., double exponential smoothing.
+    The level is initialised with the first value and the trend with zero.
+    `alpha` defaults to 2 / (window_size + 1).
+    """
+
+    def __init__(self, num_nodes, window_size, alpha=None, beta=0.1):
+        self.alpha = 2 / (window_size + 1) if alpha is None else alpha
+        self.beta = beta
+        self.level = np.zeros(num_nodes)
+        self.trend = np.zeros(num_nodes)
+        self.num_updates = 0
+
+
+    def update(self, values):
+        if self.num_updates == 0:
+            self.level[:] = values
+        else:
+            prev_level = self.level.copy()
+            self.level = self.alpha * values + (1 - self.alpha) * (self.level + self.trend)
+            self.trend = self.beta * (self.level - prev_level) + (1 - self.beta) * self.trend
+        self.num_updates += 1
+
+
+    def forecast(self):
+        """
+        One-step-ahead forecast.
+        """
+        return self.level + self.trend
+
+
+forecasters = {
+    "MA": MovingAverage,
+    "EWMA": EWMA,
+    "Holt": HoltLinear,
+}
+
+
+def get_forecaster(method, num_nodes, window_size, **params):
+    """
+    Create a forecaster of financing thresholds for `num_nodes` nodes.
+
+    Parameters
+    ----------
+    `method`: str
+        The name of time series forecasting method: `MA`, `EWMA` or `Holt`.
+    `window_size`: int
+        The window size of the moving average, also the default span of smoothing.
+    `params`: dict
+        Method-specific parameters, e.g., `alpha` and `beta` for smoothing.
+    """
+    if method not in forecasters:
+        raise ValueError(f"Unrecognised forecasting method '{method}', "
+                         f"must be one of {list(forecasters)}.")
+    return forecasters[method](num_nodes, window_size, **params)
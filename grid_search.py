@@ -5,18 +5,27 @@ Email: lx249@cam.ac.uk
 """
 
 # %% 
+import argparse
+import collections
 import itertools 
+import time
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from simulation import SCFSimulation
-from utils import load_config_file
+from lanes import iter_lane_groups, run_lanes_and_summarise
+from memory import memory_methods
+from catalogue import Catalogue, catalogue_file
+from job_queue import JobQueue
+from utils import load_config_file, seed_to_str
 
 
-def simconfig_generator(input_params):
+def _grid_axes(input_params):
     """
-    Enumerate input parameters for grid search.
+    Build the axes of the grid search, in enumeration order.
+    The grid is the Cartesian product of these axes, with the last axis varying fastest.
     """
     # Part one - basics
-    t_max                    = input_params["t_max"]
     lst_topology             = input_params["network_topology"]
     lst_homogeneous          = input_params["homogeneous"]
     lst_operation_fee        = input_params["operation_fee"]
@@ -28,33 +37,19 @@ def simconfig_generator(input_params):
     lst_demand_sigma         = input_params["distribution_params"][demand_distribution]["sigma"]
 
     # Part three - company power and marker shares
-    powers                   = input_params["powers"]
     lst_small_market_shares  = [ 1 ]
     lst_medium_market_shares = input_params["market_shares"]["medium"]
     lst_large_market_shares  = input_params["market_shares"]["large"]
     
     # Part four - financing 
-    lst_financed             = input_params["financed"]
     lst_loan_repayment_time  = input_params["loan_repayment_time"]
     lst_bank_annual_rate     = input_params["bank_annual_rate"]
     lst_invoice_annual_rate  = input_params["invoice_annual_rate"]
     lst_invoice_term         = input_params["invoice_term"]
 
     # Part five - financing threshold
-    lst_paradigm             = input_params["paradigm"]
     lst_ma_window_size       = input_params["moving_average"]["window_size"]
 
-    # Input parameter enumeration
-    basics = itertools.product(
-        lst_topology, 
-        lst_homogeneous, 
-        lst_operation_fee)
-
-    demand_generation = itertools.product( 
-        lst_demand_distribution, 
-        lst_demand_mean, 
-        lst_demand_sigma)
-    
     all_market_share_combs = itertools.product(
         lst_small_market_shares,
         lst_medium_market_shares,
@@ -77,40 +72,137 @@ def simconfig_generator(input_params):
     financing_threshold = [("reactive", 1)]  # 1 as a placeholder
     for ws in lst_ma_window_size:
         financing_threshold.append(("proactive", ws))
-    
-    sim_configs = []
-    sim_id = 0
-    for v1, v2, v3, v4, v5 in itertools.product(
-        basics,
-        demand_generation,
+
+    return [
+        lst_topology, 
+        lst_homogeneous, 
+        lst_operation_fee,
+        lst_demand_distribution, 
+        lst_demand_mean, 
+        lst_demand_sigma,
         market_shares,
-        tuple(financing),
-        tuple(financing_threshold)
-    ): 
-        sim_id += 1
-        sim_config = {}
-        sim_config["sim_id"] = sim_id
-        sim_config["t_max"] = t_max
-        sim_config["network_topology"] = v1[0]
-        sim_config["homogeneous"] = v1[1]
-        sim_config["operation_fee"] = v1[2]
-
-        sim_config["demand_distribution"] = v2[0]
-        sim_config["distribution_params"] = {"mean": v2[1], "sigma": v2[2]}
-
-        sim_config["financed"] = v4[0]
-        sim_config["loan_repayment_time"] = v4[1]
-        sim_config["bank_annual_rate"] = v4[2]
-        sim_config["invoice_annual_rate"] = v4[3]
-        sim_config["invoice_term"] = v4[4]
-        sim_config["paradigm"] = v5[0]
-        sim_config["window_size"] = v5[1]
-        sim_config["powers"] = powers
-        sim_config["market_shares"] = v3
-
-        sim_configs.append(sim_config)
-    
-    return sim_configs
+        financing,
+        financing_threshold
+    ]
+
+
+def count_sim_configs(input_params):
+    """
+    Count the number of configs in the grid search without enumerating them.
+    """
+    return int(np.prod([len(axis) for axis in _grid_axes(input_params)], dtype=object))
+
+
+# Input parameters that are not swept, shared by all configs in the grid
+fixed_params = ["t_max", "powers", "convergence", "regional_financing", "order_book",
+                "output_level", "output_every", "output_format", "output_background",
+                "memory_profile", "seed"]
+
+
+def _fixed_values(input_params):
+    """
+    The values of the input parameters that are not swept.
+    """
+    fixed = {key: input_params.get(key) for key in fixed_params}
+    fixed["forecast_method"] = input_params["moving_average"].get("forecast_method", "MA")
+    fixed["forecast_params"] = input_params["moving_average"].get("forecast_params")
+    return fixed
+
+
+def _build_sim_config(sim_id, fixed, values):
+    (topology, homogeneous, operation_fee, 
+     distribution, mean, sigma, 
+     market_shares, financing, financing_threshold) = values
+
+    sim_config = {}
+    sim_config["sim_id"] = sim_id
+    sim_config["t_max"] = fixed["t_max"]
+    sim_config["network_topology"] = topology
+    sim_config["homogeneous"] = homogeneous
+    sim_config["operation_fee"] = operation_fee
+
+    sim_config["demand_distribution"] = distribution
+    sim_config["distribution_params"] = {"mean": mean, "sigma": sigma}
+
+    sim_config["financed"] = financing[0]
+    sim_config["loan_repayment_time"] = financing[1]
+    sim_config["bank_annual_rate"] = financing[2]
+    sim_config["invoice_annual_rate"] = financing[3]
+    sim_config["invoice_term"] = financing[4]
+    sim_config["paradigm"] = financing_threshold[0]
+    sim_config["window_size"] = financing_threshold[1]
+    sim_config["powers"] = fixed["powers"]
+    sim_config["market_shares"] = market_shares
+    sim_config["convergence"] = fixed["convergence"]
+    sim_config["regional_financing"] = fixed["regional_financing"]
+    sim_config["order_book"] = fixed["order_book"]
+    sim_config["output_level"] = fixed["output_level"]
+    sim_config["output_every"] = fixed["output_every"]
+    sim_config["output_format"] = fixed["output_format"]
+    sim_config["output_background"] = fixed["output_background"]
+    sim_config["memory_profile"] = fixed["memory_profile"]
+    # The seed of each simulation is spawned from the grid seed by its `sim_id`, 
+    # so it does not depend on sharding, queueing or the number of workers.
+    sim_config["seed"] = None
+    if fixed["seed"] is not None:
+        sim_config["seed"] = seed_to_str(np.random.SeedSequence(fixed["seed"], spawn_key=(sim_id,)))
+    sim_config["forecast_method"] = fixed["forecast_method"]
+    sim_config["forecast_params"] = fixed["forecast_params"]
+    return sim_config
+
+
+def iter_sim_configs(input_params, shard=(0, 1)):
+    """
+    Lazily enumerate input parameters for grid search.
+
+    Each config is decoded directly from its position in the grid, so `sim_id`
+    (the 1-based position) is stable regardless of sharding, and a shard 
+    never materialises the configs of other shards.
+
+    Parameters
+    ----------
+    `input_params`: dict
+        The grid search inputs, e.g., loaded from `grid_search_inputs.yaml`.
+    `shard`: tuple
+        `(i, N)`, yield only the `i`-th of `N` disjoint slices of the grid, 
+        i.e., the configs whose `sim_id - 1` is congruent to `i` modulo `N`.
+    """
+    shard_idx, num_shards = shard
+    if not 0 <= shard_idx < num_shards:
+        raise ValueError(f"Shard index must be in [0, {num_shards}), got {shard_idx}.")
+
+    fixed = _fixed_values(input_params)
+    axes = _grid_axes(input_params)
+    total = int(np.prod([len(axis) for axis in axes], dtype=object))
+
+    for pos in range(shard_idx, total, num_shards):
+        # Decode the position as a mixed-radix number, last axis fastest
+        values = []
+        rest = pos
+        for axis in reversed(axes):
+            rest, i = divmod(rest, len(axis))
+            values.append(axis[i])
+        yield _build_sim_config(pos + 1, fixed, values[::-1])
+
+
+def simconfig_generator(input_params):
+    """
+    Enumerate input parameters for grid search.
+    """
+    return list(iter_sim_configs(input_params))
+
+
+def parse_shard(shard):
+    """
+    Parse a shard specifier `i/N` into the tuple `(i, N)`.
+    """
+    try:
+        shard_idx, num_shards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must be in the form `i/N`, got '{shard}'.")
+    if not 0 <= shard_idx < num_shards:
+        raise ValueError(f"Shard index must be in [0, {num_shards}), got {shard_idx}.")
+    return shard_idx, num_shards
 
 
 def single_run_params(sim_config):
@@ -131,6 +223,17 @@ def single_run_params(sim_config):
     window_size         = sim_config["moving_average"]["window_size"]
     powers              = sim_config["powers"]
     market_shares       = sim_config["market_shares"]
+    convergence         = sim_config.get("convergence")
+    regional_financing  = sim_config.get("regional_financing")
+    order_book          = sim_config.get("order_book")
+    seed                = sim_config.get("seed")
+    output_level        = sim_config.get("output_level")
+    output_every        = sim_config.get("output_every")
+    output_format       = sim_config.get("output_format")
+    output_background   = sim_config.get("output_background")
+    memory_profile      = sim_config.get("memory_profile")
+    forecast_method     = sim_config["moving_average"].get("forecast_method", "MA")
+    forecast_params     = sim_config["moving_average"].get("forecast_params")
 
     # Demand generator by normal distribution
     demand_distribution = sim_config["demand_distribution"]
@@ -146,10 +249,21 @@ def single_run_params(sim_config):
         "invoice_annual_rate": invoice_annual_rate,
         "invoice_term": invoice_term,
         "window_size": window_size,
+        "forecast_method": forecast_method,
+        "forecast_params": forecast_params,
         "powers": powers,
         "market_shares": market_shares,
         "demand_distribution": demand_distribution,
-        "distribution_params": distribution_params
+        "distribution_params": distribution_params,
+        "convergence": convergence,
+        "regional_financing": regional_financing,
+        "order_book": order_book,
+        "output_level": output_level,
+        "output_every": output_every,
+        "output_format": output_format,
+        "output_background": output_background,
+        "memory_profile": memory_profile,
+        "seed": seed
     }
     return sim_id, topology, homogeneous, params
 
@@ -161,35 +275,14 @@ def grid_search_params(config_file):
     """
     
 
-# Network configuraitons
-network_config = load_config_file("configs/network_config.yaml")
-
-# # Single run
-# sim_config = load_config_file("configs/simulation_config.yaml")
-# (sim_id, topology, homogeneous, input_params) = single_run_params(sim_config)
-
-# # New a simulation instance
-# sim = SCFSimulation(sim_id=0,
-#                     topology,
-#                     homogeneous,
-#                     network_config,
-#                     **input_params)
-# # Run the simulation
-# sim.run()
-
-
-# Grid search
-input_params = load_config_file("configs/grid_search_inputs.yaml")
-sim_configs = simconfig_generator(input_params)
-
-for config in sim_configs:
-    sim_id = config["sim_id"]
-    topology = config["network_topology"]
-    homogeneous = config["homogeneous"]
-
-    config.pop("sim_id")
-    config.pop("network_topology")
-    config.pop("homogeneous")
+def run_sim_config(config, network_config):
+    """
+    Run a single simulation given a config enumerated by `iter_sim_configs`.
+    """
+    config = dict(config)
+    sim_id = config.pop("sim_id")
+    topology = config.pop("network_topology")
+    homogeneous = config.pop("homogeneous")
 
     # Run simulation
     sim = SCFSimulation(sim_id,
@@ -199,5 +292,193 @@ for config in sim_configs:
                         **config)
     # Run the simulation
     sim.run()
+    return sim
+
+
+def run_and_summarise(config, network_config):
+    """
+    Run a single simulation and return what is recorded of it, 
+    i.e., `(config, summary, runtime, output_path, seed)`; it can be sent 
+    back from a worker process, unlike the simulation itself.
+    """
+    start = time.perf_counter()
+    sim = run_sim_config(config, network_config)
+    runtime = time.perf_counter() - start
+    return config, sim.summary(), runtime, sim.writer.written_file, sim.seed
+
+
+def _iter_results(run, tasks, executor=None, max_in_flight=64):
+    """
+    Run tasks in order, yielding their results in order. With a process pool
+    `executor`, at most `max_in_flight` tasks are submitted ahead of the
+    results consumed, so that neither the tasks nor their results are all held at once.
+    """
+    if executor is None:
+        yield from map(run, tasks)
+        return
+    tasks = iter(tasks)
+    in_flight = collections.deque()
+    try:
+        while True:
+            while len(in_flight) < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                in_flight.append(executor.submit(run, task))
+            if not in_flight:
+                break
+            yield in_flight.popleft().result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def execute(sim_configs, network_config, executor=None, catalogue=None, lanes=1,
+            return_summaries=False, max_in_flight=64):
+    """
+    Run simulations, in parallel if given a process pool `executor`, 
+    and record them in the catalogue. Results do not depend on the number 
+    of worker processes, as each simulation draws from its own seeded random streams.
+    With `lanes` > 1, consecutive configs on the same network are run together,
+    up to `lanes` at a time, as lanes of one engine (see `lanes.py`); results
+    do not depend on it either.
+    Configs are read from `sim_configs` as they are run, at most `max_in_flight`
+    simulations (or groups of lanes) ahead, and each result is recorded as it
+    finishes, so that a grid of any size runs in bounded memory.
+
+    Returns
+    -------
+        list: The summaries of the simulations, in the order of `sim_configs`,
+        if `return_summaries`; otherwise the number of simulations run.
+    """
+    if lanes > 1:
+        run = functools.partial(run_lanes_and_summarise, network_config=network_config)
+        results = itertools.chain.from_iterable(
+            _iter_results(run, iter_lane_groups(sim_configs, lanes), executor, max_in_flight))
+    else:
+        run = functools.partial(run_and_summarise, network_config=network_config)
+        results = _iter_results(run, sim_configs, executor, max_in_flight)
+
+    summaries = []
+    num_sims = 0
+    for config, summary, runtime, output_path, seed in results:
+        num_sims += 1
+        if return_summaries:
+            summaries.append(summary)
+        if catalogue is not None:
+            catalogue.record(summary, config, runtime, output_path=output_path, seed=seed)
+    return summaries if return_summaries else num_sims
+
+
+def run_worker(queue, network_config, executor=None, catalogue=None, lanes=1):
+    """
+    Claim and run jobs from the queue until it is empty. While no job is
+    pending but other workers still hold claimed jobs, wait for them: the
+    jobs of a worker that dies are requeued once its lease expires, and
+    then run here, rather than stranded once the last live worker exits.
+
+    Returns
+    -------
+        int: The number of simulations run.
+    """
+    num_sims = 0
+    with queue:
+        while True:
+            job = queue.claim()
+            if job is None:
+                if queue.status()["claimed"] == 0:
+                    break
+                time.sleep(queue.heartbeat_interval)
+                continue
+            num_sims += execute(job.configs, network_config, executor, catalogue, lanes)
+            # Records of a job are durable before the job is marked done
+            if catalogue is not None:
+                catalogue.flush()
+            queue.complete(job)
+    return num_sims
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grid search over simulation inputs.")
+    parser.add_argument("--inputs", default="configs/grid_search_inputs.yaml",
+                        help="Grid search inputs file.")
+    parser.add_argument("--shard", default="0/1", type=parse_shard,
+                        help="Run only the i-th of N disjoint slices of the grid, e.g. `3/8`.")
+    parser.add_argument("--limit", default=None, type=int,
+                        help="Stop after running this many simulations.")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of worker processes.")
+    parser.add_argument("--lanes", default=1, type=int,
+                        help="Run up to this many configs on the same network together, as lanes.")
+    parser.add_argument("--memory-profile", default=None, choices=memory_methods,
+                        help="Profile the memory of each simulation, reporting its peak in the results.")
+    parser.add_argument("--catalogue", default=catalogue_file,
+                        help="SQLite catalogue recording every simulation, empty to disable.")
+    parser.add_argument("--queue", default=None,
+                        help="Job queue directory on a shared filesystem; run as a queue worker.")
+    parser.add_argument("--enqueue", action="store_true",
+                        help="Add the grid (or shard) to the job queue instead of running it.")
+    parser.add_argument("--batch-size", default=100, type=int,
+                        help="Number of configs per job in the queue.")
+    parser.add_argument("--lease-timeout", default=300, type=float,
+                        help="Seconds without heartbeat after which a worker's jobs are requeued.")
+    parser.add_argument("--count", action="store_true",
+                        help="Print the number of configs in the grid (and shard) and exit.")
+    args = parser.parse_args(argv)
+
+    # Network configuraitons
+    network_config = load_config_file("configs/network_config.yaml")
+
+    # # Single run
+    # sim_config = load_config_file("configs/simulation_config.yaml")
+    # (sim_id, topology, homogeneous, input_params) = single_run_params(sim_config)
+
+    # # New a simulation instance
+    # sim = SCFSimulation(sim_id=0,
+    #                     topology,
+    #                     homogeneous,
+    #                     network_config,
+    #                     **input_params)
+    # # Run the simulation
+    # sim.run()
+
+    # Grid search
+    input_params = load_config_file(args.inputs)
+    if args.memory_profile:
+        input_params["memory_profile"] = args.memory_profile
+    if input_params.get("memory_profile") and args.lanes > 1:
+        parser.error("Memory profiling is per simulation, it cannot run with --lanes.")
+    if args.count:
+        total = count_sim_configs(input_params)
+        shard_idx, num_shards = args.shard
+        print(f"{total} configs in grid, "
+              f"{len(range(shard_idx, total, num_shards))} in shard {shard_idx}/{num_shards}.")
+        return
+
+    sim_configs = iter_sim_configs(input_params, shard=args.shard)
+    if args.queue:
+        queue = JobQueue(args.queue, 
+                         lease_timeout=args.lease_timeout,
+                         heartbeat_interval=args.lease_timeout / 10)
+        if args.enqueue:
+            num_jobs = queue.enqueue(itertools.islice(sim_configs, args.limit), args.batch_size)
+            print(f"{num_jobs} jobs added to the queue.")
+            return
+
+    catalogue = Catalogue(args.catalogue) if args.catalogue else None
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        if args.queue:
+            run_worker(queue, network_config, executor, catalogue, args.lanes)
+        else:
+            execute(itertools.islice(sim_configs, args.limit), network_config, 
+                    executor, catalogue, args.lanes)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if catalogue is not None:
+            catalogue.close()
+
 
-    if sim_id == 2: break
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+A job queue of simulation configs on a shared filesystem (e.g., NFS), letting
+grid search workers on several hosts claim jobs without any network service.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+Layout of the queue directory:
+    pending/<job_id>.json               jobs waiting to be claimed
+    claimed/<job_id>@<worker_id>.json   jobs claimed by a worker
+    done/<job_id>@<worker_id>.json      jobs completed by a worker
+    workers/<worker_id>                 heartbeats, i.e., modification time
+Every state change is a single `os.rename`, which is atomic on a shared
+filesystem, so a job is claimed by exactly one worker. A claimed job whose
+worker stopped heartbeating for `lease_timeout` seconds is requeued.
+Jobs are run at least once: a job requeued from a worker that was alive but
+stalled may be run twice.
+"""
+
+# %%
+import argparse
+import json
+import os
+import random
+import socket
+import threading
+import uuid
+
+
+class Job(object):
+    """
+    A claimed job: a batch of simulation configs.
+    """
+
+    def __init__(self, job_id, path, configs):
+        self.job_id = job_id
+        self.path = path
+        self.configs = configs
+
+
+class JobQueue(object):
+    """
+    Parameters
+    ----------
+    `root`: str
+        The queue directory on the shared filesystem.
+    `lease_timeout`: float
+        Seconds without heartbeat after which a worker's jobs are requeued.
+    `heartbeat_interval`: float
+        Seconds between heartbeats of this worker.
+    `worker_id`: str, optional
+        Unique ID of this worker; by default, from host name and process ID.
+    """
+
+    states = ("pending", "claimed", "done", "workers")
+
+    def __init__(self, root, lease_timeout=300, heartbeat_interval=30, worker_id=None):
+        if heartbeat_interval >= lease_timeout:
+            raise ValueError("`heartbeat_interval` must be shorter than `lease_timeout`.")
+        self.root = root
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        for state in self.states:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat_thread = None
+
+
+    def __enter__(self):
+        self.start_heartbeat()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.stop_heartbeat()
+
+
+    def _path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+
+    def _fs_now(self):
+        """
+        Current time by the clock of the shared filesystem, so that lease ages
+        are not distorted by clock skew between hosts.
+        """
+        clock = os.path.join(self.root, ".clock")
+        with open(clock, "a"):
+            pass
+        os.utime(clock, None)
+        return os.stat(clock).st_mtime
+
+
+    # %% Producer
+    def enqueue(self, configs, batch_size=100):
+        """
+        Add configs to the queue, in jobs of up to `batch_size` configs each.
+        Jobs are named by the `sim_id` of their first config, so they are
+        claimed in the order of the grid, and enqueuing again is idempotent.
+
+        Returns
+        -------
+            int: The number of jobs added.
+        """
+        known = self._known_jobs()
+        num_jobs = 0
+        batch = []
+        for config in configs:
+            batch.append(config)
+            if len(batch) == batch_size:
+                num_jobs += self._add_job(batch, known)
+                batch = []
+        if batch:
+            num_jobs += self._add_job(batch, known)
+        return num_jobs
+
+
+    def _add_job(self, configs, known):
+        sim_id = configs[0]["sim_id"]
+        job_id = f"{sim_id:012d}" if isinstance(sim_id, int) else str(sim_id)
+        if job_id in known:
+            return 0
+        # Write to a temporary file, then rename, so that no worker sees a partial job
+        tmp = self._path("pending", f".{job_id}.{self.worker_id}.tmp")
+        with open(tmp, "w") as file:
+            json.dump(configs, file)
+        os.rename(tmp, self._path("pending", f"{job_id}.json"))
+        return 1
+
+
+    def _known_jobs(self):
+        """
+        IDs of the jobs in the queue, in any state.
+        """
+        known = set()
+        for state in ("pending", "claimed", "done"):
+            for name in os.listdir(os.path.join(self.root, state)):
+                if name.endswith(".json") and not name.startswith("."):
+                    known.add(name[:-len(".json")].split("@", 1)[0])
+        return known
+
+
+    # %% Consumer
+    def claim(self):
+        """
+        Atomically claim a pending job, after requeuing expired leases.
+
+        Returns
+        -------
+            Job: The claimed job, or None if no job is pending.
+        """
+        self.reap()
+        pending = sorted(name for name in os.listdir(os.path.join(self.root, "pending"))
+                         if name.endswith(".json") and not name.startswith("."))
+        # Start from a random job near the head, to reduce contention between workers
+        if pending:
+            offset = random.randrange(min(len(pending), 16))
+            pending = pending[offset:] + pending[:offset]
+        for name in pending:
+            job_id = name[:-len(".json")]
+            claimed = self._path("claimed", f"{job_id}@{self.worker_id}.json")
+            try:
+                os.rename(self._path("pending", name), claimed)
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+            os.utime(claimed, None)  # Claim time
+            with open(claimed) as file:
+                return Job(job_id, claimed, json.load(file))
+        return None
+
+
+    def complete(self, job):
+        """
+        Mark a claimed job as done. Returns False if its lease had expired
+        and it was requeued, in which case it may be run again.
+        """
+        try:
+            os.rename(job.path, self._path("done", os.path.basename(job.path)))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+    def release(self, job):
+        """
+        Return a claimed job to the queue without running it.
+        """
+        try:
+            os.rename(job.path, self._path("pending", f"{job.job_id}.json"))
+        except FileNotFoundError:
+            pass
+
+
+    # %% Leases
+    def heartbeat(self):
+        path = self._path("workers", self.worker_id)
+        with open(path, "a"):
+            pass
+        os.utime(path, None)
+
+
+    def start_heartbeat(self):
+        """
+        Send heartbeats from a background thread until `stop_heartbeat`.
+        """
+        self.heartbeat()
+        if self._heartbeat_thread is not None:
+            return
+
+        def beat():
+            while not self._stop_heartbeat.wait(self.heartbeat_interval):
+                self.heartbeat()
+
+        self._stop_heartbeat.clear()
+        self._heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        self._heartbeat_thread.start()
+
+
+    def stop_heartbeat(self):
+        self._stop_heartbeat.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+
+    def reap(self):
+        """
+        Requeue the jobs of workers that stopped heartbeating.
+
+        Returns
+        -------
+            int: The number of requeued jobs.
+        """
+        now = self._fs_now()
+        num_requeued = 0
+        for name in os.listdir(os.path.join(self.root, "claimed")):
+            job_id, worker_id = name[:-len(".json")].split("@", 1)
+            try:
+                last_seen = os.stat(self._path("workers", worker_id)).st_mtime
+            except FileNotFoundError:
+                # A worker that never beat: fall back to its claim time
+                try:
+                    last_seen = os.stat(self._path("claimed", name)).st_mtime
+                except FileNotFoundError:
+                    continue
+            if now - last_seen <= self.lease_timeout:
+                continue
+            try:
+                os.rename(self._path("claimed", name), self._path("pending", f"{job_id}.json"))
+                num_requeued += 1
+            except FileNotFoundError:
+                pass  # Completed or requeued meanwhile
+        return num_requeued
+
+
+    def status(self):
+        """
+        Count the jobs in each state, and the workers alive.
+        """
+        now = self._fs_now()
+        counts = {}
+        for state in ("pending", "claimed", "done"):
+            counts[state] = sum(1 for name in os.listdir(os.path.join(self.root, state))
+                                if name.endswith(".json") and not name.startswith("."))
+        workers = os.listdir(os.path.join(self.root, "workers"))
+        counts["workers_alive"] = sum(
+            1 for w in workers
+            if now - os.stat(self._path("workers", w)).st_mtime <= self.lease_timeout)
+        return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or maintain a job queue.")
+    parser.add_argument("command", choices=["status", "reap"])
+    parser.add_argument("queue", help="The queue directory.")
+    parser.add_argument("--lease-timeout", default=300, type=float,
+                        help="Seconds without heartbeat after which jobs are requeued.")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue, lease_timeout=args.lease_timeout,
+                     heartbeat_interval=args.lease_timeout / 10)
+    if args.command == "reap":
+        print(f"{queue.reap()} jobs requeued.")
+    print(queue.status())
@@ -0,0 +1,464 @@
+"""
+Parameter lanes: run simulations that share a network side by side, as lanes
+of one array-based simulation.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+Simulations on the same topology, with the same `powers`, often differ only
+in financing parameters, e.g., `bank_annual_rate`, `invoice_annual_rate`,
+`invoice_term`, `loan_repayment_time`, `operation_fee`, `window_size`,
+`financed` or `paradigm`; or in their seeds. `LaneEngine` holds the state of
+all of them as arrays of shape `(num_lanes, num_nodes)`, and the parameters as
+vectors of shape `(num_lanes,)` broadcast through the settlement and financing
+phases, so that a timestep costs about as many array operations for dozens of
+lanes as for one. Orders of all lanes are held in one `orders.OrderBook`.
+
+Each lane keeps its own random streams, and its own `SCFSimulation` for its
+parameters, writer, cascades and summary, so it reproduces the run of that
+simulation on its own; `lane_engine` runs a config as a lane, for
+`equivalence.py`. Trajectories are recorded as in Parquet files, i.e., the
+key columns as integers and the others as floats. Regional financing,
+pre-drawn streams and memory profiling are not supported in lanes.
+"""
+
+# %%
+import contextlib
+import io
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+
+from convergence import SteadyStateDetector
+from forecasting import get_forecaster
+from orders import OrderBook, SupplierChoice, last_occurrences
+from output import columns, written_dtypes
+from simulation import SCFSimulation, get_loan, get_max_debt, interest_to_pay, is_bankrupt
+
+# Columns recorded per node before the financing phase, and set by orders and payments
+_order_columns = ("order_from", "buy_amount", "receive_amount", "purchase_value", "sale_value")
+_payment_columns = ("cash_from", "pay_amount")
+
+
+def _add_in_order(total, values):
+    """
+    Add `values` to `total` one at a time, in node order, as `SCFSimulation.run`
+    does in its loop over nodes, so that totals are rounded alike; `np.sum`
+    adds pairwise instead. Any value, even zero, makes an integer total a float.
+    """
+    return np.cumsum(np.r_[total, values])[-1]
+
+
+def lane_key(config):
+    """
+    The key of the configs that can run as lanes of one engine.
+    """
+    return (config["network_topology"], tuple(config["powers"]))
+
+
+class LaneEngine(object):
+    """
+    Run simulations as lanes of one array-based simulation.
+
+    Parameters
+    ----------
+    `sims`: list
+        The simulations, i.e., `SCFSimulation` instances not run yet, on the
+        same topology with the same `powers`.
+    """
+
+    def __init__(self, sims):
+        if not sims:
+            raise ValueError("No simulation to run.")
+        first = sims[0]
+        for sim in sims:
+            if sim.topology != first.topology or list(sim.powers) != list(first.powers):
+                raise ValueError("Lanes must share the topology and the powers.")
+            if sim.streams is not None:
+                raise ValueError("Lanes do not support pre-drawn streams.")
+            if sim.regional_financing:
+                raise ValueError("Lanes do not support regional financing.")
+            if sim.memory is not None:
+                raise ValueError("Lanes do not support memory profiling, which is per simulation.")
+            if sim.loan_repayment_time > sim.max_payment_delay + 1:
+                raise ValueError("`loan_repayment_time` exceeds the longest payment delay.")
+        self.sims = sims
+        self.num_lanes = len(sims)
+        self.num_nodes = first.num_nodes
+        self.max_payment_delay = int(first.max_payment_delay)
+        self.dummy_raw_material = first.network.dummy_raw_material
+        self.dummy_market = first.network.dummy_market
+
+        # Parameter vectors
+        def vector(name, dtype=float):
+            return np.array([getattr(sim, name) for sim in sims], dtype=dtype)
+        self.t_max = vector("t_max", int)
+        self.financed = vector("financed", bool)
+        self.proactive = np.array([sim.paradigm == "proactive" for sim in sims])
+        for sim in sims:
+            if sim.paradigm not in ("reactive", "proactive"):
+                raise ValueError("Paradigm must be either `reactive` or `proactive`.")
+        self.operation_fee = vector("operation_fee")
+        self.bank_annual_rate = vector("bank_annual_rate")
+        self.invoice_annual_rate = vector("invoice_annual_rate")
+        self.invoice_term = vector("invoice_term", int)
+        self.loan_repayment_time = vector("loan_repayment_time", int)
+        self.market_orders = vector("market_orders", int)
+        self.shared_stock = vector("shared_stock", bool)
+
+        # Node attributes, per lane as powers are assigned per simulation
+        nodes = range(self.num_nodes)
+        self.power = np.array([[sim.G.nodes[n]["power"] for n in nodes] for sim in sims])
+        self.tier = np.array([first.G.nodes[n]["tier"] for n in nodes])
+        self.edge_payment_delay = np.array([sim.network.edge_payment_delay for sim in sims])
+        self.edge_sell_price = first.network.edge_sell_price
+
+
+    def _initial_state(self):
+        def attr(name, dtype):
+            return np.array([[sim.G.nodes[n][name] for n in range(self.num_nodes)]
+                             for sim in self.sims], dtype=dtype)
+        self.cash = attr("cash", float)
+        self.stock = attr("stock", np.int64)
+        self.unfilled = attr("unfilled", np.int64)
+        self.issued = attr("issued", np.int64)
+        self.debt = attr("debt", float)
+        self.max_debt = attr("max_debt", float)
+        self.is_bankrupt = attr("is_bankrupt", bool)
+
+
+    def _record(self, lane, output_at_t):
+        """
+        Buffer the output of a lane at a timestep, appended in blocks to its writer.
+        """
+        self.buffers[lane].append(output_at_t)
+        if len(self.buffers[lane]) >= 100:
+            self._flush(lane)
+
+
+    def _flush(self, lane):
+        if self.buffers[lane]:
+            self.sims[lane].writer.append({
+                col: np.concatenate([b[col] for b in self.buffers[lane]]).astype(written_dtypes[col])
+                for col in columns})
+            self.buffers[lane] = []
+
+
+    def _stop(self, lane, t, reason):
+        self._flush(lane)
+        self.running[lane] = False
+        sim = self.sims[lane]
+        sim.stock, sim.unfilled, sim.issued = self.stock[lane], self.unfilled[lane], self.issued[lane]
+        sim._stop(t, reason)
+
+
+    def _draw(self, lanes):
+        """
+        Uniform draws for supplier choices, from the stream of each lane, in order.
+        """
+        u = np.empty(len(lanes))
+        by_lane = np.argsort(lanes, kind="stable")
+        counts = np.bincount(lanes, minlength=self.num_lanes)
+        start = 0
+        for lane in np.flatnonzero(counts).tolist():
+            u[by_lane[start:start + counts[lane]]] = self.sims[lane].choice_rng.random(counts[lane])
+            start += counts[lane]
+        return u
+
+
+    def run(self):
+        """
+        Run all lanes to their ends, as `SCFSimulation.run` runs each of them.
+        """
+        L, N, D = self.num_lanes, self.num_nodes, self.max_payment_delay
+        lane_idx = np.arange(L)
+        self._initial_state()
+        receivables = np.zeros((L, N, D + 1))
+        payables = np.zeros((L, N, D + 1))
+        debts = np.zeros((L, N, self.loan_repayment_time.max() + 1))
+        forecasters = [get_forecaster(sim.forecast_method, N, sim.window_size, **sim.forecast_params)
+                       if is_proactive else None
+                       for sim, is_proactive in zip(self.sims, self.proactive)]
+        detectors = [SteadyStateDetector(N, sim.convergence["window_size"],
+                                         sim.convergence.get("cash_tolerance", 0))
+                     if sim.convergence else None for sim in self.sims]
+        is_dummy = np.zeros(N, dtype=bool)
+        is_dummy[[self.dummy_raw_material, self.dummy_market]] = True
+        cash_flows = [{} for _ in range(L)]
+
+        book = OrderBook(self.sims[0].network.edge_index, N, num_lanes=L)
+        suppliers = SupplierChoice([sim.G for sim in self.sims])
+        self.running = np.ones(L, dtype=bool)
+        self.buffers = [[] for _ in range(L)]
+
+        for t in range(1, self.t_max.max() + 1):
+            running = np.flatnonzero(self.running)
+            recording = [lane for lane in running.tolist() if self.sims[lane].writer.is_recording(t)]
+
+            # New demand from market: each lane draws its demands, and selects an OEM for each
+            demands = [self.sims[lane]._get_demand(t) for lane in running.tolist()
+                       for _ in range(self.market_orders[lane])]
+            market_lanes = np.repeat(running, self.market_orders[running])
+            market = np.full(len(market_lanes), self.dummy_market)
+            oems = suppliers.select(market, self._draw(market_lanes), market_lanes)
+            book.add(market, oems, demands, market_lanes)
+
+            # Match the orders against the stock of their sellers
+            orders = book.match(self.stock[book.orders["lane"], book.orders["seller"]],
+                                self.shared_stock[book.orders["lane"]])
+            lanes, buyers, sellers = orders["lane"], orders["buyer"], orders["seller"]
+
+            # Pay for the orders: immediately or delay, both precomputed per edge
+            edges = book.edges()
+            payouts = orders["received"] * self.edge_sell_price[edges]
+            delays = self.edge_payment_delay[lanes, edges]
+            np.add.at(payables, (lanes, buyers, delays), payouts)
+            np.add.at(receivables, (lanes, sellers, delays), payouts)
+            paid = payouts > 0
+            due = t + delays
+            for lane in np.unique(lanes[paid]).tolist():
+                at_lane = paid & (lanes == lane)
+                self.sims[lane].cascades.add_payments(buyers[at_lane], sellers[at_lane],
+                                                      payouts[at_lane], due[at_lane])
+                for k in np.unique(due[at_lane]).tolist():
+                    if self.sims[lane].writer.is_recording(k):
+                        at_k = at_lane & (due == k)
+                        cash_flows[lane].setdefault(k, []).append(
+                            (buyers[at_k], sellers[at_k], payouts[at_k]))
+
+            # Settlement: pay debts, deduct operation fees, receive receivables, pay payables;
+            # stopped lanes are left as they stopped
+            alive = self.running[:, None] & ~self.is_bankrupt
+            payout_today = receivables[:, :, 0] - payables[:, :, 0] - self.operation_fee[:, None]
+            self.cash = np.where(alive, self.cash + payout_today, self.cash)
+            costs = np.where(alive, np.abs(payout_today), 0)
+            received, paid_out = receivables[:, :, 0].copy(), payables[:, :, 0].copy()
+            # Decrement the time to receive, to pay, and to repay, as `SCFSimulation.run` does
+            receivables[:, :, :D - 1] = receivables[:, :, 1:D]
+            payables[:, :, :D - 1] = payables[:, :, 1:D]
+            receivables[:, :, D] = 0
+            payables[:, :, D] = 0
+            for R in np.unique(self.loan_repayment_time).tolist():
+                at_R = self.loan_repayment_time == R
+                if R > 1:  # Unfinanced configs may have no repayment time
+                    debts[at_R, :, :R - 1] = debts[at_R, :, 1:R]
+                debts[at_R, :, R] = 0
+
+            if recording:
+                is_bankrupt_at_t = self.is_bankrupt.copy()
+                output = {
+                    "stock": np.where(self.is_bankrupt, np.nan, self.stock),
+                    "cash": np.where(self.is_bankrupt, np.nan, self.cash),
+                    "unfilled": np.where(self.is_bankrupt, np.nan, self.unfilled),
+                    "issued": np.where(self.is_bankrupt, np.nan, self.issued),
+                    "b_loan": np.where(self.is_bankrupt, np.nan, 0.0),
+                    "receivable": np.where(self.is_bankrupt, np.nan, received),
+                    "payable": np.where(self.is_bankrupt, np.nan, paid_out),
+                    "debt": np.where(self.is_bankrupt, np.nan, self.debt),
+                }
+                for col in _order_columns + _payment_columns:
+                    output[col] = np.full((L, N), np.nan)
+
+            for lane in running.tolist():
+                self.sims[lane].cascades.settle(t)
+
+            # Financing thresholds: forecast from past costs if `proactive`, otherwise 0
+            fts = np.zeros((L, N))
+            for lane in running[self.proactive[running]].tolist():
+                forecasters[lane].update(costs[lane])
+                fts[lane] = forecasters[lane].forecast()
+
+            # Bank financing
+            eligible = self.running[:, None] & ~self.is_bankrupt
+            financed = self.financed[:, None] & eligible
+            R = self.loan_repayment_time
+            asks = financed & (self.cash <= fts)
+            loan = np.where(asks, get_loan("new", cash=self.cash, max_debt=self.max_debt,
+                                           debt=self.debt, ft=fts), 0.0)
+            loan_repayment = loan + interest_to_pay(loan, self.bank_annual_rate[:, None], R[:, None])
+            debts[lane_idx, :, R - 1] = np.where(eligible, loan_repayment, debts[lane_idx, :, R - 1])
+            payables[lane_idx, :, R - 1] += np.where(eligible, loan_repayment, 0.0)
+            self.cash = self.cash + loan
+            self.debt = np.where(eligible, self.debt + loan_repayment, self.debt)
+            for sim, lane_loans, at_lane in zip(self.sims, loan, asks):
+                if at_lane.any():
+                    sim.total_loans = _add_in_order(sim.total_loans, lane_loans[at_lane])
+            if recording:
+                output["cash"] = np.where(eligible, self.cash, output["cash"])
+                output["debt"] = np.where(eligible, self.debt, output["debt"])
+                output["b_loan"] = np.where(eligible, loan, output["b_loan"])
+
+            # Supply chain financing, if cash is still not sufficient
+            discounted = financed & (self.cash <= 0)
+            term = self.invoice_term
+            due_at_term = receivables[lane_idx, :, term]
+            receive_early = np.where(discounted, np.minimum(due_at_term, np.abs(self.cash)), 0.0)
+            discount = interest_to_pay(receive_early, self.invoice_annual_rate[:, None], term[:, None])
+            self.cash = np.where(discounted, self.cash + (receive_early - discount), self.cash)
+            receivables[lane_idx, :, term] = np.where(discounted, due_at_term - receive_early, due_at_term)
+            for sim, lane_discounts, at_lane in zip(self.sims, discount, discounted):
+                if at_lane.any():
+                    sim.total_discounts = _add_in_order(sim.total_discounts, lane_discounts[at_lane])
+
+            # Update loan caps, and check bankruptcy
+            self.max_debt = np.where(eligible, get_max_debt(self.cash, self.power), self.max_debt)
+            bankrupt = eligible & is_bankrupt(self.cash, receivables.sum(axis=2), payables.sum(axis=2))
+            new_bankruptcies = np.zeros(L, dtype=bool)
+            for lane, node in np.argwhere(bankrupt).tolist():
+                sim = self.sims[lane]
+                sim.G.nodes[node]["is_bankrupt"] = True
+                sim.bankrupt_at[node] = t
+                sim.cascades.fail(node, t)
+                sim.G.remove_edges_from(list(sim.G.in_edges(node)) + list(sim.G.out_edges(node)))
+                suppliers.remove(node, lane)
+                new_bankruptcies[lane] = True
+            self.is_bankrupt |= bankrupt
+            if recording:
+                is_bankrupt_at_t |= bankrupt
+
+            # Update stock, unfilled and issued orders of both buyers and sellers
+            nodes, d_stock, d_unfilled, d_issued = book.deltas()
+            self.stock.ravel()[nodes] += d_stock
+            self.unfilled.ravel()[nodes] += d_unfilled
+            self.issued.ravel()[nodes] += d_issued
+            if recording:
+                # The values of the last order at each node
+                last = last_occurrences(book.flat(sellers))
+                output["order_from"][lanes[last], sellers[last]] = buyers[last]
+                output["buy_amount"][lanes[last], sellers[last]] = orders["amount"][last]
+                output["receive_amount"][lanes[last], sellers[last]] = orders["received"][last]
+                output["sale_value"][lanes[last], sellers[last]] = payouts[last]
+                last = last_occurrences(book.flat(buyers))
+                output["purchase_value"][lanes[last], buyers[last]] = payouts[last]
+                for lane in recording:
+                    if t in cash_flows[lane]:
+                        payers, payees, amounts = (np.concatenate(x) for x in zip(*cash_flows[lane].pop(t)))
+                        last = last_occurrences(payees)
+                        output["cash_from"][lane, payees[last]] = payers[last]
+                        output["pay_amount"][lane, payees[last]] = amounts[last]
+
+            # Replenishment orders, one for all the unfilled orders of each seller requiring it
+            replenishing = book.replenishing(self.is_bankrupt)
+            new_lanes, new_buyers = replenishing["lane"], replenishing["seller"]
+            new_sellers = suppliers.select(new_buyers, self._draw(new_lanes), new_lanes)
+            has_seller = new_sellers >= 0
+            new_lanes, new_buyers, new_sellers = new_lanes[has_seller], new_buyers[has_seller], new_sellers[has_seller]
+            book.clear()
+            book.add(new_buyers, new_sellers, self.unfilled[new_lanes, new_buyers], new_lanes)
+            book.drop_duplicates()
+
+            for lane in recording:
+                output_at_t = {col: values[lane] for col, values in output.items()}
+                output_at_t.update(timestep=np.full(N, t), node_idx=np.arange(N),
+                                   tier=self.tier, power=self.power[lane],
+                                   is_bankrupt=is_bankrupt_at_t[lane])
+                self._record(lane, output_at_t)
+
+            # Stop the lanes whose network is unconnected, that reached steady state, or `t_max`
+            for lane in running.tolist():
+                sim = self.sims[lane]
+                if (t == 1 or new_bankruptcies[lane]) and \
+                        not nx.has_path(sim.G, self.dummy_raw_material, self.dummy_market):
+                    self._stop(lane, t, "disconnected")
+                elif detectors[lane] is not None and detectors[lane].update(
+                        self.cash[lane], ~is_dummy & ~self.is_bankrupt[lane],
+                        payables[lane].sum(axis=1), debts[lane].sum(axis=1)):
+                    self._stop(lane, t, "converged")
+                elif t == self.t_max[lane]:
+                    self._stop(lane, t, "t_max")
+            if not self.running.all():
+                book.keep(self.running[book.orders["lane"]])
+            if not self.running.any():
+                break
+
+        # Keep the final state in the graphs, as `SCFSimulation.run` does
+        for lane, sim in enumerate(self.sims):
+            for n in range(N):
+                sim.G.nodes[n].update(cash=self.cash[lane, n], stock=int(self.stock[lane, n]),
+                                      unfilled=int(self.unfilled[lane, n]),
+                                      issued=int(self.issued[lane, n]),
+                                      debt=self.debt[lane, n], max_debt=self.max_debt[lane, n])
+        return self.sims
+
+
+# %% Running configs as lanes
+def make_sims(configs, network_config):
+    """
+    The simulations of configs, as enumerated by `grid_search.iter_sim_configs`.
+    """
+    sims = []
+    for config in configs:
+        if config.get("memory_profile"):
+            raise ValueError("Lanes do not support memory profiling, which is per simulation.")
+        config = dict(config)
+        sim_id = config.pop("sim_id")
+        topology = config.pop("network_topology")
+        homogeneous = config.pop("homogeneous")
+        sims.append(SCFSimulation(sim_id, topology, homogeneous, network_config, **config))
+    return sims
+
+
+def run_lanes(configs, network_config):
+    """
+    Run configs as lanes of one engine, they must share the `lane_key`.
+
+    Returns
+    -------
+        list: The simulations, run.
+    """
+    return LaneEngine(make_sims(configs, network_config)).run()
+
+
+def run_lanes_and_summarise(configs, network_config):
+    """
+    Run configs as lanes, and return what is recorded of each of them,
+    as `grid_search.run_and_summarise` does; the runtime is shared equally.
+    """
+    start = time.perf_counter()
+    sims = run_lanes(configs, network_config)
+    runtime = (time.perf_counter() - start) / len(sims)
+    return [(config, sim.summary(), runtime, sim.writer.written_file, sim.seed)
+            for config, sim in zip(configs, sims)]
+
+
+def iter_lane_groups(sim_configs, max_lanes=32):
+    """
+    Group configs into lanes, in order, each group holding up to `max_lanes`
+    consecutive configs of the same `lane_key`.
+    """
+    group, key = [], None
+    for config in sim_configs:
+        if group and (lane_key(config) != key or len(group) == max_lanes):
+            yield group
+            group = []
+        group.append(config)
+        key = lane_key(config)
+    if group:
+        yield group
+
+
+def lane_engine(config, network_config):
+    """
+    Run a config as a lane, writing nothing into `output_data`, for `equivalence.py`.
+    """
+    config = dict(config)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config.update(output_level="full", output_dir=tmp_dir)
+        sim, = run_lanes([config], network_config)
+    return sim.writer.output
+
+
+def lanes_engine(configs, network_config):
+    """
+    Run configs together as lanes, writing nothing into `output_data`.
+
+    Returns
+    -------
+        list: The trajectory of each config.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configs = [dict(config, output_level="full", output_dir=tmp_dir) for config in configs]
+        with contextlib.redirect_stdout(io.StringIO()):
+            sims = run_lanes(configs, network_config)
+    return [sim.writer.output for sim in sims]
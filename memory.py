@@ -0,0 +1,188 @@
+"""
+Memory profiling of simulations: memory is sampled at the phase boundaries of
+a run, by `tracemalloc` or as the resident set size (RSS), so that peaks and
+growth are attributed to phases, and retained allocations to subsystems.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+`tracemalloc` traces the allocations of Python and NumPy, by the line that made
+them; the peak is that of the simulation's own allocations, above what was in
+use when it started, and what the simulation still holds at its end is
+attributed to the modules that allocated it, e.g., `output` for the trajectory
+held by the writer. As the engine makes many small allocations, it slows a run
+down by tens of times, so it suits a few runs to find where memory goes. RSS
+is sampled at almost no cost, but only at the phase boundaries, and includes
+all the process holds, e.g., modules and memory freed but not returned to the
+system; its peak is what a worker needs, for sizing workers over whole sweeps.
+"""
+
+import functools
+import os
+import sysconfig
+import tracemalloc
+
+# Profiling methods
+memory_methods = ("tracemalloc", "rss")
+
+# Columns added to the summary of a simulation, empty if not profiled
+report_columns = ["peak_memory_mb", "peak_memory_phase", "memory_by_phase", "memory_by_subsystem"]
+
+# Modules of this repository, to which allocations are attributed
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+site_packages_dir = sysconfig.get_paths()["purelib"]
+
+
+def _rss():
+    """
+    The resident set size of the process, in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        raise ImportError("Sampling RSS on this platform requires `psutil`, "
+                          "install it or profile with `tracemalloc`.")
+    return psutil.Process().memory_info().rss
+
+
+@functools.lru_cache(maxsize=None)
+def _module(filename):
+    """
+    The module of a file, and whether it is of this repository; the package
+    for a file under `site-packages`, e.g., `pandas`; None for generated code.
+    """
+    if filename.startswith("<"):
+        return None, False
+    filename = os.path.abspath(filename)
+    if os.path.dirname(filename) == repo_dir:
+        return os.path.splitext(os.path.basename(filename))[0], True
+    if filename.startswith(site_packages_dir):
+        return os.path.relpath(filename, site_packages_dir).split(os.sep)[0], False
+    return os.path.splitext(os.path.basename(filename))[0], False
+
+
+def _subsystem(traceback):
+    """
+    The subsystem of an allocation: the module of this repository making it,
+    from the most recent frame, otherwise the module it was made in.
+    """
+    modules = [_module(frame.filename) for frame in reversed(traceback)]
+    for name, is_repo in modules:
+        if is_repo:
+            return name
+    return next((name for name, _ in modules if name is not None), "other")
+
+
+def _format_mb(amounts):
+    """
+    Amounts in bytes as `name:MB` pairs, e.g., "orders:1.25;output:30.50".
+    """
+    return ";".join(f"{name}:{amount / 2**20:.2f}" for name, amount in amounts)
+
+
+class MemoryProfiler(object):
+    """
+    Parameters
+    ----------
+    `method`: str
+        `tracemalloc` or `rss`, see `memory_methods`.
+    `num_frames`: int
+        Frames kept per traced allocation, to find the module making it.
+    `top`: int
+        The number of subsystems reported, those retaining the most memory.
+    """
+
+    def __init__(self, method="tracemalloc", num_frames=16, top=5):
+        if method not in memory_methods:
+            raise ValueError(f"Memory profiling method must be one of {memory_methods}, got '{method}'.")
+        self.method = method
+        self.num_frames = num_frames
+        self.top = top
+        # Net growth and highest memory (above the start) within each phase, in bytes
+        self.growth = {}
+        self.phase_peaks = {}
+        self.peak = 0
+        self.peak_phase = None
+        self.subsystems = []
+        self.is_tracing = False
+        self.is_running = False
+
+
+    def _sample(self):
+        """
+        The memory in use, and the highest since the last sample.
+        """
+        if self.method == "rss":
+            current = _rss()
+            return current, current
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        return current, peak
+
+
+    def start(self):
+        """
+        Start profiling, from the memory in use now.
+        """
+        if self.method == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start(self.num_frames)
+            self.is_tracing = True
+        # RSS is reported as is: all of it is what a worker needs
+        self.baseline = 0 if self.method == "rss" else self._sample()[0]
+        self.last = self._sample()[0]
+        self.is_running = True
+
+
+    def checkpoint(self, phase):
+        """
+        Attribute the memory since the last checkpoint to `phase`, which has just ended.
+        """
+        current, peak = self._sample()
+        self.growth[phase] = self.growth.get(phase, 0) + current - self.last
+        peak -= self.baseline
+        self.phase_peaks[phase] = max(self.phase_peaks.get(phase, 0), peak)
+        if peak > self.peak:
+            self.peak, self.peak_phase = peak, phase
+        self.last = current
+
+
+    def stop(self):
+        """
+        Stop profiling, attributing what is still allocated to subsystems, if
+        traced. Stopping a profiler that is not running does nothing.
+        """
+        if not self.is_running:
+            return
+        self.is_running = False
+        if self.method != "tracemalloc" or not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+        sizes = {}
+        for trace in snapshot.traces:
+            subsystem = _subsystem(trace.traceback)
+            sizes[subsystem] = sizes.get(subsystem, 0) + trace.size
+        self.subsystems = sorted(sizes.items(), key=lambda x: -x[1])[:self.top]
+        if self.is_tracing:
+            tracemalloc.stop()
+            self.is_tracing = False
+
+
+    def report(self):
+        """
+        The peak memory in MB and the phase it was reached in, the net growth
+        of each phase in MB, and the memory retained by each subsystem at the end,
+        as in `report_columns`.
+        """
+        return {
+            "peak_memory_mb": round(self.peak / 2**20, 3),
+            "peak_memory_phase": self.peak_phase,
+            "memory_by_phase": _format_mb(self.growth.items()),
+            "memory_by_subsystem": _format_mb(self.subsystems),
+        }
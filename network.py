@@ -5,10 +5,11 @@ Email: lx249@cam.ac.uk
 """
 
 # %% 
+import copy
 import networkx as nx
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+import os
 import random
 import sys
 
@@ -17,12 +18,31 @@ from utils import load_config_file
 
 
 # %% Get data
+# Network templates, keyed by the paths and modification times of the topology
+# files, so that a long-lived process builds networks without re-reading them
+# nor searching their tiers again. A template is what does not depend on powers
+# or market shares: the graph without attributes, its tiers and the node rows.
+_template_cache = {}
+
+
 def _get_data(edges_file, nodes_file):
     edges_df = pd.read_csv(edges_file, header=0, index_col=False)
     nodes_df = pd.read_csv(nodes_file, header=0, index_col=False)
     return edges_df, nodes_df
 
 
+def _get_template(edges_file, nodes_file):
+    key = (edges_file, os.path.getmtime(edges_file), nodes_file, os.path.getmtime(nodes_file))
+    if key not in _template_cache:
+        edges_df, nodes_df = _get_data(edges_file, nodes_file)
+        G = _create_graph(edges_df)
+        node_depths, tiers = _calc_tiers(G)
+        node_rows = [(row["node_idx"], row["buy_price"], row["sell_price"], row["cash"])
+                     for _, row in nodes_df.iterrows()]
+        _template_cache[key] = (G, node_depths, tiers, _shape_of_tiers(tiers), node_rows)
+    return _template_cache[key]
+
+
 # %%Create graph
 def _create_graph(edges):
     G = nx.from_pandas_edgelist(edges, 
@@ -61,41 +81,37 @@ def _shape_of_tiers(tiers):
 # %% Determine a node' power, i.e., a firm's bargaining power
 def _node_power(homogeneous, 
                 tier_width, 
-                min_tier_width=2):
+                min_tier_width=2,
+                u=None):
     if tier_width < min_tier_width:
         raise ValueError("`tier_width` must not be less than `min_tier_width`.")
     if homogeneous:
         power = 1  # All node gets small powers
     else:
-        x = random.uniform(0, 1) * (min_tier_width / tier_width)
+        u = random.uniform(0, 1) if u is None else u
+        x = u * (min_tier_width / tier_width)
         power = int(x // (1 / 3) + 1)
     return power
 
 
-# %% Calculate node position.
-# The entire drawing area is spanning from bottom left (0, 0) (origin point)
-# to top right (1, 1)
-def _tiered_layout(tiers, 
-                   max_tier_width, num_tiers, 
-                   padding_x=0.1, padding_y=0.1):
-    left_x, right_x = padding_x, 1 - padding_x
-    bottom_y, top_y = padding_y, 1 - padding_y
-    canvas_width, canvas_length = right_x - left_x, top_y - bottom_y
-
-    # Horizontally position nodes from right to left tier by tier
-    # Vertically position nodes in central area with even interval
-    layout = {}
-    y_intv = canvas_width / (max_tier_width - 1)
-    linspace_x = np.linspace(left_x, right_x, num_tiers)
-    for tier_idx, v in tiers.items():
-        tier_width = tiers[tier_idx]["width"]
-        base_y = top_y - (max_tier_width - tier_width) * y_intv / 2  # Most top node
-        nodes = tiers[tier_idx]["nodes"]
-        for idx, v in enumerate(nodes):
-            x_pos = linspace_x[num_tiers - tier_idx - 1]
-            y_pos = base_y - idx * y_intv
-            layout[v] = (x_pos, y_pos)
-    return layout
+# %% Allowed payment delay between buyers and sellers of different powers
+def max_payment_delay(powers):
+    """
+    Allowed payment delay between two nodes.
+
+    Parameters
+    ----------
+    `powers`: list
+        A list of company powers.
+    
+    Returns
+    -------
+        The payment delay matrix two nodes of different powers.
+    """
+    # Payment delay between a buyer with power p_b and a seller with power p_s,
+    # i.e., max(30 * (p_b - p_s) + 60, 30), broadcast over all power pairs.
+    p = np.arange(1, len(powers) + 1)
+    return np.maximum(30 * (p[:, None] - p[None, :]) + 60, 30).astype(int)
 
 
 # %% Supply chain network
@@ -104,16 +120,25 @@ class SCNetwork(object):
     def __init__(self, 
                  topology, homogeneous, 
                  powers, market_shares, 
-                 config):
+                 config, 
+                 power_draws=None,
+                 seed=None):
+        """
+        `power_draws`: np.ndarray, optional
+            Uniform draws in [0, 1) for assigning node powers, indexed by node.
+        `seed`: int, SeedSequence or Generator, optional
+            Seed of the random stream for assigning node powers, if `power_draws` is None.
+        """
         edges_file = config["edges_file"].format(topology=topology)
         nodes_file  = config["nodes_file"].format(topology=topology)
-        edges_df, nodes_df = _get_data(edges_file, nodes_file)
+        template, node_depths, tiers, shape, node_rows = _get_template(edges_file, nodes_file)
         
-        # Create graph and initialise nodes
-        G = _create_graph(edges_df)
-        node_depths, tiers = _calc_tiers(G)
-        max_tier_width, min_tier_width, num_tiers = _shape_of_tiers(tiers)
-        layout = _tiered_layout(tiers, max_tier_width, num_tiers)
+        # Copy the graph of the template and initialise nodes
+        G = template.copy()
+        node_depths, tiers = dict(node_depths), copy.deepcopy(tiers)
+        if power_draws is None:
+            power_draws = np.random.default_rng(seed).random(G.number_of_nodes())
+        max_tier_width, min_tier_width, num_tiers = shape
 
         dummy_raw_material = 0  # Dummy raw material node has infinite stock
         dummy_market = G.number_of_nodes() - 1  # Dummy market has infinite cash
@@ -129,13 +154,9 @@ class SCNetwork(object):
         self.tiers = tiers
         self.num_tiers = num_tiers
         self.max_tier_width = max_tier_width
-        self.layout = layout
-        self.node_colors = self._get_node_colors(config["node_options"])
-        self.node_labels = self._get_node_labels(config["node_options"])
 
         attrs = {}
-        for _, row in nodes_df.iterrows():
-            node_idx = row["node_idx"]
+        for node_idx, buy_price, sell_price, cash in node_rows:
             tier_no = node_depths[node_idx]
             if self.is_dummy(node_idx):
                 power = -1
@@ -143,17 +164,18 @@ class SCNetwork(object):
             else:
                 power = _node_power(homogeneous,
                                     tiers[tier_no]["width"],
-                                    min_tier_width)
+                                    min_tier_width,
+                                    power_draws[node_idx])
                 market_share = market_shares[powers.index(power)]
 
             attrs[node_idx] = {
-                "buy_price": row["buy_price"],
-                "sell_price": row["sell_price"],
-                "cash": row["cash"],
+                "buy_price": buy_price,
+                "sell_price": sell_price,
+                "cash": cash,
                 "tier": tier_no,
                 "power": power,
                 "market_share": market_share,
-                "max_debt": (power+1) * row["cash"],
+                "max_debt": (power+1) * cash,
             }
 
         nx.set_node_attributes(G, attrs)
@@ -166,6 +188,12 @@ class SCNetwork(object):
         nx.set_node_attributes(G, {dummy_market: {"cash": sys.maxsize}})
         nx.set_node_attributes(G, {dummy_raw_material: {"stock": sys.maxsize}})
 
+        # Edge-indexed payment delays and sell prices, resolved once powers are known
+        self.payment_delay_matrix = max_payment_delay(powers)
+        (self.edge_index, 
+         self.edge_payment_delay, 
+         self.edge_sell_price) = self._index_edges()
+
 
     # %% Check if the node is dummy
     def is_dummy(self, node):
@@ -175,43 +203,64 @@ class SCNetwork(object):
             return False
     
 
+    # %% Precompute payment delay and sell price of every edge
+    def _index_edges(self):
+        """
+        Index edges and precompute their payment delays and sell prices.
+        An edge `(seller, buyer)` is supplied by `seller`, so its price is the 
+        seller's sell price. Payment is immediate (zero delay) if either end 
+        is a dummy node; otherwise it is determined by both ends' powers.
+
+        Returns
+        -------
+            `edge_index`: dict, keyed by `(seller, buyer)`, valued by the edge index.
+            `delays`: np.ndarray, the payment delay of each edge.
+            `sell_prices`: np.ndarray, the unit price of each edge.
+        """
+        edges = list(self.G.edges())
+        edge_index = {edge: e for e, edge in enumerate(edges)}
+        powers = np.array([self.G.nodes[n]["power"] for n in range(self.G.number_of_nodes())])
+        prices = np.array([self.G.nodes[n]["sell_price"] for n in range(self.G.number_of_nodes())])
+        
+        sellers, buyers = (np.array(x, dtype=int) for x in zip(*edges))
+        delays = self.payment_delay_matrix[powers[buyers] - 1, powers[sellers] - 1]
+        is_dummy_edge = (buyers == self.dummy_market) | (sellers == self.dummy_raw_material)
+        delays[is_dummy_edge] = 0
+        return edge_index, delays, prices[sellers]
+
+
     # %% Get the market share of the given power.
     def _get_market_share(self, power):
         if power not in self.powers:
             raise ValueError(f"The value of `power` must be {self.powers}.")
         return self.market_shares[self.powers.index(power)]
 
-    # %% 
-    def _get_node_labels(self, node_options):
-        labels = {}
-        for node_idx in range(self.G.number_of_nodes()):
-            labels[node_idx] = str(node_idx)
-        labels[self.dummy_raw_material] = ""
-        labels[self.dummy_market] = ""
-        return labels
+    # %% Drawing: layout, colors and labels are built by the visualization layer on 
+    # first use, so that simulations never import `matplotlib`.
+    @property
+    def layout(self):
+        if not hasattr(self, "_layout"):
+            from visualization import tiered_layout
+            self._layout = tiered_layout(self.tiers, self.max_tier_width, self.num_tiers)
+        return self._layout
 
 
-    # %% Get the node colors
-    def _get_node_colors(self, node_options):
-        _color = node_options["healthy"]["color"]
-        colors = [_color] * self.G.number_of_nodes()
-        colors[self.dummy_raw_material] = node_options["raw_material"]["color"]
-        colors[self.dummy_market] = node_options["market"]["color"]
-        return colors
+    @property
+    def node_colors(self):
+        if not hasattr(self, "_node_colors"):
+            from visualization import get_node_colors
+            self._node_colors = get_node_colors(self, self.config["node_options"])
+        return self._node_colors
 
 
-    # %% Draw graph and return current figure and axes
-    def _draw_graph(self, figsize=(10, 4), **options):
-        plt.figure(figsize=figsize, frameon=False)
-        nx.draw_networkx(self.G, 
-                         pos=self.layout,
-                         labels=self.node_labels,
-                         node_color=self.node_colors,
-                         **options)
-        return (plt.gcf(), plt.gca())
+    @property
+    def node_labels(self):
+        if not hasattr(self, "_node_labels"):
+            from visualization import get_node_labels
+            self._node_labels = get_node_labels(self)
+        return self._node_labels
 
 
     def draw(self):
-        graph_options = self.config["graph_options"]
-        fig, ax = self._draw_graph(self.config["figsize"], **graph_options)
-        return fig, ax
\ No newline at end of file
+        from visualization import draw
+        return draw(self)
@@ -0,0 +1,286 @@
+"""
+Order book: the orders of a timestep, as a structured NumPy array.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+Each order is a row `(lane, buyer, seller, amount, received, replenish)`:
+`buyer` orders `amount` from `seller`, receives `received` of it, and the
+seller requires replenishment or not. `lane` is the simulation the order
+belongs to, when simulations run side by side (see `lanes.py`), otherwise 0;
+nodes of different lanes are distinct, as lane-major flat indices
+`lane * num_nodes + node`. Orders are matched against seller stock, and
+their effects on stock, unfilled and issued orders are accumulated, as whole
+arrays, so that a timestep costs NumPy operations over its orders rather than
+a dictionary update per order. A timestep may hold any number of market
+orders, and several orders on the same edge.
+"""
+
+import itertools
+
+import numpy as np
+
+order_dtype = np.dtype([
+    ("lane", np.int64),
+    ("buyer", np.int64),
+    ("seller", np.int64),
+    ("amount", np.int64),
+    ("received", np.int64),
+    ("replenish", bool),
+])
+
+
+def last_occurrences(index):
+    """
+    The positions of the last occurrence of each value in `index`, so that
+    assigning by them gives what assigning one by one in order would.
+    """
+    _, first_in_reversed = np.unique(index[::-1], return_index=True)
+    return np.sort(len(index) - 1 - first_in_reversed)
+
+
+class OrderBook(object):
+    """
+    Parameters
+    ----------
+    `edge_index`: dict
+        The edge index, keyed by `(seller, buyer)`, i.e., `SCNetwork.edge_index`.
+    `num_nodes`: int
+        The number of nodes.
+    `num_lanes`: int
+        The number of simulations whose orders are held.
+    `capacity`: int
+        The initial number of orders held, doubled when exceeded.
+    """
+
+    def __init__(self, edge_index, num_nodes, num_lanes=1, capacity=64):
+        self.num_nodes = num_nodes
+        self.num_lanes = num_lanes
+        keys = np.array([s * num_nodes + b for s, b in edge_index], dtype=np.int64)
+        ids = np.array(list(edge_index.values()), dtype=np.int64)
+        order = np.argsort(keys)
+        self.edge_keys = keys[order]
+        self.edge_ids = ids[order]
+        self.data = np.zeros(capacity, dtype=order_dtype)
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    @property
+    def orders(self):
+        """
+        The orders, as a view of the structured array.
+        """
+        return self.data[:self.size]
+
+
+    def add(self, buyers, sellers, amounts, lanes=0):
+        """
+        Append orders, not matched yet.
+        """
+        n = len(buyers)
+        if self.size + n > len(self.data):
+            data = np.zeros(max(2 * len(self.data), self.size + n), dtype=order_dtype)
+            data[:self.size] = self.orders
+            self.data = data
+        new = self.data[self.size:self.size + n]
+        new["lane"] = lanes
+        new["buyer"] = buyers
+        new["seller"] = sellers
+        new["amount"] = amounts
+        new["received"] = 0
+        new["replenish"] = False
+        self.size += n
+
+
+    def clear(self):
+        self.size = 0
+
+
+    def keep(self, mask):
+        """
+        Keep the orders where `mask` is True, in order.
+        """
+        kept = self.orders[mask]
+        self.size = len(kept)
+        self.data[:self.size] = kept
+
+
+    def drop_duplicates(self):
+        """
+        Keep the first order on each edge, e.g., of replenishment orders,
+        each of which is for all the unfilled orders of its buyer.
+        """
+        orders = self.orders
+        keys = self.flat(orders["seller"]) * self.num_nodes + orders["buyer"]
+        _, first = np.unique(keys, return_index=True)
+        if len(first) < self.size:
+            self.keep(np.sort(first))
+
+
+    def flat(self, nodes):
+        """
+        The lane-major flat indices of `nodes` of the orders.
+        """
+        return self.orders["lane"] * self.num_nodes + nodes
+
+
+    def edges(self):
+        """
+        The edge index of each order.
+        """
+        orders = self.orders
+        keys = orders["seller"] * self.num_nodes + orders["buyer"]
+        return self.edge_ids[np.searchsorted(self.edge_keys, keys)]
+
+
+    def match(self, stock, shared_stock=False):
+        """
+        Match the orders against the stock of their sellers, setting how much is
+        received and whether the seller requires replenishment, i.e., if its
+        stock does not exceed the order.
+
+        Parameters
+        ----------
+        `stock`: np.ndarray
+            The stock of the seller of each order, at the start of the timestep.
+        `shared_stock`: bool, or np.ndarray of bool per order
+            If False, every order is matched against the whole stock of its
+            seller, as stock is only updated after the timestep. If True,
+            orders on the same seller draw down its stock in the order they
+            were placed, so that a seller never delivers more than its stock.
+        """
+        orders = self.orders
+        amounts = orders["amount"]
+        available = np.asarray(stock, dtype=np.int64)
+        if np.any(shared_stock) and self.size > 1:
+            # Stock left for each order, after the earlier orders on its seller
+            seller_keys = self.flat(orders["seller"])
+            by_seller = np.argsort(seller_keys, kind="stable")
+            sorted_sellers = seller_keys[by_seller]
+            cum = np.cumsum(amounts[by_seller])
+            starts = np.flatnonzero(np.r_[True, sorted_sellers[1:] != sorted_sellers[:-1]])
+            ordered_before = cum - amounts[by_seller]
+            ordered_before -= np.repeat(ordered_before[starts], np.diff(np.r_[starts, len(cum)]))
+            shared = available.copy()
+            shared[by_seller] = np.maximum(available[by_seller] - ordered_before, 0)
+            available = np.where(shared_stock, shared, available)
+        orders["received"] = np.minimum(available, amounts)
+        orders["replenish"] = available <= amounts
+        return orders
+
+
+    def deltas(self):
+        """
+        The changes in stock, unfilled and issued orders of the nodes in the orders.
+
+        Returns
+        -------
+            tuple: The nodes, as flat indices, and their changes in stock,
+            unfilled and issued orders.
+        """
+        orders = self.orders
+        buyers, sellers = self.flat(orders["buyer"]), self.flat(orders["seller"])
+        amounts, received = orders["amount"], orders["received"]
+        size = self.num_lanes * self.num_nodes
+        stock = np.zeros(size, dtype=np.int64)
+        unfilled = np.zeros(size, dtype=np.int64)
+        issued = np.zeros(size, dtype=np.int64)
+        np.add.at(stock, buyers, received)
+        np.subtract.at(stock, sellers, received)
+        np.subtract.at(unfilled, buyers, received)
+        np.add.at(unfilled, sellers, amounts - received)
+        np.add.at(issued, sellers, received)
+        nodes = np.unique(np.concatenate([buyers, sellers]))
+        return nodes, stock[nodes], unfilled[nodes], issued[nodes]
+
+
+    def replenishing(self, is_bankrupt):
+        """
+        The orders whose sellers place replenishment orders, one per order
+        requiring it, in order, leaving out the bankrupt sellers.
+
+        Parameters
+        ----------
+        `is_bankrupt`: np.ndarray
+            Whether each node is bankrupt, of shape `(num_nodes,)` or `(num_lanes, num_nodes)`.
+        """
+        orders = self.orders
+        is_bankrupt = np.ravel(is_bankrupt)[self.flat(orders["seller"])]
+        return orders[orders["replenish"] & ~is_bankrupt]
+
+
+class SupplierChoice(object):
+    """
+    Vectorised supplier selection, given uniform draws: a supplier is
+    selected with probability proportional to its market share, by inverse
+    transform sampling, as `random.choices` does. The suppliers of each
+    node, in the order of `graph.predecessors`, and their cumulative market
+    shares are kept in padded arrays, and updated as suppliers are removed.
+
+    Parameters
+    ----------
+    `graphs`: list
+        The supply chain network of each lane, i.e., `SCNetwork.G`; they
+        share nodes, and may differ in edges and market shares.
+    """
+
+    def __init__(self, graphs):
+        self.graphs = graphs
+        num_nodes = graphs[0].number_of_nodes()
+        width = max([g.in_degree(n) for g in graphs for n in range(num_nodes)] + [1])
+        shape = (len(graphs), num_nodes, width)
+        self.suppliers = np.full(shape, -1, dtype=np.int64)
+        self.cum_shares = np.full(shape, np.inf)
+        self.num_suppliers = np.zeros(shape[:2], dtype=np.int64)
+        for lane in range(len(graphs)):
+            for n in range(num_nodes):
+                self._update(n, lane)
+
+
+    def _update(self, node, lane):
+        graph = self.graphs[lane]
+        sellers = list(graph.predecessors(node))
+        self.suppliers[lane, node] = -1
+        self.cum_shares[lane, node] = np.inf
+        self.num_suppliers[lane, node] = len(sellers)
+        if sellers:
+            self.suppliers[lane, node, :len(sellers)] = sellers
+            self.cum_shares[lane, node, :len(sellers)] = list(
+                itertools.accumulate(graph.nodes[s]["market_share"] for s in sellers))
+
+
+    def remove(self, node, lane=0):
+        """
+        Update the customers of `node`, after its edges are removed from the graph of `lane`.
+        """
+        for customer in np.flatnonzero((self.suppliers[lane] == node).any(axis=1)):
+            self._update(customer, lane)
+
+
+    def select(self, buyers, u, lanes=0):
+        """
+        Select a supplier for each of `buyers`, -1 for a buyer without suppliers.
+
+        Parameters
+        ----------
+        `buyers`: np.ndarray
+            The buyers.
+        `u`: np.ndarray
+            A uniform draw in [0, 1) per buyer.
+        `lanes`: int or np.ndarray
+            The lane of each buyer.
+        """
+        buyers = np.asarray(buyers, dtype=np.int64)
+        lanes = np.broadcast_to(np.asarray(lanes, dtype=np.int64), buyers.shape)
+        num_suppliers = self.num_suppliers[lanes, buyers]
+        cum_shares = self.cum_shares[lanes, buyers]
+        has_suppliers = num_suppliers > 0
+        last = np.maximum(num_suppliers - 1, 0)
+        total = cum_shares[np.arange(len(buyers)), last]
+        position = (cum_shares <= (u * total)[:, None]).sum(axis=1)
+        position = np.minimum(position, last)
+        selected = self.suppliers[lanes, buyers, position]
+        return np.where(has_suppliers, selected, -1)
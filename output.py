@@ -4,9 +4,17 @@ Author: Liming Xu
 Email: lx249@cam.ac.uk
 """
 
+import os
+import csv
+import io
+import queue
+import tempfile
+import threading
 import pandas as pd
 import numpy as np
 
+from trajectory import TrajectoryIndex, write_csv_block
+
 # The columns names and their dtypes.
 column_dtypes = [
     ("timestep", int),
@@ -32,13 +40,126 @@ column_dtypes = [
 ]
 columns = list(zip(*column_dtypes))[0]
 
+# The dtypes of columns as streamed in Parquet row groups, which must share a schema:
+# all but the keys are floats, as they are NaN for bankrupt nodes.
+written_dtypes = {
+    col: (dtype if col in ("timestep", "node_idx", "tier", "power", "is_bankrupt") else float)
+    for col, dtype in column_dtypes
+}
+
+
+
+# Output levels: 
+# `full` records every timestep; `sampled` records every k-th timestep; 
+# `summary` records no trajectory. All levels add a summary row to the results table.
+output_levels = ("full", "sampled", "summary")
+
+# Trajectory file formats. `parquet` needs the optional `pyarrow` package.
+output_formats = ("csv", "parquet")
+
+# The directory of output files, and the table shared by all simulations 
+# in it, one summary row per simulation.
+output_dir = "output_data"
+results_file = os.path.join(output_dir, "results.csv")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Writing Parquet output requires `pyarrow`, "
+                          "install it or set `output_format` to `csv`.")
+    return pa, pq
 
 
 class Writer(object):
+    """
+    Writer of the trajectory and summary of a simulation.
+
+    Parameters
+    ----------
+    `sim_id`: int or str
+        The simulation ID, which names the trajectory file.
+    `output_dir`: str
+        The directory of the trajectory file, and by default of the results table.
+    `level`: str
+        The output level, see `output_levels`.
+    `every`: int
+        Record every `every`-th timestep at the `sampled` level.
+    `file_format`: str
+        The trajectory file format, see `output_formats`.
+    `chunk_size`: int
+        The number of timesteps per Parquet row group, and per chunk in `background` mode.
+    `background`: bool
+        If True, stream chunks of `chunk_size` timesteps through a queue of at most
+        `max_chunks` chunks to a background thread that writes them, so that
+        simulation and disk writes overlap and memory stays bounded.
+        `write` then returns without waiting, and `close` blocks until all is written;
+        the thread is started by the first chunk, and ends once the writer is closed.
+    """
+
+    def __init__(self, sim_id, column_dtypes=column_dtypes, 
+                 level="full", every=1, output_dir=output_dir, results_file=None,
+                 file_format="csv", background=False, chunk_size=100, max_chunks=8):
+        if level not in output_levels:
+            raise ValueError(f"Output level must be one of {output_levels}, got '{level}'.")
+        if level == "sampled" and every < 1:
+            raise ValueError("`every` must be a positive integer.")
+        if file_format not in output_formats:
+            raise ValueError(f"Output format must be one of {output_formats}, got '{file_format}'.")
+        if file_format == "parquet" and level != "summary":
+            _import_pyarrow()
+        self.sim_id = sim_id
+        self.output_file = os.path.join(output_dir, f"output__sim_{sim_id}.{file_format}")
+        self.cascade_file = os.path.join(output_dir, f"cascade__sim_{sim_id}.json")
+        self.results_file = results_file or os.path.join(output_dir, "results.csv")
+        self.level = level
+        self.every = int(every) if level == "sampled" else 1
+        self.file_format = file_format
+        self.column_dtypes = column_dtypes
+        # Data are appended as chunks and concatenated once, when written
+        self.chunks = []
+
+        self.chunk_size = chunk_size
+        self.background = background and level != "summary"
+        if self.background:
+            self.pending = []
+            self.queue = queue.Queue(maxsize=max_chunks)
+            self.error = None
+            self.is_finished = False
+            self.is_closed = False
+            # Started by the first chunk, so that a writer never used leaves no thread behind
+            self.thread = None
+
+
+    @property
+    def written_file(self):
+        """
+        The trajectory file, None if no trajectory is written at the output level.
+        """
+        return None if self.level == "summary" else self.output_file
+
+
+    def is_recording(self, t):
+        """
+        Check if the data at timestep `t` are recorded at the output level.
+        """
+        if self.level == "full":
+            return True
+        elif self.level == "sampled":
+            return (t - 1) % self.every == 0
+        return False
+
 
-    def __init__(self, sim_id, column_dtypes=column_dtypes):
-        self.output_file = f"output_data/output__sim_{sim_id}.csv"
-        self.output = pd.DataFrame(np.empty(0, dtype=np.dtype(column_dtypes)))
+    @property
+    def output(self):
+        """
+        The output dataframe; in `background` mode, data are streamed to file instead.
+        """
+        empty = pd.DataFrame(np.empty(0, dtype=np.dtype(self.column_dtypes)))
+        self.chunks = [pd.concat([empty] + self.chunks, ignore_index=True)]
+        return self.chunks[0]
 
 
     def append(self, data_at_t):
@@ -50,12 +171,140 @@ class Writer(object):
         `data_at_t`: dict
             the output data at a time step.
         """
-        incoming_output = pd.DataFrame.from_dict(data_at_t)
-        self.output = pd.concat([self.output, incoming_output], ignore_index=True)
+        if not self.background:
+            self.chunks.append(pd.DataFrame.from_dict(data_at_t))
+            return
+        self.pending.append(data_at_t)
+        if len(self.pending) >= self.chunk_size:
+            self._put(self.pending)
+            self.pending = []
 
 
     def write(self):
-        self.output.to_csv(self.output_file, index=False)
-        
-    
-        
+        if self.level == "summary":
+            return
+        if self.background:
+            # Hand over the remaining data and the end-of-file marker, without waiting
+            if not self.is_finished:
+                if self.pending:
+                    self._put(self.pending)
+                    self.pending = []
+                self._put(None)
+                self.is_finished = True
+            return
+        output = self.output
+        if self.file_format == "parquet":
+            # Row groups of `chunk_size` timesteps, for random access by timestep
+            rows_per_t = max(1, int((output.timestep == output.timestep.min()).sum()))
+            output.to_parquet(self.output_file, index=False, 
+                              row_group_size=self.chunk_size * rows_per_t)
+        else:
+            index = TrajectoryIndex()
+            with open(self.output_file, "wb") as file:
+                write_csv_block(file, output, index, header=True)
+            index.save(self.output_file)
+
+
+    def close(self):
+        """
+        Write all data, blocking until the background thread has written them.
+        """
+        if not self.background or self.is_closed:
+            return
+        self.is_closed = True
+        self.write()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+    def _put(self, chunk):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._drain, name=f"writer-{self.sim_id}")
+            self.thread.start()
+        # Blocks while the queue is full, which bounds memory
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+    def _drain(self):
+        """
+        Background thread: write chunks from the queue until the end-of-file marker.
+        """
+        parquet_writer = None
+        csv_file = None
+        index = TrajectoryIndex()
+        try:
+            if self.file_format == "parquet":
+                pa, pq = _import_pyarrow()
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                frame = pd.concat([pd.DataFrame.from_dict(d) for d in chunk], ignore_index=True)
+                if self.file_format == "parquet":
+                    table = pa.Table.from_pandas(frame.astype(written_dtypes), preserve_index=False)
+                    if parquet_writer is None:
+                        parquet_writer = pq.ParquetWriter(self.output_file, table.schema)
+                    parquet_writer.write_table(table)
+                else:
+                    is_first = csv_file is None
+                    if is_first:
+                        csv_file = open(self.output_file, "wb")
+                    write_csv_block(csv_file, frame, index, header=is_first)
+            if csv_file is not None:
+                index.save(self.output_file)
+        except Exception as e:
+            # Raised in the simulation at its next `append` or `close`
+            self.error = e
+        finally:
+            if parquet_writer is not None:
+                parquet_writer.close()
+            if csv_file is not None:
+                csv_file.close()
+
+
+    def write_summary(self, summary):
+        """
+        Append the summary of a simulation as a row of the shared results table.
+        The header is written by whoever creates the file, and each row is 
+        appended in a single write, so that parallel simulations can share the table.
+        The file is created with its header in place, by linking a complete
+        temporary file, so that no row is appended before the header. Rows are
+        written by the columns of the existing header; a summary of other
+        columns, e.g., from an older engine or other `powers`, is refused
+        rather than appended under the wrong headers.
+
+        Parameters
+        ----------
+        `summary`: dict
+            The summary of a simulation, keyed by column names.
+        """
+        if not os.path.exists(self.results_file):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.results_file) or ".")
+            with os.fdopen(fd, "w", newline="") as file:
+                csv.writer(file).writerow(summary.keys())
+            try:
+                os.link(tmp_path, self.results_file)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+
+        with open(self.results_file, newline="") as file:
+            header = next(csv.reader(file), [])
+        if set(header) != set(summary):
+            raise ValueError(f"The columns of the results table {self.results_file} differ "
+                             f"from the summary: {sorted(set(header) ^ set(summary))}. "
+                             "Move the table away, or write to another `results_file`.")
+
+        row = io.StringIO()
+        csv.DictWriter(row, fieldnames=header).writerow(summary)
+        with open(self.results_file, "a", newline="") as file:
+            file.write(row.getvalue())
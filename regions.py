@@ -0,0 +1,193 @@
+"""
+Regional financing: nodes share the financing threshold of their n-hop region.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+The region of a node is itself and the nodes within `num_hops` hops of it,
+as suppliers or customers, not passing through dummy or bankrupt nodes.
+Regions are computed once, by breadth-first search over the adjacency in
+CSR form (`indptr`, `indices`). The network is covered by subregions, each
+the nodes of the region of a focal node not yet in another subregion, the
+focal nodes taken by degree; the focal node redefines its threshold as the
+mean over its subregion, and every node of it shares that threshold. Shares
+are kept as a sparse averaging matrix, also in CSR form, so that the regional
+thresholds of all nodes are a single sparse matrix-vector product per
+timestep. When a node goes bankrupt, only the regions that contained it are
+searched again, the nodes cut off from their focal node form new subregions,
+and only the rows of the matrix that changed are patched.
+"""
+
+import numpy as np
+
+
+def _to_csr(rows, num_nodes):
+    """
+    Pack a list of index arrays, one per row, into CSR `(indptr, indices)`.
+    """
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(r) for r in rows])
+    indices = np.concatenate(rows).astype(np.int64) if rows else np.zeros(0, dtype=np.int64)
+    return indptr, indices
+
+
+# How nodes share thresholds: the mean over the subregion of their focal node,
+# or the mean over their own region
+share_modes = ("focal", "mean")
+
+
+class RegionalThresholds(object):
+    """
+    Parameters
+    ----------
+    `graph`: nx.DiGraph
+        The supply chain network, i.e., `SCNetwork.G`.
+    `num_hops`: int
+        The radius of a region.
+    `excluded`: list
+        Nodes that are never in a region nor passed through, i.e., the dummy nodes.
+        Each of them forms a region of its own.
+    `share`: str
+        `focal` for the threshold of the focal node of a node's subregion,
+        or `mean` for the mean threshold over the node's own region.
+    """
+
+    def __init__(self, graph, num_hops, excluded=(), share="focal"):
+        if num_hops < 0:
+            raise ValueError("`num_hops` must be a non-negative integer.")
+        if share not in share_modes:
+            raise ValueError(f"Regional sharing must be one of {share_modes}, got '{share}'.")
+        self.num_hops = int(num_hops)
+        self.share = share
+        self.num_nodes = graph.number_of_nodes()
+        self.is_removed = np.zeros(self.num_nodes, dtype=bool)
+        self.is_removed[list(excluded)] = True
+        self.excluded = set(excluded)
+
+        # Undirected adjacency in CSR form
+        neighbours = [np.array(sorted(set(graph.predecessors(n)) | set(graph.successors(n))), dtype=np.int64)
+                      for n in range(self.num_nodes)]
+        self.adj_indptr, self.adj_indices = _to_csr(neighbours, self.num_nodes)
+        # Focal nodes are taken by degree, then by index
+        self.order = np.argsort(-np.diff(self.adj_indptr), kind="stable")
+
+        self.regions = [self._search(n) for n in range(self.num_nodes)]
+        self.focal = np.arange(self.num_nodes)
+        if self.share == "focal":
+            self._cover(np.flatnonzero(~self.is_removed))
+        self._build_matrix()
+
+
+    def _search(self, node):
+        """
+        Breadth-first search of the region of `node`, as a sorted index array.
+        """
+        if self.is_removed[node]:
+            return np.array([node], dtype=np.int64)
+        visited = np.zeros(self.num_nodes, dtype=bool)
+        visited[node] = True
+        frontier = np.array([node], dtype=np.int64)
+        for _ in range(self.num_hops):
+            if len(frontier) == 0:
+                break
+            starts, ends = self.adj_indptr[frontier], self.adj_indptr[frontier + 1]
+            reached = np.concatenate([self.adj_indices[s:e] for s, e in zip(starts, ends)])
+            reached = np.unique(reached[~visited[reached] & ~self.is_removed[reached]])
+            visited[reached] = True
+            frontier = reached
+        return np.flatnonzero(visited)
+
+
+    def _cover(self, nodes):
+        """
+        Cover `nodes` by subregions: in turn by degree, each node not yet covered
+        becomes a focal node, whose subregion is the nodes of its region not yet covered.
+        """
+        is_uncovered = np.zeros(self.num_nodes, dtype=bool)
+        is_uncovered[nodes] = True
+        for n in self.order[is_uncovered[self.order]]:
+            if not is_uncovered[n]:
+                continue
+            members = self.regions[n][is_uncovered[self.regions[n]]]
+            self.focal[members] = n
+            is_uncovered[members] = False
+
+
+    def _row(self, node):
+        """
+        The nodes whose thresholds `node` averages.
+        """
+        if self.share == "focal":
+            return np.flatnonzero(self.focal == self.focal[node])
+        return self.regions[node]
+
+
+    def _build_matrix(self):
+        """
+        Pack the rows into the CSR averaging matrix: row `i` holds
+        weight `1 / |row of i|` at each node of the row of `i`.
+        """
+        self.indptr, self.indices = _to_csr([self._row(n) for n in range(self.num_nodes)], self.num_nodes)
+        sizes = np.diff(self.indptr)
+        self.weights = np.repeat(1 / sizes, sizes)
+        self.rows = np.repeat(np.arange(self.num_nodes), sizes)
+
+
+    def _patch_matrix(self, changed):
+        """
+        Patch the rows `changed` of the averaging matrix. Removing a node only
+        shrinks rows, so their entries are masked out in place.
+        """
+        keep = np.ones(len(self.indices), dtype=bool)
+        for n in changed:
+            start, end = self.indptr[n], self.indptr[n + 1]
+            keep[start:end] = np.isin(self.indices[start:end], self._row(n))
+        self.indices = self.indices[keep]
+        self.rows = self.rows[keep]
+        sizes = np.bincount(self.rows, minlength=self.num_nodes)
+        self.indptr[1:] = np.cumsum(sizes)
+        self.weights = 1 / sizes[self.rows]
+
+
+    def remove(self, node):
+        """
+        Remove a bankrupt node: drop it from every region, and search again
+        the regions that contained it, as paths through it are cut. Nodes cut
+        off from their focal node, or all those of its subregion if it was a
+        focal node, are covered by new subregions.
+        """
+        if self.is_removed[node]:
+            return
+        self.is_removed[node] = True
+        # Regions are symmetric: those containing the node are of the nodes in its region
+        affected = self.regions[node]
+        for n in affected:
+            self.regions[n] = self._search(n)
+        # The bankrupt node keeps a region of its own
+        self.regions[node] = np.array([node], dtype=np.int64)
+
+        changed = [affected]
+        if self.share == "focal":
+            # Subregions that may have changed are of the focal nodes whose region did
+            focals = affected[self.focal[affected] == affected]
+            self.focal[node] = node
+            for f in focals:
+                members = np.flatnonzero(self.focal == f)
+                cut = members[members != node] if f == node else np.setdiff1d(members, self.regions[f])
+                # Covered apart from other subregions, so that every row only shrinks
+                self._cover(cut)
+                changed.append(members)
+        self._patch_matrix(np.unique(np.concatenate(changed)))
+
+
+    def thresholds(self, fts):
+        """
+        The regional financing thresholds, i.e., the mean threshold over the
+        subregion of the focal node of each node, or over its own region, by
+        a sparse matrix-vector product.
+
+        Parameters
+        ----------
+        `fts`: np.ndarray
+            The financing threshold of each node.
+        """
+        return np.bincount(self.rows, weights=self.weights * fts[self.indices], minlength=self.num_nodes)
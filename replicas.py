@@ -0,0 +1,259 @@
+"""
+Replica scheduling with variance reduction: common random numbers and
+antithetic demand paths for comparing paired scenarios.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+"""
+
+# %%
+import math
+import contextlib
+import io
+import tempfile
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from network import SCNetwork
+from simulation import SCFSimulation
+
+
+# %% Pre-drawn random streams of a simulation
+class ScenarioStreams(object):
+    """
+    Random streams driving a simulation, drawn before it runs.
+
+    `demands`: np.ndarray
+        Market demand at each timestep, indexed by `t - 1`.
+    `choices`: np.ndarray
+        Uniform draws in [0, 1) for supplier selection, indexed by `[t - 1, buyer]`,
+        so that a buyer uses the same draw at the same timestep in every scenario,
+        however differently the scenarios have evolved.
+    `power_draws`: np.ndarray
+        Uniform draws in [0, 1) for assigning node powers, indexed by node.
+    """
+
+    def __init__(self, demands, choices, power_draws):
+        self.demands = demands
+        self.choices = choices
+        self.power_draws = power_draws
+
+
+# %% Demand by inverse transform sampling
+def demand_path(distribution, uniforms, **params):
+    """
+    Transform uniform draws into positive, integer demands, distributed as
+    `simulation.get_demand` generates them. Draws `u` and `1 - u` give
+    antithetic demands.
+
+    Parameters
+    ----------
+    `distribution`: str
+        The demand distribution, `normal` or `poisson`.
+    `uniforms`: np.ndarray
+        Uniform draws in (0, 1), one per timestep.
+    """
+    # Keep draws away from 0 and 1, where the inverse CDF is unbounded
+    uniforms = np.clip(uniforms, 1e-12, 1 - 1e-12)
+
+    if distribution == "normal":
+        # `get_demand` redraws until int(x) > 0, i.e., x is truncated below at 1
+        dist = NormalDist(params["mean"], params["sigma"])
+        p_min = dist.cdf(1)
+        return np.array([int(dist.inv_cdf(p_min + u * (1 - p_min))) for u in uniforms])
+    elif distribution == "poisson":
+        lambda_value = params["lambda"]
+        demands = []
+        for u in uniforms:
+            k, p = 0, math.exp(-lambda_value)
+            cdf = p
+            while cdf < u:
+                k += 1
+                p *= lambda_value / k
+                cdf += p
+            demands.append(k)
+        return np.array(demands)
+    else:
+        raise ValueError(f"Unrecognised demand generator '{distribution}'!")
+
+
+def draw_streams(rng, t_max, num_nodes, distribution, antithetic=False, **params):
+    """
+    Draw the streams of one replica.
+
+    Returns
+    -------
+        list: A list of `ScenarioStreams`, holding one streams if not `antithetic`;
+        otherwise two, whose demand paths are antithetic, sharing supplier and
+        power draws.
+    """
+    demand_uniforms = rng.random(t_max)
+    choices = rng.random((t_max, num_nodes))
+    power_draws = rng.random(num_nodes)
+
+    streams = [ScenarioStreams(demand_path(distribution, demand_uniforms, **params),
+                               choices, power_draws)]
+    if antithetic:
+        streams.append(ScenarioStreams(demand_path(distribution, 1 - demand_uniforms, **params),
+                                       choices, power_draws))
+    return streams
+
+
+# %% Paired-difference estimator
+def paired_difference(results, scenario_a, scenario_b, metric, confidence=0.95):
+    """
+    Estimate the mean difference of `metric` between two scenarios run on common
+    random numbers, with its confidence interval. Antithetic twins of a replica
+    are averaged first, so that the estimator is made of independent replicas.
+    The interval uses the normal approximation, so it needs a fair number of replicas.
+
+    Parameters
+    ----------
+    `results`: pd.DataFrame
+        The results of `ReplicaScheduler.run`.
+    `scenario_a`, `scenario_b`: str
+        The names of the scenarios to compare, the difference is a - b.
+    `metric`: str
+        The column of `results` to compare.
+    `confidence`: float
+        The confidence level of the interval.
+
+    Returns
+    -------
+        dict: the mean difference, its standard error and confidence interval,
+        the number of replicas, and the ratio of the paired to the unpaired
+        variance of the estimator (below 1 means common random numbers helped).
+    """
+    pivot = results.pivot_table(index=["replica", "twin"], columns="scenario",
+                                values=metric, aggfunc="first")
+    per_replica = pivot.groupby(level="replica").mean()
+    diffs = per_replica[scenario_a] - per_replica[scenario_b]
+    n = len(diffs)
+    if n < 2:
+        raise ValueError("At least two replicas are needed to estimate the variance.")
+
+    mean = diffs.mean()
+    std_err = diffs.std(ddof=1) / math.sqrt(n)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    unpaired_var = per_replica[scenario_a].var(ddof=1) + per_replica[scenario_b].var(ddof=1)
+    return {
+        "metric": metric,
+        "difference": float(mean),
+        "std_err": float(std_err),
+        "ci_low": float(mean - z * std_err),
+        "ci_high": float(mean + z * std_err),
+        "confidence": confidence,
+        "num_replicas": n,
+        "variance_ratio": float(diffs.var(ddof=1) / unpaired_var) if unpaired_var > 0 else np.nan,
+    }
+
+
+# %% Replica scheduler
+class ReplicaScheduler(object):
+    """
+    Run paired scenarios on common random numbers.
+    Within a replica, every scenario is run on identical demand, supplier choice
+    and power assignment streams; with `antithetic`, each replica is also run on
+    its antithetic demand path.
+
+    Parameters
+    ----------
+    `topology`: str
+        The network topology.
+    `homogeneous`: bool
+        Node homogeneity.
+    `network_config`: dict
+        The network configurations.
+    `base_params`: dict
+        The input parameters shared by all scenarios, as accepted by `SCFSimulation`.
+    `scenarios`: dict
+        Keyed by scenario name, valued by the input parameters overriding
+        `base_params`, e.g., {"financed": {"financed": True}, "unfinanced": {"financed": False}}.
+    `num_replicas`: int
+        The number of replicas, i.e., independent draws of streams.
+    `antithetic`: bool
+        Whether to also run each replica on its antithetic demand path.
+    `seed`: int, optional
+        The seed of the streams.
+    `output_level`: str
+        The output level of the replicas, in place of that of `base_params`;
+        `summary` by default, as their metrics are returned by `run`.
+    `output_dir`: str, optional
+        The directory of the output files, by default a temporary directory,
+        removed when `run` returns.
+    """
+
+    def __init__(self,
+                 topology, homogeneous,
+                 network_config,
+                 base_params, scenarios,
+                 num_replicas,
+                 antithetic=False,
+                 seed=None,
+                 output_level="summary",
+                 output_dir=None):
+        self.topology = topology
+        self.homogeneous = homogeneous
+        self.network_config = network_config
+        self.base_params = base_params
+        self.scenarios = scenarios
+        self.num_replicas = num_replicas
+        self.antithetic = antithetic
+        self.output_level = output_level
+        self.output_dir = output_dir
+        self.rng = np.random.default_rng(seed)
+
+        network = SCNetwork(topology, homogeneous,
+                            base_params["powers"], base_params["market_shares"],
+                            network_config)
+        self.num_nodes = network.G.number_of_nodes()
+
+
+    @staticmethod
+    def metrics(sim):
+        """
+        Scalar outcomes of a finished simulation.
+        """
+        return {
+            "survival_time": sim.t_end,
+            "survived": float(sim.survived),
+            "num_bankrupt": len(sim.bankrupt_at),
+        }
+
+
+    def run(self, verbose=False):
+        """
+        Run all replicas of all scenarios.
+
+        Returns
+        -------
+            pd.DataFrame: One row per replica, twin and scenario, with the metrics.
+        """
+        rows = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = {"output_level": self.output_level, "output_dir": self.output_dir or tmp_dir}
+            for replica in range(self.num_replicas):
+                all_streams = draw_streams(self.rng,
+                                           self.base_params["t_max"],
+                                           self.num_nodes,
+                                           self.base_params["demand_distribution"],
+                                           self.antithetic,
+                                           **self.base_params["distribution_params"])
+                for twin, streams in enumerate(all_streams):
+                    for name, overrides in self.scenarios.items():
+                        params = {**self.base_params, **output, **overrides}
+                        sim = SCFSimulation(f"replica_{replica}_{twin}_{name}",
+                                            self.topology,
+                                            self.homogeneous,
+                                            self.network_config,
+                                            streams=streams,
+                                            **params)
+                        if verbose:
+                            sim.run()
+                        else:
+                            with contextlib.redirect_stdout(io.StringIO()):
+                                sim.run()
+                        rows.append({"replica": replica, "twin": twin, "scenario": name,
+                                     **self.metrics(sim)})
+        return pd.DataFrame(rows)
@@ -0,0 +1,321 @@
+"""
+Global sensitivity analysis of simulation outputs to their inputs:
+first-order and total-order Sobol indices, estimated from Saltelli sample
+matrices by the Jansen estimators, with bootstrap confidence intervals.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+For `d` inputs and `N` samples, the simulation is run at the rows of the
+matrices `A` and `B`, and of each `AB_i`, i.e., `A` with its `i`-th column
+taken from `B`, which is `N * (d + 2)` runs. The matrices are cut from one
+`2d`-dimensional sequence, so the first `N` samples are the same for any
+larger `N`, and runs cached from a smaller analysis are reused when extended.
+"""
+
+# %%
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from emulator import next_sim_id, sim_id_numbers
+from grid_search import execute, single_run_params
+from sweeps import integer_params, unit_samples
+from utils import load_config_file, make_seed_sequence, seed_to_str
+
+# Scalar outputs analysed by default, from the summary of a simulation
+default_metrics = ["t_end", "num_failed"]
+
+
+# %% Estimators
+def jansen_indices(f_A, f_B, f_AB):
+    """
+    Jansen estimators of the first-order and total-order indices.
+
+    Parameters
+    ----------
+    `f_A`, `f_B`: np.ndarray
+        The outputs at the rows of `A` and `B`, of shape `(N,)`.
+    `f_AB`: np.ndarray
+        The outputs at the rows of each `AB_i`, of shape `(N, d)`.
+
+    Returns
+    -------
+        tuple: The first-order and total-order indices, each of shape `(d,)`.
+    """
+    variance = np.var(np.concatenate([f_A, f_B]))
+    if variance == 0:
+        return np.full(f_AB.shape[1], np.nan), np.full(f_AB.shape[1], np.nan)
+    first_order = 1 - np.mean((f_B[:, None] - f_AB) ** 2, axis=0) / (2 * variance)
+    total_order = np.mean((f_A[:, None] - f_AB) ** 2, axis=0) / (2 * variance)
+    return first_order, total_order
+
+
+def bootstrap_indices(f_A, f_B, f_AB, num_bootstrap=1000, confidence=0.95, seed=None):
+    """
+    Percentile bootstrap confidence intervals of the indices, resampling the rows.
+
+    Returns
+    -------
+        tuple: The lower and upper bounds of the first-order and total-order
+        indices, i.e., `(first_low, first_high, total_low, total_high)`.
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = len(f_A)
+    first_order, total_order = [], []
+    for _ in range(num_bootstrap):
+        rows = rng.integers(num_samples, size=num_samples)
+        s1, st = jansen_indices(f_A[rows], f_B[rows], f_AB[rows])
+        first_order.append(s1)
+        total_order.append(st)
+    q = [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100]
+    first_low, first_high = np.nanpercentile(first_order, q, axis=0)
+    total_low, total_high = np.nanpercentile(total_order, q, axis=0)
+    return first_low, first_high, total_low, total_high
+
+
+# %% Analysis
+class SobolAnalysis(object):
+    """
+    Sobol sensitivity analysis of a simulation around a base config.
+
+    Parameters
+    ----------
+    `inputs`: dict
+        The inputs analysed, `{name: (low, high)}` for numeric inputs, or
+        `{name: [levels]}` for categorical inputs, e.g., `network_topology`
+        or `paradigm`, whose levels are equally likely. Names are config keys,
+        or `demand_mean` and `demand_sigma` for the demand distribution.
+    `base_config`: dict
+        The config of the other inputs, as enumerated by `grid_search.iter_sim_configs`.
+    `network_config`: dict
+        The network configurations.
+    `metrics`: list
+        The summary columns analysed.
+    `sampler`: str
+        `sobol` (needs `scipy`) or `random`.
+    `seed`: int
+        The seed of the sample matrices and of the simulations. The runs of a
+        row share a seed, so that the indices are not blurred by their noise.
+    `cache_file`: str, optional
+        The CSV file of finished runs, by default named after the analysis.
+    `first_sim_id`: int, optional
+        The `sim_id` number of the first row, by default the one recorded in
+        the cache, or else the one after the results table, see
+        `emulator.next_sim_id`. Row `i` is numbered `first_sim_id + i`, and
+        its runs are seeded by this number, as grid configs are by `sim_id`;
+        rows added by extending the analysis are numbered on from there.
+    """
+
+    samplers = ("sobol", "random")
+
+    def __init__(self, inputs, base_config, network_config,
+                 metrics=default_metrics, sampler="sobol", seed=0, cache_file=None,
+                 first_sim_id=None):
+        if sampler not in self.samplers:
+            raise ValueError(f"Unrecognised sampler '{sampler}', must be one of {self.samplers}.")
+        self.inputs = dict(inputs)
+        self.names = list(self.inputs)
+        self.base_config = base_config
+        self.network_config = network_config
+        self.metrics = list(metrics)
+        self.sampler = sampler
+        self.seed = seed
+
+        # Identify the analysis by everything that changes its runs
+        problem = json.dumps([{k: [type(v).__name__, list(v)] for k, v in self.inputs.items()},
+                              base_config, sampler, seed],
+                             sort_keys=True, default=str)
+        self.key = hashlib.sha1(problem.encode()).hexdigest()[:12]
+        self.cache_file = cache_file or f"output_data/sensitivity_{self.key}.csv"
+        self.first_sim_id = self._resolve_first_sim_id(first_sim_id)
+
+
+    def _resolve_first_sim_id(self, first_sim_id):
+        """
+        The `sim_id` number of the first row, which must agree with the cache,
+        whose runs were seeded by it.
+        """
+        cached = self.load_cache()
+        if len(cached) and "sim_id" in cached:
+            first = cached.iloc[0]
+            recorded = int(sim_id_numbers([first["sim_id"]])[0]) - int(first["row"])
+            if first_sim_id is not None and first_sim_id != recorded:
+                raise ValueError(f"The runs in {self.cache_file} are numbered from sim_id "
+                                 f"{recorded}, not {first_sim_id}.")
+            return recorded
+        return next_sim_id() if first_sim_id is None else first_sim_id
+
+
+    def matrices(self, num_samples):
+        """
+        The sample matrices `A` and `B` in the unit hypercube, each of shape `(N, d)`.
+        """
+        d = len(self.names)
+        samples = unit_samples(self.sampler, num_samples, 2 * d, self.seed)
+        return samples[:, :d], samples[:, d:]
+
+
+    def _config(self, row, matrix, unit):
+        """
+        The config of a run from a row of unit samples.
+        """
+        config = dict(self.base_config)
+        config["distribution_params"] = dict(config["distribution_params"])
+        for name, u in zip(self.names, unit):
+            domain = self.inputs[name]
+            if isinstance(domain, tuple):
+                low, high = domain
+                value = low + u * (high - low)
+                value = int(round(value)) if name in integer_params else float(value)
+            else:
+                value = domain[min(int(u * len(domain)), len(domain) - 1)]
+            if name in ("demand_mean", "demand_sigma"):
+                config["distribution_params"][name[len("demand_"):]] = value
+            else:
+                config[name] = value
+        config["sim_id"] = f"{self.first_sim_id + row}_sa_{self.key}_{matrix}"
+        config["output_level"] = "summary"
+        config["seed"] = seed_to_str(np.random.SeedSequence(
+            make_seed_sequence(self.seed).entropy, spawn_key=(self.first_sim_id + row,)))
+        return config
+
+
+    def runs(self, num_samples):
+        """
+        The runs of the analysis, keyed by `(row, matrix)`, where `matrix`
+        is `A`, `B`, or the index `i` of `AB_i`.
+        """
+        A, B = self.matrices(num_samples)
+        runs = {}
+        for row in range(num_samples):
+            runs[(row, "A")] = self._config(row, "A", A[row])
+            runs[(row, "B")] = self._config(row, "B", B[row])
+            for i in range(len(self.names)):
+                AB = A[row].copy()
+                AB[i] = B[row, i]
+                runs[(row, str(i))] = self._config(row, str(i), AB)
+        return runs
+
+
+    def load_cache(self):
+        """
+        The finished runs, one row per run, with their metrics.
+        """
+        if not os.path.exists(self.cache_file):
+            return pd.DataFrame(columns=["row", "matrix", "sim_id"] + self.metrics)
+        return pd.read_csv(self.cache_file, dtype={"matrix": str, "sim_id": str})
+
+
+    def run(self, num_samples, executor=None, batch_size=64, catalogue=None, verbose=False):
+        """
+        Run the analysis with `num_samples` rows, skipping the runs in the cache.
+        Runs are dispatched in batches, in parallel if given a process pool
+        `executor`, and appended to the cache as each batch finishes, so that
+        an interrupted or extended analysis resumes where it stopped.
+
+        Returns
+        -------
+            pd.DataFrame: The outputs of all runs of the analysis.
+        """
+        cached = self.load_cache()
+        done = set(zip(cached["row"], cached["matrix"]))
+        todo = [(key, config) for key, config in self.runs(num_samples).items() if key not in done]
+
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            if verbose:
+                summaries = execute([config for _, config in batch], self.network_config, executor,
+                                    catalogue, return_summaries=True)
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    summaries = execute([config for _, config in batch], self.network_config, executor,
+                                        catalogue, return_summaries=True)
+            outputs = pd.DataFrame([{"row": row, "matrix": matrix, "sim_id": config["sim_id"],
+                                     **{m: float(s[m]) for m in self.metrics}}
+                                    for ((row, matrix), config), s in zip(batch, summaries)])
+            outputs.to_csv(self.cache_file, mode="a", index=False,
+                           header=not os.path.exists(self.cache_file))
+        cached = self.load_cache()
+        return cached[cached["row"] < num_samples].reset_index(drop=True)
+
+
+    def indices(self, num_samples, num_bootstrap=1000, confidence=0.95):
+        """
+        The first-order (`S1`) and total-order (`ST`) indices of each input,
+        for each metric, with their bootstrap confidence intervals, from the
+        cached runs of the first `num_samples` rows.
+
+        Returns
+        -------
+            pd.DataFrame: One row per metric and input.
+        """
+        outputs = self.load_cache()
+        outputs = outputs[outputs["row"] < num_samples].drop_duplicates(["row", "matrix"])
+        matrices = ["A", "B"] + [str(i) for i in range(len(self.names))]
+        if len(outputs) < num_samples * len(matrices):
+            raise ValueError(f"The analysis has not finished {num_samples} samples, call `run` first.")
+
+        rows = []
+        for metric in self.metrics:
+            table = outputs.pivot(index="row", columns="matrix", values=metric)[matrices].to_numpy()
+            f_A, f_B, f_AB = table[:, 0], table[:, 1], table[:, 2:]
+            first_order, total_order = jansen_indices(f_A, f_B, f_AB)
+            first_low, first_high, total_low, total_high = bootstrap_indices(
+                f_A, f_B, f_AB, num_bootstrap, confidence, self.seed)
+            for i, name in enumerate(self.names):
+                rows.append({
+                    "metric": metric, "input": name,
+                    "S1": first_order[i], "S1_low": first_low[i], "S1_high": first_high[i],
+                    "ST": total_order[i], "ST_low": total_low[i], "ST_high": total_high[i],
+                })
+        return pd.DataFrame(rows)
+
+
+def _parse_domain(value):
+    """
+    Parse `low:high` into a numeric range, or `a,b,c` into categorical levels.
+    """
+    if ":" in value:
+        low, high = (float(x) for x in value.split(":"))
+        return (low, high)
+    return [yaml.safe_load(x) for x in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sobol sensitivity analysis around the single-run config.")
+    parser.add_argument("inputs", nargs="+",
+                        help="Inputs as `name=low:high` or `name=a,b`, e.g., "
+                             "`bank_annual_rate=1.01:1.2 paradigm=reactive,proactive`.")
+    parser.add_argument("--config", default="configs/simulation_config.yaml", help="The base config.")
+    parser.add_argument("--samples", default=64, type=int, help="The number of samples N.")
+    parser.add_argument("--metrics", nargs="+", default=default_metrics)
+    parser.add_argument("--sampler", default="sobol", choices=SobolAnalysis.samplers)
+    parser.add_argument("--workers", default=1, type=int, help="Number of worker processes.")
+    parser.add_argument("--batch-size", default=64, type=int, help="Number of runs per batch.")
+    parser.add_argument("--first-sim-id", default=None, type=int,
+                        help="The sim_id of the first row, by default the one after the results table.")
+    args = parser.parse_args()
+
+    network_config = load_config_file("configs/network_config.yaml")
+    sim_id, topology, homogeneous, params = single_run_params(load_config_file(args.config))
+    base_config = {"sim_id": sim_id, "network_topology": topology, "homogeneous": homogeneous, **params}
+    inputs = dict(i.split("=", 1) for i in args.inputs)
+    inputs = {name: _parse_domain(value) for name, value in inputs.items()}
+
+    analysis = SobolAnalysis(inputs, base_config, network_config, args.metrics, args.sampler,
+                             first_sim_id=args.first_sim_id)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        analysis.run(args.samples, executor, args.batch_size)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print(analysis.indices(args.samples).round(3).to_string())
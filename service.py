@@ -0,0 +1,442 @@
+"""
+A long-lived local simulation service, so that small what-if runs do not pay
+for imports and network construction every time.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+The service listens over HTTP on localhost, or on a Unix socket, and runs
+simulations on a pool of worker processes kept warm, i.e., with the simulation
+modules imported and the templates of the networks built, so that a network
+is copied rather than built from its topology files. Responses are streamed
+as NDJSON, one JSON object per line:
+    {"type": "accepted", "job_id": ..., "num_sims": ...}
+    {"type": "trajectory", "sim_id": ..., "rows": [...]}   chunks of a trajectory, if requested,
+                                                           once its simulation has finished
+    {"type": "summary", ...}                               one per simulation, as they finish
+    {"type": "done" | "cancelled" | "error", ...}
+
+Endpoints:
+    GET  /health            the pool size and the running jobs
+    POST /simulate          run a config: {"config": {...}, "trajectory": false, "chunk_size": 100};
+                            the trajectory is not streamed as the simulation runs, but
+                            read back from its file after it finishes, then sent in
+                            chunks of `chunk_size` timesteps before the summary
+    POST /sweep             run configs: {"configs": [{...}, ...]}, or the Cartesian product
+                            {"base": {...}, "sweep": {"name": [values], ...}}
+    POST /cancel/<job_id>   cancel a job
+Configs are flat, as enumerated by `grid_search.iter_sim_configs`, and fill in
+the missing parameters from `configs/simulation_config.yaml`.
+
+Back-pressure: a job keeps at most `2 * workers` simulations in flight, and
+submits more only as finished summaries are written to the client, so a slow
+client slows its job down instead of piling up results. Cancellation, by
+`/cancel` or by the client disconnecting, drops the job's pending simulations;
+those already running finish, and their results are discarded.
+"""
+
+# %%
+import argparse
+import contextlib
+import http.client
+import io
+import itertools
+import json
+import math
+import os
+import re
+import socket
+import socketserver
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from grid_search import run_and_summarise, single_run_params
+from trajectory import TrajectoryReader
+from utils import load_config_file
+
+network_config_file = "configs/network_config.yaml"
+default_config_file = "configs/simulation_config.yaml"
+
+
+# %% Workers
+def _warm_up(network_config, topologies):
+    """
+    Initialise a worker: import the simulation modules, and build the network templates.
+    """
+    from network import _get_template
+    for topology in topologies:
+        _get_template(network_config["edges_file"].format(topology=topology),
+                      network_config["nodes_file"].format(topology=topology))
+
+
+def _ping():
+    return os.getpid()
+
+
+def _run_quietly(config, network_config):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return run_and_summarise(config, network_config)
+
+
+def _to_json_line(obj):
+    """
+    Encode an object as a line of JSON, with NaNs as nulls and numpy values as Python's.
+    """
+    def clean(x):
+        if isinstance(x, dict):
+            return {k: clean(v) for k, v in x.items()}
+        if isinstance(x, (list, tuple)):
+            return [clean(v) for v in x]
+        if isinstance(x, np.generic):
+            x = x.item()
+        if isinstance(x, float) and math.isnan(x):
+            return None
+        return x
+    return (json.dumps(clean(obj), default=str) + "\n").encode()
+
+
+# %% Service
+class SimulationService(object):
+    """
+    Parameters
+    ----------
+    `workers`: int
+        The number of worker processes.
+    `output_dir`: str
+        The directory of trajectory files and of the results table.
+    """
+
+    def __init__(self, workers=2, output_dir="output_data"):
+        self.network_config = load_config_file(network_config_file)
+        sim_id, topology, homogeneous, params = single_run_params(load_config_file(default_config_file))
+        self.default_config = {"network_topology": topology, "homogeneous": homogeneous, **params}
+        self.workers = workers
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.max_in_flight = 2 * workers
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=_warm_up,
+                                            initargs=(self.network_config, ["lattice", "diamond"]))
+        # Start all workers now, rather than at the first request
+        for future in [self.executor.submit(_ping) for _ in range(workers)]:
+            future.result()
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+    def make_config(self, overrides, job_id, i):
+        """
+        The config of a request. The `sim_id` and `network_topology` name files,
+        so those given by a client must be plain names, e.g., not `../x`.
+        """
+        config = {**self.default_config, **overrides}
+        config.setdefault("sim_id", f"{job_id}_{i}")
+        for name in ("sim_id", "network_topology"):
+            if not re.fullmatch(r"[A-Za-z0-9_-]+", str(config[name])):
+                raise ValueError(f"`{name}` must be letters, digits, `_` or `-`, got '{config[name]}'.")
+        config["output_dir"] = self.output_dir
+        return config
+
+
+    def expand(self, request, job_id):
+        """
+        The configs of a sweep request.
+        """
+        if "configs" in request:
+            overrides = request["configs"]
+        else:
+            base = request.get("base", {})
+            sweep = request.get("sweep", {})
+            overrides = [{**base, **dict(zip(sweep, values))}
+                         for values in itertools.product(*sweep.values())]
+        return [self.make_config({"output_level": "summary", **o}, job_id, i)
+                for i, o in enumerate(overrides)]
+
+
+    def open_job(self):
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.jobs[job_id] = threading.Event()
+        return job_id, self.jobs[job_id]
+
+
+    def close_job(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+
+    def cancel(self, job_id):
+        with self.lock:
+            cancelled = self.jobs.get(job_id)
+        if cancelled is None:
+            return False
+        cancelled.set()
+        return True
+
+
+    def run(self, configs, cancelled, send, trajectory=False, chunk_size=100):
+        """
+        Run configs on the pool, sending each summary as it finishes, and the
+        trajectory in chunks of `chunk_size` timesteps if requested. The
+        trajectory is read from its file once the simulation has finished, as
+        the workers write it, so its first chunk arrives only then.
+        Submits at most `max_in_flight` simulations ahead of the client.
+
+        Returns
+        -------
+            bool: False if cancelled.
+        """
+        pending = iter(configs)
+        in_flight = set()
+        try:
+            while True:
+                while not cancelled.is_set() and len(in_flight) < self.max_in_flight:
+                    config = next(pending, None)
+                    if config is None:
+                        break
+                    in_flight.add(self.executor.submit(_run_quietly, config, self.network_config))
+                if cancelled.is_set() or not in_flight:
+                    break
+                done, in_flight = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    config, summary, runtime, output_path, seed = future.result()
+                    if trajectory and output_path is not None:
+                        reader = TrajectoryReader(output_path)
+                        for _, frame in _iter_blocks(reader, chunk_size):
+                            if cancelled.is_set():
+                                break
+                            send({"type": "trajectory", "sim_id": summary["sim_id"],
+                                  "rows": frame.to_dict("records")})
+                    send({"type": "summary", "runtime": runtime, **summary})
+        finally:
+            for future in in_flight:
+                future.cancel()
+        return not cancelled.is_set()
+
+
+def _iter_blocks(reader, block_size):
+    """
+    Read a trajectory in blocks of `block_size` timesteps.
+    """
+    if len(reader.timesteps) == 0:
+        return
+    for start in range(int(reader.timesteps[0]), reader.max_timestep + 1, block_size):
+        yield start, reader.frames(start, start + block_size - 1)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+    def send_json(self, status, obj):
+        body = _to_json_line(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        if self.path == "/health":
+            with self.service.lock:
+                jobs = list(self.service.jobs)
+            self.send_json(200, {"status": "ok", "workers": self.service.workers, "jobs": jobs})
+        else:
+            self.send_json(404, {"type": "error", "message": f"Unknown path '{self.path}'."})
+
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self.send_json(400, {"type": "error", "message": f"Invalid JSON: {e}"})
+            return
+
+        if self.path.startswith("/cancel/"):
+            job_id = self.path[len("/cancel/"):]
+            found = self.service.cancel(job_id)
+            self.send_json(200 if found else 404, {"type": "cancel", "job_id": job_id, "found": found})
+            return
+        if self.path not in ("/simulate", "/sweep"):
+            self.send_json(404, {"type": "error", "message": f"Unknown path '{self.path}'."})
+            return
+
+        job_id, cancelled = self.service.open_job()
+        try:
+            if self.path == "/simulate":
+                trajectory = bool(request.get("trajectory", False))
+                overrides = {"output_level": "full" if trajectory else "summary",
+                             **request.get("config", {})}
+                configs = [self.service.make_config(overrides, job_id, 0)]
+            else:
+                trajectory = False
+                configs = self.service.expand(request, job_id)
+        except Exception as e:
+            self.service.close_job(job_id)
+            self.send_json(400, {"type": "error", "message": str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(obj):
+            line = _to_json_line(obj)
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            send({"type": "accepted", "job_id": job_id, "num_sims": len(configs)})
+            try:
+                finished = self.service.run(configs, cancelled, send, trajectory,
+                                            int(request.get("chunk_size", 100)))
+                send({"type": "done" if finished else "cancelled", "job_id": job_id})
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                send({"type": "error", "job_id": job_id, "message": str(e)})
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client has gone: drop the rest of the job
+            cancelled.set()
+            self.close_connection = True
+        finally:
+            self.service.close_job(job_id)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host="127.0.0.1", port=8765, unix_socket=None):
+    """
+    Serve until interrupted, on `host:port` or on `unix_socket`.
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, ServiceHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        server.daemon_threads = True
+    server.service = service
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.shutdown()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+# %% Client
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_socket = path
+
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_socket)
+
+
+class Client(object):
+    """
+    Client of the service, e.g., from a notebook.
+    `client.sweep(base={...}, sweep={"bank_annual_rate": [1.01, 1.05]})` yields the
+    messages of the response as they arrive; stopping the iteration cancels the job.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, unix_socket=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+
+
+    def _connect(self):
+        if self.unix_socket:
+            return UnixHTTPConnection(self.unix_socket, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+
+    def _stream(self, path, payload):
+        conn = self._connect()
+        try:
+            conn.request("POST", path, body=json.dumps(payload),
+                         headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            for line in response:
+                yield json.loads(line)
+        finally:
+            conn.close()
+
+
+    def health(self):
+        conn = self._connect()
+        try:
+            conn.request("GET", "/health")
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+
+    def simulate(self, trajectory=False, chunk_size=100, **config):
+        return self._stream("/simulate", {"config": config, "trajectory": trajectory,
+                                          "chunk_size": chunk_size})
+
+
+    def sweep(self, configs=None, base=None, sweep=None):
+        payload = {"configs": configs} if configs is not None else {"base": base or {},
+                                                                     "sweep": sweep or {}}
+        return self._stream("/sweep", payload)
+
+
+    def cancel(self, job_id):
+        conn = self._connect()
+        try:
+            conn.request("POST", f"/cancel/{job_id}", body=b"{}")
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the local simulation service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8765, type=int)
+    parser.add_argument("--unix-socket", default=None, help="Serve on this Unix socket instead.")
+    parser.add_argument("--workers", default=2, type=int, help="Number of worker processes.")
+    parser.add_argument("--output-dir", default="output_data",
+                        help="Directory of trajectory files and the results table.")
+    args = parser.parse_args()
+
+    service = SimulationService(args.workers, args.output_dir)
+    where = args.unix_socket or f"http://{args.host}:{args.port}"
+    print(f"Serving simulations on {where} with {args.workers} warm workers.")
+    serve(service, args.host, args.port, args.unix_socket)
@@ -8,38 +8,38 @@ Email: lx249@cam.ac.uk
 import numpy as np
 import pandas as pd
 import networkx as nx
-import random
 
 # Self-defined modules
 from network import SCNetwork
-from output import columns, Writer
+from output import columns, output_dir, Writer
+from convergence import SteadyStateDetector
+from forecasting import get_forecaster
+from regions import RegionalThresholds
+from cascades import CascadeTracer
+from orders import OrderBook, SupplierChoice, last_occurrences
+from memory import MemoryProfiler, report_columns
+from utils import make_seed_sequence, seed_to_str
 
-
-# %% Supplier selection: select a node with as the supplier
-def select_seller(graph, buyer):
-    sellers = list(graph.predecessors(buyer))
-    num_sellers = len(sellers)
-    if num_sellers == 0:
-        return -1
-    elif num_sellers == 1:
-        return sellers[0]
-    else:  # >= 1
-        market_shares = [ graph.nodes[s]["market_share"] for s in sellers ]
-        selected, = random.choices(sellers, weights=market_shares)
-        return selected
+# Version of the simulation engine, bumped whenever simulation results change.
+ENGINE_VERSION = "1.3"
 
 
 # %% Randomly generate positive, integer amount of demands.
-def get_demand(distribution, **params):
+def get_demand(distribution, rng=None, **params):
+    """
+    `rng`: np.random.Generator, optional
+        The random stream to draw from; the global `np.random` if None.
+    """
+    rng = np.random if rng is None else rng
 
     # Normal demand generator
     def normal(mean, sigma):
-        d = int(np.random.normal(mean, sigma))
+        d = int(rng.normal(mean, sigma))
         return (d if d > 0 else normal(mean, sigma))
 
     # Poisson demand generator
     def poisson(lambda_value):
-        return np.random.poisson(lambda_value)
+        return rng.poisson(lambda_value)
 
     if distribution == "normal":
         mean = params["mean"]
@@ -64,8 +64,9 @@ def get_max_debt(cash, power):
         The cash at current timestep.
     `power`: int 
         The power of the node. 
+    Also of arrays of nodes, as in `lanes.py`.
     """
-    return max(cash * (power + 1), 0)
+    return np.maximum(cash * (power + 1), 0)
 
 
 # %% Bank financing: return the amount of loan approaved
@@ -90,15 +91,15 @@ def get_loan(approach, **params):
 
     Returns
     -------
-        float: The allowed amount of loan.
+        float: The allowed amount of loan; an array of them, given arrays, as in `lanes.py`.
     """
 
     def old(cash, max_debt, debt):
-        allowed_loan = min(abs(cash), max_debt - debt)
-        return max(0, allowed_loan)
+        allowed_loan = np.minimum(np.abs(cash), max_debt - debt)
+        return np.maximum(0, allowed_loan)
 
     def new(cash, max_debt, debt, ft):
-        return max(min(max_debt - debt, ft - cash), 0)
+        return np.maximum(np.minimum(max_debt - debt, ft - cash), 0)
 
     cash = params["cash"]
     max_debt = params["max_debt"]
@@ -118,48 +119,37 @@ def interest_to_pay(loan, annual_rate, borrow_period=120):
 
 # %% Check if the node is illiuid and expects no profits
 def is_bankrupt(cash_available, total_receiveable, total_payable):
-    return cash_available <= 0 and total_receiveable < total_payable
+    return (cash_available <= 0) & (total_receiveable < total_payable)
 
 
 # %% Select a financing threshold (ft).
-def ft_forecast(costs, method="MA"):
+def ft_forecast(costs, method="MA", **params):
     """
-    Compute the financing threshold using moving cost average.
+    Compute the financing threshold by forecasting costs, e.g., moving cost average.
 
     Parameters
     ----------
     `costs`: list
         A list of cost at the past timestep
     `method`: str
-        The name of time series forecasting method.
+        The name of time series forecasting method: `MA`, `EWMA` or `Holt`.
     """
-    return sum(costs) / len(costs)
+    forecaster = get_forecaster(method, 1, len(costs), **params)
+    for cost in costs:
+        forecaster.update(np.array([cost]))
+    return forecaster.forecast()[0]
 
 
-def max_payment_delay(powers):
+def spawn_seed_sequences(seed):
     """
-    Allowed payment delay between two nodes.
+    Spawn the seeds of independent random streams of a simulation.
+    They are spawned from a fresh copy of the seed, so they depend on the seed only.
 
-    Parameters
-    ----------
-    `powers`: list
-        A list of company powers.
-    
     Returns
     -------
-        The payment delay matrix two nodes of different powers.
+        tuple: The SeedSequences for power assignment, demand, and supplier choice.
     """
-    # Anonymous function to calculate payment delay 
-    # between a buyer with power p_b and a seller with power p_s
-    def _delay(p_b, p_s): return max(30 * (p_b - p_s) + 60, 30)
-
-    num_powers = len(powers)
-    payment_delay_matrix = np.zeros((num_powers, num_powers), dtype=int)
-    (rows, cols) = payment_delay_matrix.shape
-    for i in range(rows):
-        for j in range(cols):
-            payment_delay_matrix[i, j] = _delay(i + 1, j + 1)
-    return payment_delay_matrix    
+    return tuple(make_seed_sequence(seed).spawn(3))
 
 
 class SCFSimulation(object):
@@ -172,17 +162,51 @@ class SCFSimulation(object):
                  topology, 
                  homogeneous,
                  network_config, 
+                 streams=None,
+                 seed=None,
                  **input_params):
+        """
+        `streams`: ScenarioStreams, optional
+            Pre-drawn random streams for demand, supplier choice and power 
+            assignment (see `replicas.py`). Simulations given the same streams
+            face identical demand and supplier choices, i.e., common random numbers.
+        `seed`: int, str, SeedSequence, optional
+            Seed of the simulation, see `utils.make_seed_sequence`. Independent 
+            random streams for demand, supplier choice and power assignment are
+            spawned from it, unless `streams` are given. If None, fresh entropy
+            is used, which is recorded in `seed` so the run can be repeated.
+        """
+
+        # Optional memory profiling, `tracemalloc` or `rss`, sampled at the phase boundaries of `run`
+        self.memory = None
+        if input_params.get("memory_profile"):
+            self.memory = MemoryProfiler(input_params["memory_profile"])
 
         self.sim_id = sim_id  
-        # Define a writer for storing runtime data.
-        self.writer = Writer(sim_id)
+        self.topology = topology
+        self.homogeneous = homogeneous
+        self.streams = streams
+        self.seed = seed_to_str(make_seed_sequence(seed))
+        power_seq, demand_seq, choice_seq = spawn_seed_sequences(self.seed)
+        self.demand_rng = np.random.default_rng(demand_seq)
+        self.choice_rng = np.random.default_rng(choice_seq)
+        # Define a writer for storing runtime data, 
+        # at the output level `full`, `sampled` (every k-th timestep) or `summary`;
+        # with `output_background`, data are written by a background thread as the run goes.
+        self.writer = Writer(sim_id,
+                             level=input_params.get("output_level") or "full",
+                             every=input_params.get("output_every") or 1,
+                             output_dir=input_params.get("output_dir") or output_dir,
+                             file_format=input_params.get("output_format") or "csv",
+                             background=bool(input_params.get("output_background")))
 
         self.network = SCNetwork(topology, 
                                  homogeneous,
                                  input_params["powers"],
                                  input_params["market_shares"],
-                                 network_config)
+                                 network_config,
+                                 power_draws=None if streams is None else streams.power_draws,
+                                 seed=power_seq)
 
         self.t_max               = input_params["t_max"]
         self.financed            = input_params["financed"]
@@ -193,99 +217,285 @@ class SCFSimulation(object):
         self.invoice_annual_rate = input_params["invoice_annual_rate"]
         self.invoice_term        = input_params["invoice_term"]
         self.window_size         = input_params["window_size"]
+        self.forecast_method     = input_params.get("forecast_method", "MA")
+        self.forecast_params     = input_params.get("forecast_params") or {}
         self.powers              = input_params["powers"]
+        self.market_shares       = input_params["market_shares"]
         self.demand_distribution = input_params["demand_distribution"]
         self.distribution_params = input_params["distribution_params"]
-
-        self.payment_delay_matrix = max_payment_delay(input_params["powers"])
+        # Optional early stopping, e.g., {"window_size": 100, "cash_tolerance": 0}
+        self.convergence         = input_params.get("convergence")
+        # Optional regional financing, e.g., {"num_hops": 2, "share": "focal"}
+        self.regional_financing  = input_params.get("regional_financing")
+        # Optional order book settings, e.g., {"market_orders": 4, "shared_stock": True}
+        order_book               = input_params.get("order_book") or {}
+        self.market_orders       = int(order_book.get("market_orders", 1))
+        self.shared_stock        = bool(order_book.get("shared_stock", False))
+        if self.market_orders < 1:
+            raise ValueError("`market_orders` must be a positive integer.")
+        if streams is not None and self.market_orders > 1:
+            raise ValueError("Pre-drawn streams hold one market order per timestep.")
+
+        self.payment_delay_matrix = self.network.payment_delay_matrix
         self.max_payment_delay = self.payment_delay_matrix.max()
         self.G = self.network.G
         self.num_nodes = self.G.number_of_nodes()
 
+        # Result of the run: the last timestep, the reason to stop,
+        # and the timestep at which each bankrupt node failed.
+        self.t_end = None
+        self.stop_reason = None
+        self.bankrupt_at = {}
+        self.total_loans = 0
+        self.total_discounts = 0
+        # Which failures each bankruptcy exposed other firms to
+        self.cascades = CascadeTracer(self.G, excluded=[self.network.dummy_raw_material,
+                                                        self.network.dummy_market])
+        # Stock, unfilled and issued orders of each node, kept as arrays during the run
+        # and written back into the graph when it stops
+        self.stock = np.array([self.G.nodes[n]["stock"] for n in range(self.num_nodes)], dtype=np.int64)
+        self.unfilled = np.array([self.G.nodes[n]["unfilled"] for n in range(self.num_nodes)], dtype=np.int64)
+        self.issued = np.array([self.G.nodes[n]["issued"] for n in range(self.num_nodes)], dtype=np.int64)
+
+
+    @property
+    def survived(self):
+        """
+        Whether the network survived the run, i.e., it did not become unconnected.
+        A survived run is right-censored at `t_end`, either because it reached
+        `t_max` or because it stopped early at steady state.
+        """
+        return self.stop_reason in ("t_max", "converged")
+
+
+    def _get_demand(self, t):
+        """
+        Market demand at timestep `t`, from the pre-drawn stream if given.
+        """
+        if self.streams is not None:
+            return int(self.streams.demands[t-1])
+        return get_demand(self.demand_distribution, self.demand_rng, **self.distribution_params)
+
+
+    def _select_sellers(self, t, buyers, suppliers):
+        """
+        Select a seller of each of `buyers` at timestep `t`, from the pre-drawn stream if given.
+        """
+        if self.streams is not None:
+            u = self.streams.choices[t-1, buyers]
+        else:
+            u = self.choice_rng.random(len(buyers))
+        return suppliers.select(buyers, u)
+
+
+    def _checkpoint(self, phase):
+        """
+        Attribute the memory used since the last checkpoint to `phase`, if profiled.
+        """
+        if self.memory is not None:
+            self.memory.checkpoint(phase)
+
+
+    def _stop(self, t, reason):
+        """
+        Record the end of the run and write runtime data into file.
+        """
+        self.t_end = t
+        self.stop_reason = reason
+        for name, values in (("stock", self.stock), ("unfilled", self.unfilled), ("issued", self.issued)):
+            nx.set_node_attributes(self.G, dict(enumerate(values.tolist())), name)
+        self.writer.write()
+        self.writer.close()
+        # The cascade tree, with its edges, is exported alongside the trajectory;
+        # at every output level, the summary holds the parents of its failures
+        if self.writer.written_file is not None:
+            self.cascades.save(self.writer.cascade_file, self.sim_id)
+        if self.memory is not None:
+            self.memory.checkpoint("write")
+            self.memory.stop()
+        self.writer.write_summary(self.summary())
+
+
+    def summary(self):
+        """
+        Summarise the run into a single row: the input parameters, survival time,
+        which nodes failed and when, failures by power and by tier, and 
+        the total amount of bank loans and invoice discounts, and the peak memory if profiled.
+        """
+        failed_nodes = sorted(self.bankrupt_at.items(), key=lambda x: (x[1], x[0]))
+        failed_tiers = {}
+        for node_idx, _ in failed_nodes:
+            tier = self.G.nodes[node_idx]["tier"]
+            failed_tiers[tier] = failed_tiers.get(tier, 0) + 1
+
+        summary = {
+            "sim_id": self.sim_id,
+            "seed": self.seed,
+            "network_topology": self.topology,
+            "homogeneous": self.homogeneous,
+            "t_max": self.t_max,
+            "financed": self.financed,
+            "paradigm": self.paradigm,
+            "operation_fee": self.operation_fee,
+            "loan_repayment_time": self.loan_repayment_time,
+            "bank_annual_rate": self.bank_annual_rate,
+            "invoice_annual_rate": self.invoice_annual_rate,
+            "invoice_term": self.invoice_term,
+            "window_size": self.window_size,
+            "forecast_method": self.forecast_method,
+            "regional_hops": (self.regional_financing or {}).get("num_hops", 0),
+            "regional_share": self.regional_financing.get("share", "focal") if self.regional_financing else None,
+            "market_orders": self.market_orders,
+            "shared_stock": self.shared_stock,
+            "demand_distribution": self.demand_distribution,
+            "demand_mean": self.distribution_params.get("mean", np.nan),
+            "demand_sigma": self.distribution_params.get("sigma", np.nan),
+            "demand_lambda": self.distribution_params.get("lambda", np.nan),
+        }
+        for power, market_share in zip(self.powers, self.market_shares):
+            summary[f"market_share_{power}"] = market_share
+        summary.update({
+            "t_end": self.t_end,
+            "stop_reason": self.stop_reason,
+            "survived": self.survived,
+            "num_failed": len(failed_nodes),
+            # Failed nodes and their failure timesteps, e.g., "3:77;11:120"
+            "failed_nodes": ";".join(f"{n}:{t}" for n, t in failed_nodes),
+            # Number of failures per tier, e.g., "1:2;4:1"
+            "failed_tiers": ";".join(f"{k}:{v}" for k, v in sorted(failed_tiers.items())),
+        })
+        for power in self.powers:
+            summary[f"failed_power_{power}"] = sum(
+                1 for n, _ in failed_nodes if self.G.nodes[n]["power"] == power)
+        # Depth of the deepest bankruptcy cascade, 0 if no failure followed a lost supplier
+        summary["cascade_depth"] = self.cascades.depth
+        # Parent of each failure within a cascade, e.g., "11:3;14:11", roots left out
+        summary["cascade_parents"] = ";".join(f"{f['node']}:{f['parent']}"
+                                              for f in self.cascades.tree()["failures"]
+                                              if f["parent"] is not None)
+        summary["total_loans"] = self.total_loans
+        summary["total_discounts"] = self.total_discounts
+        # Peak memory, and where it went, if profiled
+        summary.update(self.memory.report() if self.memory is not None
+                       else dict.fromkeys(report_columns))
+        return summary
+
         
     def run(self):
+        """
+        Run the simulation until it stops. The writer is closed and the memory
+        profiler stopped however the run ends, so that a run that fails leaves
+        no background writer thread waiting, nor memory traced.
+        """
+        if self.memory is not None:
+            self.memory.start()
+        try:
+            self._run()
+        finally:
+            self.writer.close()
+            if self.memory is not None:
+                self.memory.stop()
+
+
+    def _run(self):
         """
         Receivable, payable cash, and debts until repayment time
         `receivables`, `payables`, and `debts` are sliding windows 
         that update over the time step.
         Note: `payables` include the debts. 
-        `costs` records the costs in the past `window_size` timesteps.
-        `cash_flow` records the cash movement between nodes, keyed by payment timestep.
+        `forecaster` keeps rolling state of the costs in the past timesteps,
+        from which the financing thresholds of the `proactive` paradigm are forecast.
+        `cash_flow` records the cash movement between nodes, keyed by payment timestep,
+        for the timesteps recorded at the output level.
         """
 
         receivables = np.zeros((self.num_nodes, self.max_payment_delay+1))
         payables = np.zeros((self.num_nodes, self.max_payment_delay+1))
         debts = np.zeros((self.num_nodes, self.loan_repayment_time+1))
-        costs = np.zeros((self.num_nodes, self.window_size))
+        forecaster = get_forecaster(self.forecast_method, 
+                                    self.num_nodes,
+                                    self.window_size,
+                                    **self.forecast_params)
         cash_flow = {}
 
+        detector = None
+        if self.convergence:
+            detector = SteadyStateDetector(self.num_nodes,
+                                           self.convergence["window_size"],
+                                           self.convergence.get("cash_tolerance", 0))
+            is_dummy = np.array([self.network.is_dummy(n) for n in range(self.num_nodes)])
+
+        regions = None
+        if self.regional_financing:
+            regions = RegionalThresholds(self.G,
+                                         self.regional_financing["num_hops"],
+                                         excluded=[self.network.dummy_raw_material,
+                                                   self.network.dummy_market],
+                                         share=self.regional_financing.get("share", "focal"))
 
         """
-        A dictionary for storing new orders at the current timestep.
-        Its item {(buyer, seller): (buy_amount, receive_amount, replenish_required)} 
-        indicates: a `buyer` buys `buy_amount` from `seller`, 
-        and receives `receive_amount` and requires replenish or not.
+        The order book of the current timestep, whose orders
+        `(buyer, seller, amount, received, replenish)` indicate: a `buyer` buys `amount`
+        from `seller`, and receives `received` and requires replenish or not.
+        `suppliers` selects the sellers of orders, as the network loses nodes.
         """
-        new_orders = {}
+        book = OrderBook(self.network.edge_index, self.num_nodes)
+        suppliers = SupplierChoice([self.G])
+        is_bankrupt_node = np.zeros(self.num_nodes, dtype=bool)
         total_demands = 0
 
         for t in range(1, self.t_max + 1):
-            demand = get_demand(self.demand_distribution,
-                                **self.distribution_params)
+            demands = [self._get_demand(t) for _ in range(self.market_orders)]
+            demand = sum(demands)
             total_demands += demand
             print("_"*30)
             print(f"[{t:<8}], demand: {demand}, total_demand: {total_demands}")
 
-            # Save the data at current time step into file.
+            # Save the data at current time step into file, if recorded at the output level.
+            record = self.writer.is_recording(t)
             output_at_t = {}
             for col in columns:
                 output_at_t[col] = []
 
-            # New demand from market: randomly select an OEM to fill the demand
-            oem = select_seller(self.G, self.network.dummy_market)
-            new_orders[(self.network.dummy_market, oem)] = (demand, 0, False)
+            # New demand from market: randomly select an OEM to fill each market order
+            market = np.full(self.market_orders, self.network.dummy_market)
+            oems = self._select_sellers(t, market, suppliers)
+            book.add(market, oems, demands)
 
-            # Iterate all incoming orders, updapte receiveables, payables immediately,
+            # Match all incoming orders, updapte receiveables, payables immediately,
             # but deplay stock update till next time step (material needs one time step delivery).
-            for (buyer, seller), (buy_amount, _, replenish_required) in new_orders.items():
-                """
-                Action: stock balancing without check cash reserve.
-                        `buy_amount`: the accumulated amount of its unfilled orders;
-                        `receive_amount`: the actual receive amount, which is constrained by 
-                        the seller's stock.
-                """
-                stock = self.G.nodes[seller]["stock"]
-                receive_amount = min(stock, buy_amount)
-                print(
-                    f"  ({buyer:>2}->{seller:>2}): buy {buy_amount}, receive {receive_amount}")
-
-                # Label if the order triggers replenishment
-                replenish_required = True if stock <= buy_amount else False
-                new_orders[(buyer, seller)] = (
-                    buy_amount, receive_amount, replenish_required)
+            """
+            Action: stock balancing without check cash reserve.
+                    `amount`: the accumulated amount of its unfilled orders;
+                    `received`: the actual receive amount, which is constrained by 
+                    the seller's stock; the order triggers replenishment if the stock
+                    does not exceed the amount.
+            """
+            orders = book.match(self.stock[book.orders["seller"]], self.shared_stock)
+            buyers, sellers = orders["buyer"], orders["seller"]
+            print("\n".join(f"  ({b:>2}->{s:>2}): buy {a}, receive {r}" for _, b, s, a, r, _ in orders.tolist()))
 
-                """
-                Action: update receivables and payables. 
-                        If buyer or seller is dummy node, then payment occurs immediately; 
-                        Otherwise, delay payment as much as possible, which is determined by a node's power.
-                """
-                # Pay for the order: immediately or delay
-                payout = receive_amount * self.G.nodes[seller]["sell_price"]
-                if buyer == self.network.dummy_market or seller == self.network.dummy_raw_material:
-                    delay = 0
-                else:  # Delay
-                    p_b = self.G.nodes[buyer]["power"]
-                    p_s = self.G.nodes[seller]["power"]
-                    delay = self.payment_delay_matrix[p_b-1, p_s-1]
-                payables[buyer][delay] += payout
-                receivables[seller][delay] += payout
-
-                # Record cash flow: moves from `buyer` to `seller` at timestep `k`
-                if payout > 0:
-                    k = t + delay  # Keyed by actual payment timestep
-                    if k not in cash_flow:
-                        cash_flow[k] = {}
-                    cash_flow[k][(buyer, seller)] = payout
+            """
+            Action: update receivables and payables. 
+                    If buyer or seller is dummy node, then payment occurs immediately; 
+                    Otherwise, delay payment as much as possible, which is determined by a node's power.
+            """
+            # Pay for the orders: immediately or delay, both precomputed per edge
+            edges = book.edges()
+            payouts = orders["received"] * self.network.edge_sell_price[edges]
+            delays = self.network.edge_payment_delay[edges]
+            np.add.at(payables, (buyers, delays), payouts)
+            np.add.at(receivables, (sellers, delays), payouts)
+
+            # Record cash flow: moves from `buyer` to `seller` at timestep `k`
+            paid = payouts > 0
+            due = t + delays  # Keyed by actual payment timestep
+            self.cascades.add_payments(buyers[paid], sellers[paid], payouts[paid], due[paid])
+            for k in np.unique(due[paid]).tolist():
+                if self.writer.is_recording(k):
+                    at_k = paid & (due == k)
+                    cash_flow.setdefault(k, []).append((buyers[at_k], sellers[at_k], payouts[at_k]))
+            self._checkpoint("orders")
 
             """
             Action: handle receivables, payables, and debts at current time step. It includes:
@@ -295,6 +505,7 @@ class SCFSimulation(object):
                     4) pay payables; and 
                     5) decrement time to receive and pay
             """
+            costs = np.zeros(self.num_nodes)
             for node_idx in range(self.num_nodes):
 
                 # Exclude bankrupt nodes
@@ -305,16 +516,32 @@ class SCFSimulation(object):
                                     - self.operation_fee)
                     self.G.nodes[node_idx]["cash"] += payout_today
 
-                    # Record the costs at the timesteps within the given window size
-                    costs[node_idx][(t-1) % self.window_size] = abs(payout_today)
+                    # Record the costs at current timestep
+                    costs[node_idx] = abs(payout_today)
 
-                _stock = np.nan if _bankrupt else self.G.nodes[node_idx]["stock"]
+                # Decrement: the time to receive, to pay, and to repay decrement one time step.
+                # After decrement, their values at current time step should be reset
+                # to ZERO; we delay these actions after getting these values.
+                _received = receivables[node_idx][0]
+                _paid = payables[node_idx][0]
+                for d in range(self.max_payment_delay-1):
+                    receivables[node_idx][d] = receivables[node_idx][d+1]
+                    payables[node_idx][d] = payables[node_idx][d+1]
+                for d in range(self.loan_repayment_time-1):
+                    debts[node_idx][d] = debts[node_idx][d+1]
+                receivables[node_idx][self.max_payment_delay] = 0
+                payables[node_idx][self.max_payment_delay] = 0
+                debts[node_idx][self.loan_repayment_time] = 0
+
+                if not record:
+                    continue
+                _stock = np.nan if _bankrupt else int(self.stock[node_idx])
                 _cash = np.nan if _bankrupt else self.G.nodes[node_idx]["cash"]
                 _debt = np.nan if _bankrupt else self.G.nodes[node_idx]["debt"]
-                _unfilled = np.nan if _bankrupt else self.G.nodes[node_idx]["unfilled"]
-                _issued = np.nan if _bankrupt else self.G.nodes[node_idx]["issued"]
-                _received = np.nan if _bankrupt else receivables[node_idx][0]
-                _paid = np.nan if _bankrupt else payables[node_idx][0]
+                _unfilled = np.nan if _bankrupt else int(self.unfilled[node_idx])
+                _issued = np.nan if _bankrupt else int(self.issued[node_idx])
+                _received = np.nan if _bankrupt else _received
+                _paid = np.nan if _bankrupt else _paid
                 _b_loan = np.nan if _bankrupt else 0
 
                 output_at_t["timestep"].append(t)
@@ -339,27 +566,29 @@ class SCFSimulation(object):
                 output_at_t["payable"].append(_paid)
                 output_at_t["debt"].append(_debt)
 
-                # Decrement: the time to receive, to pay, and to repay decrement one time step.
-                # After decrement, their values at current time step should be reset
-                # to ZERO; we delay these actions after getting these values.
-                for d in range(self.max_payment_delay-1):
-                    receivables[node_idx][d] = receivables[node_idx][d+1]
-                    payables[node_idx][d] = payables[node_idx][d+1]
-                for d in range(self.loan_repayment_time-1):
-                    debts[node_idx][d] = debts[node_idx][d+1]
-                receivables[node_idx][self.max_payment_delay] = 0
-                payables[node_idx][self.max_payment_delay] = 0
-                debts[node_idx][self.loan_repayment_time] = 0
+            # Payments due at current timestep are paid
+            self.cascades.settle(t)
 
             ### Updating for next timestep ###
             """
             Action: Selecting financing threshold (ft).
-                    Now, the threshold value is set as 0, which may introduce ML methods 
-                    to predict its value. The potential methods are: 
-                        1) moving average; 
-                        2) time series forecasting methods.
+                    `reactive`: the threshold value is 0;
+                    `proactive`: the threshold value is forecast from the past costs,
+                    by one of the methods: 
+                        1) moving average (MA); 
+                        2) exponentially weighted moving average (EWMA); 
+                        3) Holt linear trend (Holt).
             """
-            # To-Do: ft forecast using moving avareage
+            if self.paradigm == "proactive":
+                forecaster.update(costs)
+                fts = forecaster.forecast()
+            elif self.paradigm == "reactive":
+                fts = np.zeros(self.num_nodes)
+            else:
+                raise ValueError("Paradigm must be either `reactive` or `proactive`.")
+            # Regional financing: nodes share the threshold of their focal node, or of their n-hop region
+            if regions is not None:
+                fts = regions.thresholds(fts)
 
             """
             Action: Seek bank financing. 
@@ -371,15 +600,7 @@ class SCFSimulation(object):
                         5) remove it from the network.
             """
             for node_idx in range(self.num_nodes):
-                # Financing threshold forecasting using moving average
-                ft = 0 # Default to `reactive`
-                if self.paradigm == "proactive":
-                    ft_forecast(costs[node_idx], "MA")
-                elif self.paradigm == "reactive":
-                    ft = 0
-                else:
-                    raise ValueError("Paradigm must be either `reactive` or `proactive`.")
-
+                ft = fts[node_idx]
                 node = self.G.nodes[node_idx]
                 # Omit backrupt nodes
                 if node["is_bankrupt"]:
@@ -408,11 +629,13 @@ class SCFSimulation(object):
                 payables[node_idx][self.loan_repayment_time-1] += loan_repayment
                 self.G.nodes[node_idx]["cash"] += loan
                 self.G.nodes[node_idx]["debt"] += loan_repayment
+                self.total_loans += loan
 
                 # Output
-                output_at_t["cash"][node_idx] = self.G.nodes[node_idx]["cash"]
-                output_at_t["debt"][node_idx] = self.G.nodes[node_idx]["debt"]
-                output_at_t["b_loan"][node_idx] = loan
+                if record:
+                    output_at_t["cash"][node_idx] = self.G.nodes[node_idx]["cash"]
+                    output_at_t["debt"][node_idx] = self.G.nodes[node_idx]["debt"]
+                    output_at_t["b_loan"][node_idx] = loan
 
                 # If cash is still not sufficient (<=0), then seek supply chain financing
                 if self.financed and self.G.nodes[node_idx]["cash"] <= 0:
@@ -422,6 +645,7 @@ class SCFSimulation(object):
                                                self.invoice_annual_rate,
                                                self.invoice_term)
                     self.G.nodes[node_idx]["cash"] += (receive_early - discount)
+                    self.total_discounts += discount
                     receivables[node_idx][self.invoice_term] -= receive_early
                 
                 # Update loan cap
@@ -441,53 +665,69 @@ class SCFSimulation(object):
                     print(f"max debt: {max_debt}.")
                     print(f"SC loan: {loan}.")
                     # Output: to file
-                    output_at_t["is_bankrupt"][node_idx] = True
+                    if record:
+                        output_at_t["is_bankrupt"][node_idx] = True
                     self.G.nodes[node_idx]["is_bankrupt"] = True
+                    self.bankrupt_at[node_idx] = t
+                    self.cascades.fail(node_idx, t)
+                    is_bankrupt_node[node_idx] = True
                     ebunch = list(self.G.in_edges(node_idx)) + list(self.G.out_edges(node_idx))
                     self.G.remove_edges_from(ebunch)
+                    suppliers.remove(node_idx)
+                    if regions is not None:
+                        regions.remove(node_idx)
                     # network.draw()
+            self._checkpoint("settlement")
 
             """
             Action: Update stock, unfilled_orders, issued_orders of both buyer and seller.
             """
-            for (buyer, seller), (buy_amount, receive_amount, _) in new_orders.items():
-                self.G.nodes[buyer]["stock"] += receive_amount
-                self.G.nodes[seller]["stock"] -= receive_amount
-                self.G.nodes[buyer]["unfilled"] -= receive_amount
-                self.G.nodes[seller]["unfilled"] += (buy_amount - receive_amount)
-                self.G.nodes[seller]["issued"] += receive_amount
-
-                # Output: set the values of the remaining four columns
-                output_at_t["order_from"][seller] = buyer
-                output_at_t["buy_amount"][seller] = buy_amount
-                output_at_t["receive_amount"][seller] = receive_amount
-                _purchase_value = self.G.nodes[seller]["sell_price"] * receive_amount
-                output_at_t["purchase_value"][buyer] = _purchase_value
-                output_at_t["sale_value"][seller] = _purchase_value
+            nodes, d_stock, d_unfilled, d_issued = book.deltas()
+            np.add.at(self.stock, nodes, d_stock)
+            np.add.at(self.unfilled, nodes, d_unfilled)
+            np.add.at(self.issued, nodes, d_issued)
+
+            # Output: set the values of the remaining four columns, of the last order at each node
+            if record:
+                for col in ("order_from", "buy_amount", "receive_amount", "purchase_value", "sale_value"):
+                    output_at_t[col] = np.array(output_at_t[col], dtype=float)
+                last = last_occurrences(sellers)
+                output_at_t["order_from"][sellers[last]] = buyers[last]
+                output_at_t["buy_amount"][sellers[last]] = orders["amount"][last]
+                output_at_t["receive_amount"][sellers[last]] = orders["received"][last]
+                output_at_t["sale_value"][sellers[last]] = payouts[last]
+                last = last_occurrences(buyers)
+                output_at_t["purchase_value"][buyers[last]] = payouts[last]
 
             """
             Action: output cash flows at the current timestep to file.
             """
             if t in cash_flow:
-                for (buyer, seller), pay_amount in cash_flow[t].items():
-                    output_at_t["cash_from"][seller] = buyer
-                    output_at_t["pay_amount"][seller] = pay_amount
+                flows = cash_flow.pop(t)
+                payers, payees, pay_amounts = (np.concatenate(x) for x in zip(*flows))
+                last = last_occurrences(payees)
+                for col in ("cash_from", "pay_amount"):
+                    output_at_t[col] = np.array(output_at_t[col], dtype=float)
+                output_at_t["cash_from"][payees[last]] = payers[last]
+                output_at_t["pay_amount"][payees[last]] = pay_amounts[last]
 
             """
-            Action: Update new orders, adding follow-up replenish orders.
+            Action: Update new orders, adding follow-up replenish orders,
+            one for all the unfilled orders of each seller requiring replenishment.
             """
-            replenish_orders = {}
-            for (buyer, seller), (_, _, replenish_required) in new_orders.items():
-                if replenish_required and not self.G.nodes[seller]["is_bankrupt"]:
-                    # Add follow-up replenish order
-                    new_seller = select_seller(self.G, seller)
-                    new_buyer = seller
-                    buy_amount = self.G.nodes[new_buyer]["unfilled"]
-                    replenish_orders[(new_buyer, new_seller)] = (buy_amount, 0, False)
-            new_orders = replenish_orders
+            new_buyers = book.replenishing(is_bankrupt_node)["seller"]
+            new_sellers = self._select_sellers(t, new_buyers, suppliers)
+            has_seller = new_sellers >= 0
+            new_buyers, new_sellers = new_buyers[has_seller], new_sellers[has_seller]
+            book.clear()
+            book.add(new_buyers, new_sellers, self.unfilled[new_buyers])
+            book.drop_duplicates()
+            self._checkpoint("updates")
 
             # Write to file
-            self.writer.append(output_at_t)
+            if record:
+                self.writer.append(output_at_t)
+            self._checkpoint("output")
 
             # Check if the graph is still connected, i.e., if there is
             # a path from dummy market to dummy raw material.
@@ -497,8 +737,21 @@ class SCFSimulation(object):
                                self.network.dummy_market):
                 print("\nNo path from dummy raw material to market!")
                 print("Network is unconnected, simulation ends.")
-                self.writer.write()
+                self._stop(t, "disconnected")
                 break
+
+            # Stop early if the network has reached steady state.
+            # The run survives, censored at the current timestep.
+            if detector is not None:
+                cash = np.array([self.G.nodes[n]["cash"] for n in range(self.num_nodes)], dtype=float)
+                active = ~is_dummy & ~np.array([self.G.nodes[n]["is_bankrupt"] 
+                                                for n in range(self.num_nodes)])
+                if detector.update(cash, active, payables.sum(axis=1), debts.sum(axis=1)):
+                    print(f"\nSteady state reached, simulation stops at timestep {t}.")
+                    self._stop(t, "converged")
+                    break
+        else:
+            self._stop(self.t_max, "t_max")
                 
 
 
@@ -0,0 +1,350 @@
+"""
+Sweep strategies other than the full grid: space-filling sampling of the
+numeric parameters (Latin hypercube or Sobol), and successive halving,
+which spends replicas and the full horizon only where outcomes are uncertain.
+Sobol sampling needs the optional `scipy` package.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+"""
+
+# %%
+import argparse
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from catalogue import Catalogue, catalogue_file
+from emulator import next_sim_id
+from grid_search import _build_sim_config, _fixed_values, count_sim_configs, execute
+from utils import load_config_file, make_seed_sequence, seed_to_str
+
+# Numeric parameters that are sampled, and which of them are integers
+numeric_params = ["operation_fee", "demand_mean", "demand_sigma",
+                  "loan_repayment_time", "bank_annual_rate", "invoice_annual_rate",
+                  "invoice_term", "window_size"]
+integer_params = ["loan_repayment_time", "invoice_term", "window_size"]
+
+samplers = ("lhs", "sobol", "random")
+
+
+def numeric_ranges(input_params):
+    """
+    The range `(low, high)` of each numeric parameter, spanned by its values in the grid inputs.
+    """
+    distribution = input_params["demand_distribution"][0]
+    values = {
+        "operation_fee": input_params["operation_fee"],
+        "demand_mean": input_params["distribution_params"][distribution]["mean"],
+        "demand_sigma": input_params["distribution_params"][distribution]["sigma"],
+        "loan_repayment_time": input_params["loan_repayment_time"],
+        "bank_annual_rate": input_params["bank_annual_rate"],
+        "invoice_annual_rate": input_params["invoice_annual_rate"],
+        "invoice_term": input_params["invoice_term"],
+        "window_size": input_params["moving_average"]["window_size"],
+    }
+    return {name: (min(values[name]), max(values[name])) for name in numeric_params}
+
+
+# %% Samplers on the unit hypercube
+def latin_hypercube(num_samples, num_dims, rng):
+    """
+    Latin hypercube sample: each dimension has exactly one point in each of
+    `num_samples` equal strata, at a random position within the stratum.
+    """
+    strata = np.argsort(rng.random((num_samples, num_dims)), axis=0)
+    return (strata + rng.random((num_samples, num_dims))) / num_samples
+
+
+def unit_samples(method, num_samples, num_dims, seed=None):
+    """
+    Draw `num_samples` points in the unit hypercube of `num_dims` dimensions.
+
+    Parameters
+    ----------
+    `method`: str
+        `lhs` (Latin hypercube), `sobol` (scrambled Sobol sequence, best with
+        a power of two samples) or `random` (uniform).
+    """
+    if method not in samplers:
+        raise ValueError(f"Unrecognised sampler '{method}', must be one of {samplers}.")
+    rng = np.random.default_rng(seed)
+    if method == "lhs":
+        return latin_hypercube(num_samples, num_dims, rng)
+    elif method == "sobol":
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ImportError("Sobol sampling requires `scipy`, install it or use `lhs`.")
+        return qmc.Sobol(num_dims, scramble=True, seed=rng).random(num_samples)
+    return rng.random((num_samples, num_dims))
+
+
+def scale_samples(unit, ranges):
+    """
+    Scale unit samples to the ranges of the parameters, rounding integer parameters.
+
+    Parameters
+    ----------
+    `unit`: np.ndarray
+        Samples in the unit hypercube, one column per parameter in `ranges`.
+    `ranges`: dict
+        `{name: (low, high)}` of the parameters.
+
+    Returns
+    -------
+        pd.DataFrame: One row per sample, one column per parameter.
+    """
+    samples = {}
+    for j, (name, (low, high)) in enumerate(ranges.items()):
+        values = low + unit[:, j] * (high - low)
+        samples[name] = np.round(values).astype(int) if name in integer_params else values
+    return pd.DataFrame(samples)
+
+
+# %% Sampled sweep
+def _categorical_combinations(input_params):
+    """
+    The combinations of categorical inputs, each of which is run at every sampled point.
+    """
+    shares = [(1, m, l) for m, l in itertools.product(input_params["market_shares"]["medium"],
+                                                      input_params["market_shares"]["large"])
+              if 1 <= m <= l]
+    return list(itertools.product(input_params["network_topology"],
+                                  input_params["homogeneous"],
+                                  shares,
+                                  input_params["financed"],
+                                  input_params["paradigm"]))
+
+
+def sample_sim_configs(input_params, num_samples, method="lhs", seed=None, first_sim_id=None):
+    """
+    Sample the numeric parameters within the ranges of the grid inputs, and run
+    each sample under every combination of the categorical inputs (topology,
+    homogeneity, market shares, financing and paradigm). Parameters unused by
+    a config, e.g., rates without financing, get the placeholders of the grid.
+
+    Parameters
+    ----------
+    `input_params`: dict
+        The grid search inputs, e.g., loaded from `grid_search_inputs.yaml`.
+    `num_samples`: int
+        The number of sampled points of the numeric parameters.
+    `method`: str
+        The sampler, see `unit_samples`.
+    `seed`: int, optional
+        The seed of the samples, by default the seed of the grid inputs.
+    `first_sim_id`: int, optional
+        The `sim_id` of the first config, by default the one after the last of
+        the grid and of the runs in the results table, see `emulator.next_sim_id`,
+        so that sampled configs neither overwrite the output files of earlier
+        configs nor share their seeds, which are spawned by `sim_id`.
+
+    Returns
+    -------
+        list: The configs, as enumerated by `grid_search.iter_sim_configs`.
+    """
+    ranges = numeric_ranges(input_params)
+    seed = input_params.get("seed") if seed is None else seed
+    samples = scale_samples(unit_samples(method, num_samples, len(ranges), seed), ranges)
+    fixed = _fixed_values(input_params)
+    distribution = input_params["demand_distribution"][0]
+
+    sim_configs = []
+    sim_id = first_sim_id
+    if sim_id is None:
+        sim_id = max(count_sim_configs(input_params) + 1, next_sim_id())
+    for topology, homogeneous, market_shares, financed, paradigm in _categorical_combinations(input_params):
+        for p in samples.to_dict("records"):
+            financing = (False, 0, 0, 0, 0)  # 0 as a placeholder
+            if financed:
+                financing = (True, int(p["loan_repayment_time"]), float(p["bank_annual_rate"]),
+                             float(p["invoice_annual_rate"]), int(p["invoice_term"]))
+            financing_threshold = ("reactive", 1)  # 1 as a placeholder
+            if paradigm == "proactive":
+                financing_threshold = ("proactive", int(p["window_size"]))
+            values = [topology, homogeneous, float(p["operation_fee"]),
+                      distribution, float(p["demand_mean"]), float(p["demand_sigma"]),
+                      market_shares, financing, financing_threshold]
+            sim_configs.append(_build_sim_config(sim_id, fixed, values))
+            sim_id += 1
+    return sim_configs
+
+
+# %% Successive halving
+def _numeric_values(config):
+    return [config["operation_fee"],
+            config["distribution_params"]["mean"], config["distribution_params"]["sigma"],
+            config["loan_repayment_time"], config["bank_annual_rate"], config["invoice_annual_rate"],
+            config["invoice_term"], config["window_size"]]
+
+
+def _categorical_values(config):
+    return (config["network_topology"], config["homogeneous"], tuple(config["market_shares"]),
+            config["financed"], config["paradigm"])
+
+
+def replicate(config, t_max, round_idx, replica):
+    """
+    A replica of a config, run up to `t_max`, with its own seed spawned from the config's seed.
+    """
+    replica_config = dict(config)
+    replica_config["sim_id"] = f"{config['sim_id']}_{round_idx}_{replica}"
+    replica_config["t_max"] = t_max
+    if config.get("seed") is not None:
+        seed_seq = make_seed_sequence(config["seed"])
+        replica_config["seed"] = seed_to_str(np.random.SeedSequence(
+            seed_seq.entropy, spawn_key=seed_seq.spawn_key + (replica,)))
+    return replica_config
+
+
+def transition_scores(outcomes, features, groups, num_neighbours=5):
+    """
+    How far the outcome of each point is from those of its nearest neighbours
+    with the same categorical inputs, high near a transition between regimes.
+
+    Parameters
+    ----------
+    `outcomes`: np.ndarray
+        The outcome of each point, e.g., its survival rate.
+    `features`: np.ndarray
+        The numeric parameters of each point, one row per point.
+    `groups`: list
+        The categorical inputs of each point.
+    """
+    span = features.max(axis=0) - features.min(axis=0)
+    scaled = (features - features.min(axis=0)) / np.where(span > 0, span, 1)
+    scores = np.zeros(len(outcomes))
+    codes = {}
+    groups = np.array([codes.setdefault(g, len(codes)) for g in groups])
+    for group in range(len(codes)):
+        members = np.flatnonzero(groups == group)
+        if len(members) < 2:
+            continue
+        dists = np.linalg.norm(scaled[members, None] - scaled[None, members], axis=-1)
+        np.fill_diagonal(dists, np.inf)
+        k = min(num_neighbours, len(members) - 1)
+        neighbours = members[np.argsort(dists, axis=1)[:, :k]]
+        scores[members] = np.abs(outcomes[members] - outcomes[neighbours].mean(axis=1))
+    return scores
+
+
+def successive_halving(sim_configs, network_config, eta=3, num_rounds=3,
+                       min_replicas=2, replica_growth=2,
+                       executor=None, catalogue=None):
+    """
+    Successive halving: run all configs with few replicas over a short horizon,
+    then keep the `1/eta` of them whose outcomes are the most uncertain or near
+    a transition, and run those with more replicas over a longer horizon, until
+    the last round, which runs the full horizon `t_max` of the configs.
+
+    A config is scored by the spread of its replicas (the standard deviation of
+    survival plus that of survival time relative to the horizon), plus how far
+    its survival rate and its mean survival time relative to the horizon are
+    from those of its nearest neighbours, see `transition_scores`. Configs
+    tied on their scores are kept in their order.
+
+    Parameters
+    ----------
+    `sim_configs`: list
+        The configs, as enumerated by `iter_sim_configs` or `sample_sim_configs`.
+    `eta`: int
+        The reduction factor: each round keeps `1/eta` of the configs,
+        and the horizon is `eta` times longer.
+    `num_rounds`: int
+        The number of rounds.
+    `min_replicas`: int
+        The number of replicas per config in the first round, at least 2 for
+        the spread of the replicas to score the configs.
+    `replica_growth`: int
+        The factor by which the number of replicas grows each round.
+
+    Returns
+    -------
+        pd.DataFrame: One row per config per round it ran in, with its outcomes,
+        score and whether it was promoted. Every replica is also recorded in the
+        results table and the catalogue, as in `grid_search.execute`.
+    """
+    points = list(sim_configs)
+    rows = []
+    for round_idx in range(num_rounds):
+        num_replicas = min_replicas * replica_growth ** round_idx
+        scale = eta ** (num_rounds - 1 - round_idx)
+        replica_configs = [replicate(config, max(1, math.ceil(config["t_max"] / scale)), round_idx, r)
+                           for config in points for r in range(num_replicas)]
+        summaries = execute(replica_configs, network_config, executor, catalogue,
+                            return_summaries=True)
+
+        survived = np.array([float(s["survived"]) for s in summaries]).reshape(len(points), num_replicas)
+        horizons = np.array([c["t_max"] for c in replica_configs]).reshape(len(points), num_replicas)
+        t_end = np.array([s["t_end"] for s in summaries], dtype=float).reshape(len(points), num_replicas)
+        survival_rate = survived.mean(axis=1)
+        features = np.array([_numeric_values(c) for c in points], dtype=float)
+        groups = [_categorical_values(c) for c in points]
+        score = (survived.std(axis=1) + (t_end / horizons).std(axis=1)
+                 + transition_scores(survival_rate, features, groups)
+                 + transition_scores((t_end / horizons).mean(axis=1), features, groups))
+
+        num_kept = max(1, math.ceil(len(points) / eta)) if round_idx < num_rounds - 1 else 0
+        # Stable sort, so that ties are kept in the order of the configs
+        kept = np.argsort(-score, kind="stable")[:num_kept]
+        promoted = np.zeros(len(points), dtype=bool)
+        promoted[kept] = True
+        for i, config in enumerate(points):
+            rows.append({
+                "sim_id": config["sim_id"],
+                "round": round_idx,
+                "t_max": int(horizons[i, 0]),
+                "num_replicas": num_replicas,
+                "survival_rate": survival_rate[i],
+                "t_end_mean": t_end[i].mean(),
+                "t_end_std": t_end[i].std(),
+                "score": score[i],
+                "promoted": promoted[i],
+            })
+        points = [points[i] for i in sorted(kept)]
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sampled and successive-halving sweeps.")
+    parser.add_argument("--inputs", default="configs/grid_search_inputs.yaml",
+                        help="Grid search inputs file, whose values span the sampled ranges.")
+    parser.add_argument("--sampler", default="lhs", choices=samplers,
+                        help="Sampler of the numeric parameters.")
+    parser.add_argument("--samples", default=64, type=int,
+                        help="Number of sampled points, each run under every categorical combination.")
+    parser.add_argument("--first-sim-id", default=None, type=int,
+                        help="The sim_id of the first sampled config, by default the one after the grid "
+                             "and the results table.")
+    parser.add_argument("--halving", action="store_true",
+                        help="Run the sampled configs by successive halving.")
+    parser.add_argument("--eta", default=3, type=int, help="Reduction factor of successive halving.")
+    parser.add_argument("--rounds", default=3, type=int, help="Number of rounds of successive halving.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of worker processes.")
+    parser.add_argument("--catalogue", default=catalogue_file,
+                        help="SQLite catalogue recording every simulation, empty to disable.")
+    args = parser.parse_args()
+
+    network_config = load_config_file("configs/network_config.yaml")
+    input_params = load_config_file(args.inputs)
+    sim_configs = sample_sim_configs(input_params, args.samples, args.sampler,
+                                     first_sim_id=args.first_sim_id)
+
+    catalogue = Catalogue(args.catalogue) if args.catalogue else None
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        if args.halving:
+            rounds = successive_halving(sim_configs, network_config, args.eta, args.rounds,
+                                        executor=executor, catalogue=catalogue)
+            print(rounds.groupby("round").agg(num_configs=("sim_id", "size"), t_max=("t_max", "first"),
+                                              num_replicas=("num_replicas", "first")).to_string())
+        else:
+            execute(sim_configs, network_config, executor, catalogue)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if catalogue is not None:
+            catalogue.close()
@@ -0,0 +1,208 @@
+"""
+Timestep-indexed trajectory files, for reading the data at a few timesteps
+of a large run without loading the whole file.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+
+A CSV trajectory is indexed by a sidecar file `<trajectory>.idx`, holding
+for each timestep the byte offset of its first row and its number of rows;
+rows are written in timestep order, one line each. A Parquet trajectory is
+written in row groups of consecutive timesteps, found by their statistics.
+"""
+
+# %%
+import argparse
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def index_file(path):
+    return path + ".idx"
+
+
+def _index_entries(timesteps, row_starts):
+    """
+    `(timestep, offset, num_rows)` of each run of rows at the same timestep.
+    """
+    starts = np.flatnonzero(np.diff(timesteps, prepend=timesteps[0] - 1))
+    num_rows = np.diff(np.append(starts, len(timesteps)))
+    return list(zip(timesteps[starts].tolist(), row_starts[starts].tolist(), num_rows.tolist()))
+
+
+class TrajectoryIndex(object):
+    """
+    Index of a CSV trajectory, built as blocks of rows are written.
+    Each entry is `(timestep, offset, num_rows)`.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+
+    def add(self, timesteps, text, offset):
+        """
+        Index a block of CSV rows without header.
+
+        Parameters
+        ----------
+        `timesteps`: np.ndarray
+            The timestep of each row in the block.
+        `text`: bytes
+            The block as written.
+        `offset`: int
+            The byte offset of the block in the file.
+        """
+        if len(timesteps) == 0:
+            return
+        line_ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == ord("\n"))
+        row_starts = np.concatenate(([0], line_ends[:-1] + 1)) + offset
+        self.entries.extend(_index_entries(timesteps, row_starts))
+
+
+    def save(self, path):
+        with open(index_file(path), "wb") as file:
+            np.save(file, np.array(self.entries, dtype=np.int64).reshape(-1, 3))
+
+
+def write_csv_block(file, frame, index, header=False):
+    """
+    Write a block of rows into a CSV trajectory opened in binary mode, and index it.
+    """
+    if header:
+        file.write(",".join(frame.columns).encode() + b"\n")
+    text = frame.to_csv(index=False, header=False, lineterminator="\n").encode()
+    index.add(frame["timestep"].to_numpy(), text, file.tell())
+    file.write(text)
+
+
+def build_index(path, block_size=1 << 26):
+    """
+    Index an existing CSV trajectory, e.g., one written before indexing,
+    by scanning it once, and save the index next to it.
+    """
+    timesteps = pd.read_csv(path, usecols=["timestep"])["timestep"].to_numpy()
+    line_starts = []
+    with open(path, "rb") as file:
+        offset = 0
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            line_ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+            line_starts.append(line_ends + offset + 1)
+            offset += len(block)
+    # The first line is the header; the line after the last newline is empty
+    row_starts = np.concatenate(line_starts)[:len(timesteps)]
+
+    index = TrajectoryIndex()
+    if len(timesteps):
+        index.entries = _index_entries(timesteps, row_starts)
+    index.save(path)
+    return index
+
+
+class TrajectoryReader(object):
+    """
+    Random-access reader of a trajectory file, CSV or Parquet,
+    reading only the rows of the requested timesteps.
+    A CSV trajectory without index is indexed once, when first opened.
+
+    Parameters
+    ----------
+    `path`: str
+        The trajectory file, as written by `output.Writer`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_parquet = path.endswith(".parquet")
+        if self.is_parquet:
+            import pyarrow.parquet as pq
+            self.file = pq.ParquetFile(path)
+            self.columns = self.file.schema_arrow.names
+            # Timestep range of each row group
+            col = self.columns.index("timestep")
+            self.row_groups = []
+            for i in range(self.file.num_row_groups):
+                stats = self.file.metadata.row_group(i).column(col).statistics
+                self.row_groups.append((stats.min, stats.max))
+            self.timesteps = np.unique(self.file.read(columns=["timestep"]).column(0).to_numpy())
+        else:
+            if (not os.path.exists(index_file(path))
+                    or os.path.getmtime(index_file(path)) < os.path.getmtime(path)):
+                build_index(path)
+            with open(index_file(path), "rb") as file:
+                entries = np.load(file)
+            self.timesteps, self.offsets, self.num_rows = entries.T
+            with open(path, "rb") as file:
+                self.header = file.readline()
+            self.columns = self.header.decode().strip().split(",")
+
+
+    @property
+    def max_timestep(self):
+        return int(self.timesteps[-1]) if len(self.timesteps) else 0
+
+
+    def frame(self, t):
+        """
+        The data at timestep `t`, empty if not recorded.
+        """
+        return self.frames(t, t)
+
+
+    def frames(self, t0, t1):
+        """
+        The data from timestep `t0` to `t1`, both included.
+        """
+        if self.is_parquet:
+            groups = [i for i, (lo, hi) in enumerate(self.row_groups) if lo <= t1 and hi >= t0]
+            if not groups:
+                return self.file.schema_arrow.empty_table().to_pandas()
+            data = self.file.read_row_groups(groups).to_pandas()
+            return data[(data.timestep >= t0) & (data.timestep <= t1)].reset_index(drop=True)
+
+        first = np.searchsorted(self.timesteps, t0, side="left")
+        last = np.searchsorted(self.timesteps, t1, side="right") - 1
+        if last < first:
+            if len(self.timesteps) == 0:
+                return pd.read_csv(io.BytesIO(self.header))
+            # No rows, with the dtypes of the first timestep
+            return self.frames(self.timesteps[0], self.timesteps[0]).iloc[:0]
+        start = self.offsets[first]
+        end = self.offsets[last + 1] if last + 1 < len(self.offsets) else None
+        with open(self.path, "rb") as file:
+            file.seek(start)
+            text = file.read() if end is None else file.read(end - start)
+        return pd.read_csv(io.BytesIO(self.header + text))
+
+
+    def iter_frames(self, t0=None, t1=None, block_size=100):
+        """
+        Stream the data from timestep `t0` to `t1`, one timestep at a time,
+        reading `block_size` timesteps at once.
+
+        Yields
+        ------
+            tuple: The timestep and its data.
+        """
+        t0 = self.timesteps[0] if t0 is None else t0
+        t1 = self.max_timestep if t1 is None else t1
+        for start in range(int(t0), int(t1) + 1, block_size):
+            block = self.frames(start, min(start + block_size - 1, t1))
+            for t, data_at_t in block.groupby("timestep", sort=True):
+                yield t, data_at_t
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preview timesteps of a trajectory file.")
+    parser.add_argument("trajectory", help="The trajectory file.")
+    parser.add_argument("t0", type=int, help="The first timestep.")
+    parser.add_argument("t1", type=int, nargs="?", help="The last timestep, `t0` by default.")
+    args = parser.parse_args()
+
+    reader = TrajectoryReader(args.trajectory)
+    print(reader.frames(args.t0, args.t0 if args.t1 is None else args.t1).to_string())
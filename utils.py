@@ -4,9 +4,41 @@ Author: Liming Xu
 Email: lx249@cam.ac.uk
 """
 import yaml 
+import numpy as np
 
 # %% Load config parameters
 def load_config_file(config_file_path, mode="r"):
     with open(config_file_path, mode) as file:
         config = yaml.safe_load(file)
     return config
+
+
+# %% Seeds of random streams
+def make_seed_sequence(seed=None):
+    """
+    Make a `np.random.SeedSequence` from a seed.
+
+    Parameters
+    ----------
+    `seed`: int, str, SeedSequence or None
+        An integer entropy; a string `entropy` or `entropy:k1.k2`, as given 
+        by `seed_to_str`, where `k1.k2` is the spawn key; a SeedSequence; 
+        or None for fresh entropy from the OS (recorded in the SeedSequence).
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, str):
+        entropy, _, spawn_key = seed.partition(":")
+        spawn_key = tuple(int(k) for k in spawn_key.split(".")) if spawn_key else ()
+        return np.random.SeedSequence(int(entropy), spawn_key=spawn_key)
+    return np.random.SeedSequence(seed)
+
+
+def seed_to_str(seed_seq):
+    """
+    Represent a SeedSequence as a string `entropy` or `entropy:k1.k2`, 
+    from which `make_seed_sequence` recreates it.
+    """
+    if not seed_seq.spawn_key:
+        return str(seed_seq.entropy)
+    return f"{seed_seq.entropy}:{'.'.join(str(k) for k in seed_seq.spawn_key)}"
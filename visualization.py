@@ -0,0 +1,74 @@
+"""
+Drawing the supply chain network using `matplotlib`.
+This module is only imported on demand, so that running simulations never 
+pays for importing `matplotlib`.
+Author: Liming Xu
+Email: lx249@cam.ac.uk
+"""
+
+# %%
+import networkx as nx
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+# %% Calculate node position.
+# The entire drawing area is spanning from bottom left (0, 0) (origin point)
+# to top right (1, 1)
+def tiered_layout(tiers, 
+                  max_tier_width, num_tiers, 
+                  padding_x=0.1, padding_y=0.1):
+    left_x, right_x = padding_x, 1 - padding_x
+    bottom_y, top_y = padding_y, 1 - padding_y
+    canvas_width, canvas_length = right_x - left_x, top_y - bottom_y
+
+    # Horizontally position nodes from right to left tier by tier
+    # Vertically position nodes in central area with even interval
+    layout = {}
+    y_intv = canvas_width / (max_tier_width - 1)
+    linspace_x = np.linspace(left_x, right_x, num_tiers)
+    for tier_idx, v in tiers.items():
+        tier_width = tiers[tier_idx]["width"]
+        base_y = top_y - (max_tier_width - tier_width) * y_intv / 2  # Most top node
+        nodes = tiers[tier_idx]["nodes"]
+        for idx, v in enumerate(nodes):
+            x_pos = linspace_x[num_tiers - tier_idx - 1]
+            y_pos = base_y - idx * y_intv
+            layout[v] = (x_pos, y_pos)
+    return layout
+
+
+# %% Get the node labels
+def get_node_labels(network):
+    labels = {}
+    for node_idx in range(network.G.number_of_nodes()):
+        labels[node_idx] = str(node_idx)
+    labels[network.dummy_raw_material] = ""
+    labels[network.dummy_market] = ""
+    return labels
+
+
+# %% Get the node colors
+def get_node_colors(network, node_options):
+    _color = node_options["healthy"]["color"]
+    colors = [_color] * network.G.number_of_nodes()
+    colors[network.dummy_raw_material] = node_options["raw_material"]["color"]
+    colors[network.dummy_market] = node_options["market"]["color"]
+    return colors
+
+
+# %% Draw graph and return current figure and axes
+def draw_graph(network, figsize=(10, 4), **options):
+    plt.figure(figsize=figsize, frameon=False)
+    nx.draw_networkx(network.G, 
+                     pos=network.layout,
+                     labels=network.node_labels,
+                     node_color=network.node_colors,
+                     **options)
+    return (plt.gcf(), plt.gca())
+
+
+def draw(network):
+    graph_options = network.config["graph_options"]
+    fig, ax = draw_graph(network, network.config["figsize"], **graph_options)
+    return fig, ax